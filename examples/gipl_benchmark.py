@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_benchmark.py
+
+Time GIPL on synthetic inputs, through BmiGiplMethod and the standalone
+gipl executable, and store the timings as JSON so that runs can be
+compared across commits.
+
+Run from the ./gipl/ directory, after "make gipl f2py_gipl.so", e.g.:
+    python ../examples/gipl_benchmark.py --sites 64 --nodes 176 --years 3 \\
+        --output bench.json
+and later, to compare against those timings:
+    python ../examples/gipl_benchmark.py --sites 64 --nodes 176 --years 3 \\
+        --compare bench.json
+
+NOTES:
+    The synthetic inputs are made from the sample inputs in ./gipl/in/:
+        sites:    the sample sites repeated to N sites
+        forcing:  the sample columns repeated to N sites, and the records
+                  repeated in time if Y years need more of them
+        grid:     M nodes interpolated over the index of the sample grid,
+                  with the stored nodes nearest to the sample's stored depths
+    The inputs are written to a work directory, with paths relative to it
+        in the configuration file because the Fortran code limits file
+        names to 64 characters.
+
+    The BMI run is timed in phases: initialize, a third of the years with
+        update(), a third with the update_model and write_output steps of
+        update() timed apart, the rest with update_until(), and finalize.
+    The standalone executable is timed as a whole.
+    Rates are given as model steps per second and site-years per second.
+    Each timing is the best of --repeat runs.
+
+    --compare prints the change of every rate against a stored JSON file,
+        and exits with status 1 if any rate dropped by more than
+        --tolerance (a fraction, 0.1 by default).
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+
+import numpy as np
+
+
+_cfg_template = """input files
+in/sites.txt
+in/bound.txt
+in/snow.txt
+in/rsnow.txt
+in/initial.txt
+in/grid.txt
+in/vegetation.txt
+in/geo.txt
+
+output files
+output/mean.txt
+output/result.txt
+output/start.txt
+
+0/1: start from previous time step / start from the beginning
+1
+step | taum | tmin :
+ 1.0       0.1       0.0010
+begin end : start and end, in the example it runs over one year from 0 to 1
+ 0         {n_years}
+smoothing factor | unfrozen water parameter | max number of iterations
+ 0.0100    0.0100    5
+number of second in a day [sec] | number of time steps (in the example number of days in a year )
+2628000            {n_time}
+sea level | max number of freezing fronts [integer number]
+ 0.000     4
+freezing front min and max depth [meters]
+ 0.05      10.00
+saturation coefficient (fraction of 1)
+ 0.95
+"""
+
+_n_time = 12
+
+
+def _write_sites(in_dir, out_dir, n_sites):
+    with open(os.path.join(in_dir, 'sites.txt')) as f:
+        n_sample = int(f.readline().split()[0])
+        sample = [f.readline().split() for i in range(n_sample)]
+    with open(os.path.join(out_dir, 'sites.txt'), 'w') as f:
+        f.write(' {}\n'.format(n_sites))
+        for i_site in range(n_sites):
+            fields = sample[i_site % n_sample]
+            f.write(' '.join([str(i_site + 1)] + fields[1:]) + '\n')
+
+
+def _write_forcing(in_dir, out_dir, name, n_sites, n_records):
+    data = np.loadtxt(os.path.join(in_dir, name), skiprows=1, ndmin=2)
+    values = data[:, 1:]
+    columns = np.arange(n_sites) % values.shape[1]
+    rows = np.arange(n_records) % values.shape[0]
+    times = data[0, 0] + np.arange(n_records) * (data[1, 0] - data[0, 0])
+    with open(os.path.join(out_dir, name), 'w') as f:
+        f.write('{}\n'.format(n_records))
+        for i_rec in range(n_records):
+            f.write('{:g} '.format(times[i_rec]))
+            f.write(' '.join('{:.10f}'.format(v)
+                             for v in values[rows[i_rec], columns]))
+            f.write('\n')
+
+
+def _write_grid(in_dir, out_dir, n_nodes):
+    with open(os.path.join(in_dir, 'grid.txt')) as f:
+        n_grd = int(f.readline().split()[0])
+        depths = np.array([float(f.readline()) for i in range(n_grd)])
+        m_grd = int(f.readline().split()[0])
+        stored = np.array([int(f.readline().split()[0])
+                           for i in range(m_grd)])
+
+    new_depths = np.interp(np.linspace(0, n_grd - 1, n_nodes),
+                           np.arange(n_grd), depths)
+    new_stored = sorted(set(
+        int(np.argmin(np.abs(new_depths - depths[i - 1]))) + 1
+        for i in stored))
+
+    with open(os.path.join(out_dir, 'grid.txt'), 'w') as f:
+        f.write('{}\n'.format(n_nodes))
+        for depth in new_depths:
+            f.write('{:.6f}\n'.format(depth))
+        f.write('{}\n'.format(len(new_stored)))
+        for i in new_stored:
+            f.write('{}\n'.format(i))
+
+
+def make_inputs(workdir, n_sites, n_nodes, n_years, sample_dir):
+    """ Write synthetic inputs and a configuration file to workdir """
+    in_dir = os.path.join(workdir, 'in')
+    for d in (in_dir, os.path.join(workdir, 'output')):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    _write_sites(sample_dir, in_dir, n_sites)
+    # The year-end interpolation reaches two steps into the next year
+    n_records = _n_time * (n_years + 1) + 2
+    for name in ('bound.txt', 'snow.txt', 'rsnow.txt'):
+        _write_forcing(sample_dir, in_dir, name, n_sites, n_records)
+    _write_grid(sample_dir, in_dir, n_nodes)
+    for name in ('initial.txt', 'vegetation.txt', 'geo.txt'):
+        shutil.copyfile(os.path.join(sample_dir, name),
+                        os.path.join(in_dir, name))
+
+    cfg_filename = 'benchmark.cfg'
+    with open(os.path.join(workdir, cfg_filename), 'w') as f:
+        f.write(_cfg_template.format(n_years=n_years, n_time=_n_time))
+    return cfg_filename
+
+
+def _rates(seconds, n_steps, n_sites):
+    if not n_steps:
+        return None
+    return {
+        'seconds':             seconds,
+        'steps':               n_steps,
+        'steps_per_sec':       n_steps / seconds,
+        'site_years_per_sec':  n_sites * n_steps / float(_n_time) / seconds,
+    }
+
+
+def time_bmi(workdir, cfg_filename, n_sites):
+    """ Time the phases of a run through BmiGiplMethod """
+    import bmi_gipl
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        model = bmi_gipl.BmiGiplMethod()
+
+        start = time.time()
+        model.initialize(cfg_filename)
+        t_initialize = time.time() - start
+
+        n_steps = int(round(model.get_end_time()))
+        n_years = n_steps // _n_time
+        update_steps = _n_time * ((n_years + 2) // 3)
+        split_steps = min(_n_time * ((n_years + 1) // 3),
+                          n_steps - update_steps)
+
+        start = time.time()
+        for i_step in range(update_steps):
+            model.update()
+        t_update = time.time() - start
+
+        # update() is update_model() followed by write_output()
+        t_update_model = 0.0
+        t_write_output = 0.0
+        with bmi_gipl._model_lock:
+            model._model.select_instance(model._handle)
+            for i_step in range(split_steps):
+                start = time.time()
+                model._model.update_model()
+                t_update_model += time.time() - start
+                start = time.time()
+                model._model.write_output()
+                t_write_output += time.time() - start
+
+        until_steps = n_steps - update_steps - split_steps
+        start = time.time()
+        model.update_until(model.get_end_time())
+        t_update_until = time.time() - start
+
+        start = time.time()
+        model.finalize()
+        t_finalize = time.time() - start
+    finally:
+        os.chdir(cwd)
+
+    return {
+        'initialize':    {'seconds': t_initialize},
+        'update':        _rates(t_update, update_steps, n_sites),
+        'update_model':  _rates(t_update_model, split_steps, n_sites),
+        'write_output':  _rates(t_write_output, split_steps, n_sites),
+        'update_until':  _rates(t_update_until, until_steps, n_sites),
+        'finalize':      {'seconds': t_finalize},
+    }
+
+
+def time_binary(workdir, cfg_filename, gipl_executable, n_sites, n_years):
+    """ Time a whole run of the standalone executable """
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call([gipl_executable, cfg_filename], cwd=workdir,
+                              stdout=devnull)
+        seconds = time.time() - start
+    return {'run': _rates(seconds, n_years * _n_time, n_sites)}
+
+
+def _best(runs):
+    """ Keep the shortest time of every phase of several runs """
+    best = runs[0]
+    for run in runs[1:]:
+        for phase, timing in run.items():
+            if timing and timing['seconds'] < best[phase]['seconds']:
+                best[phase] = timing
+    return best
+
+
+def _git_commit(directory):
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=directory,
+                stderr=devnull)
+        return commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, reference, tolerance):
+    """ Print the change of every rate, return False on a regression """
+    ok = True
+    for runner in ('bmi', 'binary'):
+        for phase, timing in sorted(results.get(runner, {}).items()):
+            old = reference.get(runner, {}).get(phase)
+            if not timing or not old:
+                continue
+            for key in ('steps_per_sec', 'seconds'):
+                if key in timing and key in old:
+                    break
+            change = timing[key] / old[key] - 1.0
+            if key == 'seconds':
+                change = -change
+            slower = change < -tolerance
+            ok = ok and not slower
+            print('{:8s} {:14s} {:+7.1%}{}'.format(
+                runner, phase, change, '  REGRESSION' if slower else ''))
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time GIPL on synthetic inputs')
+    parser.add_argument('--sites', type=int, default=16)
+    parser.add_argument('--nodes', type=int, default=176)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--gipl-dir', default=os.getcwd(),
+                        help='directory with gipl, f2py_gipl and bmi_gipl.py')
+    parser.add_argument('--workdir', default=None,
+                        help='where to write the inputs (default: temporary)')
+    parser.add_argument('--no-bmi', action='store_true')
+    parser.add_argument('--no-binary', action='store_true')
+    parser.add_argument('--output', help='JSON file to store the timings in')
+    parser.add_argument('--compare', help='JSON file of earlier timings')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    gipl_dir = os.path.abspath(args.gipl_dir)
+    sys.path.insert(0, gipl_dir)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='gipl_benchmark_')
+    try:
+        cfg_filename = make_inputs(workdir, args.sites, args.nodes,
+                                   args.years, os.path.join(gipl_dir, 'in'))
+
+        results = {
+            'commit':      _git_commit(gipl_dir),
+            'date':        time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host':        platform.node(),
+            'python':      platform.python_version(),
+            'parameters':  {'sites': args.sites, 'nodes': args.nodes,
+                            'years': args.years, 'repeat': args.repeat},
+        }
+        if not args.no_bmi:
+            results['bmi'] = _best([
+                time_bmi(workdir, cfg_filename, args.sites)
+                for i in range(args.repeat)])
+        if not args.no_binary:
+            results['binary'] = _best([
+                time_binary(workdir, cfg_filename,
+                            os.path.join(gipl_dir, 'gipl'),
+                            args.sites, args.years)
+                for i in range(args.repeat)])
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    for runner in ('bmi', 'binary'):
+        for phase, timing in sorted(results.get(runner, {}).items()):
+            if not timing:
+                continue
+            line = '{:8s} {:14s} {:9.3f} s'.format(runner, phase,
+                                                   timing['seconds'])
+            if 'steps_per_sec' in timing:
+                line += '  {:10.1f} steps/s  {:10.1f} site-years/s'.format(
+                    timing['steps_per_sec'], timing['site_years_per_sec'])
+            print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        if reference.get('parameters') != results['parameters']:
+            print('Warning: {} was run with {}'.format(
+                args.compare, reference.get('parameters')))
+        if not compare(results, reference, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
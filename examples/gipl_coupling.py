@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_coupling.py
+
+Step several GIPL servers (see gipl_server.py) from one asyncio driver, a
+timestep at a time, as a coupled model would.
+
+Run from the ./gipl/ directory, after "make f2py_gipl.so", e.g.:
+    python ../examples/gipl_coupling.py ../examples/gipl_config_3yr.cfg \\
+        --servers 4 --offset 0.5
+
+NOTES:
+    Server i runs the configuration with its air temperature raised by
+        i times --offset degrees.  The air temperature is given through
+        shared memory with GiplClient.set_forcing() after initialize().
+    Every timestep, all servers are advanced together with
+        asyncio.gather(), and the driver reads their soil temperatures
+        from shared memory.
+    Each server has a work directory of its own, with links to the input
+        files and its own output files (see gipl_step_control.py).
+    The report gives the time per coupling step, for all servers together,
+        and each server's mean temperature at the top and the bottom node
+        of the grid over the run.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+import numpy as np
+
+import gipl_step_control
+
+
+async def run_servers(cfg_filename, n_servers, offset, work_dir):
+    """ Run the coupled servers, return their soil temperatures and the
+    wall time of each coupling step """
+    import gipl_ensemble
+    import gipl_server
+
+    lines, files, n_time = gipl_ensemble.read_config(cfg_filename)
+    bound = np.loadtxt(files['bound'], skiprows=1, ndmin=2)
+
+    clients = []
+    for i_server in range(n_servers):
+        run_dir = os.path.join(work_dir, 'server_{}'.format(i_server))
+        gipl_step_control.make_run_dir(cfg_filename, run_dir)
+        clients.append(await gipl_server.start_server(
+            os.path.join(work_dir, 'server_{}.sock'.format(i_server)),
+            cwd=run_dir))
+
+    try:
+        for i_server, client in enumerate(clients):
+            await client.set_option('output_format', 'binary')
+            await client.initialize(gipl_ensemble._chunk_cfg_name)
+            await client.set_forcing('atmosphere_bottom_air__temperature',
+                                     bound[:, 0],
+                                     bound[:, 1:] + i_server * offset)
+
+        end_time = await clients[0].get_end_time()
+        time_step = await clients[0].get_time_step()
+        current_time = await clients[0].get_current_time()
+        temperatures = [[] for client in clients]
+        step_times = []
+        while current_time < end_time:
+            current_time += time_step
+            time_start = time.time()
+            await asyncio.gather(*[client.update_until(current_time)
+                                   for client in clients])
+            for i_server, client in enumerate(clients):
+                temperatures[i_server].append(
+                    await client.get_value('soil__temperature'))
+            step_times.append(time.time() - time_start)
+
+        for client in clients:
+            await client.finalize()
+    finally:
+        for client in clients:
+            await client.shutdown()
+
+    return np.array(temperatures), np.array(step_times)
+
+
+def print_report(temperatures, step_times, offset):
+    print('{} servers, {} coupling steps, {:.4f} s per step '
+          '(median {:.4f} s)'.format(temperatures.shape[0], len(step_times),
+                                     step_times.mean(),
+                                     np.median(step_times)))
+    print('  {:>6s} {:>8s} {:>10s} {:>10s}'.format(
+        'server', 'offset', 'T top', 'T bottom'))
+    for i_server, values in enumerate(temperatures):
+        # values is (step, site, depth)
+        print('  {:6d} {:8.2f} {:10.4f} {:10.4f}'.format(
+            i_server, i_server * offset, values[:, :, 0].mean(),
+            values[:, :, -1].mean()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Step several GIPL servers from one asyncio driver')
+    parser.add_argument('cfg_filename', nargs='?',
+                        default='../examples/gipl_config_3yr.cfg')
+    parser.add_argument('--servers', type=int, default=4)
+    parser.add_argument('--offset', type=float, default=0.5,
+                        help='air temperature step between servers, deg C')
+    parser.add_argument('--gipl-dir', default=os.getcwd(),
+                        help='directory with gipl_server.py')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.abspath(args.gipl_dir))
+
+    # Socket paths are short, so the work directory is under the temp dir
+    work_dir = tempfile.mkdtemp(prefix='gipl_coupling_')
+    try:
+        temperatures, step_times = asyncio.run(run_servers(
+            args.cfg_filename, args.servers, args.offset, work_dir))
+    finally:
+        shutil.rmtree(work_dir)
+    print_report(temperatures, step_times, args.offset)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_grid_report.py
+
+Compare a grid generated at initialize (the grid_stretch, grid_dz_min and
+grid_dz_front options, see generate_grid() in gipl.f90) with the grid of
+the configuration's grid file.
+
+Run from the ./gipl/ directory, after "make f2py_gipl.so", e.g.:
+    python ../examples/gipl_grid_report.py ../examples/gipl_config_3yr.cfg \\
+        --grid-stretch 1.3 --grid-dz-front 0.3
+
+NOTES:
+    Every configuration is run twice, with the grid file and with the
+        generated grid, each in a worker process and work directory of its
+        own (see gipl_step_control.py).
+    The generated grid keeps the depths of the output nodes (zdepth_id), so
+        the temperatures at those depths are compared at every timestep,
+        together with the depth of the deepest freezing front.
+    The solver time and the number of nodes show what the generated grid
+        saves.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+import gipl_step_control
+
+
+def run(cfg_filename, options):
+    """ Run a configuration with the given options, return its results
+
+    Only call this once per process: the Fortran module state is not
+    reset between runs.
+    """
+    import gipl_ensemble
+
+    run_dir = tempfile.mkdtemp(prefix='gipl_grid_')
+    cwd = os.getcwd()
+    try:
+        gipl_step_control.make_run_dir(cfg_filename, run_dir)
+        os.chdir(run_dir)
+
+        if gipl_ensemble._gipl_dir not in sys.path:
+            sys.path.insert(0, gipl_ensemble._gipl_dir)
+        import bmi_gipl
+
+        model = bmi_gipl.BmiGiplMethod()
+        model.set_option('output_format', 'binary')
+        model.set_option('profile', 1)
+        for name, value in options.items():
+            model.set_option(name, value)
+        model.initialize(gipl_ensemble._chunk_cfg_name)
+        n_nodes = len(model.get_grid_z(
+            model.get_var_grid('soil__temperature')))
+        depths = np.array(model.get_grid_z(
+            model.get_var_grid('soil__temperature__annual')))
+        recorded = model.update_until(
+            model.get_end_time(),
+            record=['soil__temperature__selected', 'freezing_front__depth'])
+        profile = model.get_profile()
+        model.finalize()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(run_dir)
+
+    return {
+        'n_nodes':      n_nodes,
+        'depths':       depths,
+        'temperature':  recorded['soil__temperature__selected'],
+        'front':        recorded['freezing_front__depth'],
+        'time_solver':  float(profile['time_solver']),
+    }
+
+
+def _run_star(args):
+    return run(*args)
+
+
+def compare(cfg_filenames, grid_options, processes=None):
+    """ Run every configuration with the grid file and the generated grid
+
+    Returns a dict from configuration file name to a dict of the two runs,
+    'file' and 'generated', see run().
+    """
+    import gipl_ensemble
+
+    tasks = []
+    for cfg_filename in cfg_filenames:
+        tasks.append((cfg_filename, {}))
+        tasks.append((cfg_filename, grid_options))
+
+    pool = gipl_ensemble._make_pool(processes)
+    try:
+        results = pool.map(_run_star, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    runs = {}
+    for i_cfg, cfg_filename in enumerate(cfg_filenames):
+        runs[cfg_filename] = dict(zip(('file', 'generated'),
+                                      results[2 * i_cfg:2 * i_cfg + 2]))
+    return runs
+
+
+def print_report(cfg_filename, runs):
+    reference = runs['file']
+    generated = runs['generated']
+    print(cfg_filename)
+    print('  {:10s} {:>6s} {:>10s}'.format('grid', 'nodes', 'solver s'))
+    for name in ('file', 'generated'):
+        print('  {:10s} {:6d} {:10.3f}'.format(
+            name, runs[name]['n_nodes'], runs[name]['time_solver']))
+
+    error = np.abs(generated['temperature'] - reference['temperature'])
+    print('  temperature difference at the output depths, max and mean:')
+    print('  {:>8s} {:>10s} {:>10s}'.format('depth m', 'max |dT|',
+                                            'mean |dT|'))
+    for i_node, depth in enumerate(reference['depths']):
+        print('  {:8.3f} {:10.4f} {:10.4f}'.format(
+            depth, error[..., i_node].max(), error[..., i_node].mean()))
+    front = np.abs(generated['front'] - reference['front'])
+    print('  freezing front depth difference, max {:.4f} m, mean {:.4f} m'
+          .format(front.max(), front.mean()))
+    print('')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare a generated grid with the grid file of GIPL')
+    parser.add_argument('cfg_filenames', nargs='*',
+                        default=['../examples/gipl_config_3yr.cfg'])
+    parser.add_argument('--grid-stretch', type=float, default=1.3)
+    parser.add_argument('--grid-dz-min', type=float, default=None)
+    parser.add_argument('--grid-dz-front', type=float, default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--gipl-dir', default=os.getcwd(),
+                        help='directory with f2py_gipl and bmi_gipl.py')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.abspath(args.gipl_dir))
+
+    grid_options = {'grid_stretch': args.grid_stretch}
+    if args.grid_dz_min is not None:
+        grid_options['grid_dz_min'] = args.grid_dz_min
+    if args.grid_dz_front is not None:
+        grid_options['grid_dz_front'] = args.grid_dz_front
+
+    runs = compare(args.cfg_filenames, grid_options,
+                   processes=args.processes)
+    for cfg_filename in args.cfg_filenames:
+        print_report(cfg_filename, runs[cfg_filename])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
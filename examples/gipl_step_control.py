@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_step_control.py
+
+Compare the sub-step control of stefan1D (step_control=0, sub-steps of at
+most TAUM) with the step doubling controller of stefan1D_adaptive
+(step_control=1) on sample configurations.
+
+Run from the ./gipl/ directory, after "make f2py_gipl.so", e.g.:
+    python ../examples/gipl_step_control.py ../examples/gipl_config_3yr.cfg \\
+        ../examples/gipl_config.cfg --step-tolerance 0.02 --taum 0.01
+
+NOTES:
+    Every configuration is run three times:
+        fixed:      step_control=0 with the configuration's TAUM, or --taum
+        adaptive:   step_control=1 with the same TAUM and --step-tolerance
+        reference:  step_control=0 with TAUM divided by --reference-factor
+    Each run has a work directory of its own, with links to the input files
+        and its own output files, and runs in a worker process of its own
+        (see gipl_ensemble.py).
+    The solver work is given as the number of Picard iterations, each one
+        a tridiagonal sweep over the grid, as counted with the 'profile'
+        option, together with the number of halved or rejected sub-steps
+        and the time spent in the solver.
+    The error of the fixed and adaptive runs is the largest and the mean
+        absolute difference of their soil temperatures, at every node and
+        timestep, from those of the reference run.
+    The iterations per timestep are also given by month of the year (by
+        timestep of the year), where the quiet months show how much the
+        adaptive sub-steps save.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+
+# Line number (0-based) of 'step | taum | tmin' in a configuration file
+_cfg_step_line = 18
+
+
+def make_run_dir(cfg_filename, run_dir, taum=None):
+    """ Create the work directory of a run of a configuration file
+
+    The input files are linked, the output files go to run_dir/output/ and
+    taum, if given, replaces the configuration's TAUM.
+    """
+    import gipl_ensemble
+
+    lines, files, n_time = gipl_ensemble.read_config(cfg_filename)
+    os.makedirs(os.path.join(run_dir, 'in'))
+    os.makedirs(os.path.join(run_dir, 'output'))
+
+    run_lines = list(lines)
+    for name, line_number in gipl_ensemble._cfg_input_lines.items():
+        os.symlink(os.path.abspath(files[name]),
+                   os.path.join(run_dir, gipl_ensemble._chunk_files[name]))
+        run_lines[line_number] = gipl_ensemble._chunk_files[name]
+    for name, line_number in gipl_ensemble._cfg_output_lines.items():
+        run_lines[line_number] = gipl_ensemble._chunk_files[name]
+    if taum is not None:
+        step = run_lines[_cfg_step_line].split()
+        step[1] = repr(taum)
+        run_lines[_cfg_step_line] = ' ' + '    '.join(step)
+    with open(os.path.join(run_dir, gipl_ensemble._chunk_cfg_name), 'w') as f:
+        f.write('\n'.join(run_lines) + '\n')
+
+    return float(run_lines[_cfg_step_line].split()[1])
+
+
+def run(cfg_filename, taum=None, step_control=0, step_tolerance=None):
+    """ Run a configuration, return its temperatures and solver counters
+
+    Only call this once per process: the Fortran module state is not
+    reset between runs.
+    """
+    import gipl_ensemble
+
+    run_dir = tempfile.mkdtemp(prefix='gipl_step_control_')
+    cwd = os.getcwd()
+    try:
+        taum = make_run_dir(cfg_filename, run_dir, taum=taum)
+        os.chdir(run_dir)
+
+        if gipl_ensemble._gipl_dir not in sys.path:
+            sys.path.insert(0, gipl_ensemble._gipl_dir)
+        import bmi_gipl
+
+        model = bmi_gipl.BmiGiplMethod()
+        model.set_option('output_format', 'binary')
+        model.set_option('profile', 1)
+        model.set_option('step_control', step_control)
+        if step_tolerance is not None:
+            model.set_option('step_tolerance', step_tolerance)
+        model.initialize(gipl_ensemble._chunk_cfg_name)
+        n_time = int(model.get_value('model_timesteps_per_year'))
+        temperatures = model.update_until(
+            model.get_end_time(), record=['soil__temperature'])
+        profile = model.get_profile()
+        model.finalize()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(run_dir)
+
+    n_steps = len(temperatures['soil__temperature'])
+    return {
+        'taum':         taum,
+        'n_time':       n_time,
+        'temperature':  temperatures['soil__temperature'],
+        'iterations':   profile['iterations'][:, :n_steps],
+        'halvings':     profile['halvings'][:, :n_steps],
+        'time_solver':  float(profile['time_solver']),
+    }
+
+
+def _run_star(args):
+    return run(*args)
+
+
+def compare(cfg_filenames, taum=None, step_tolerance=None,
+            reference_factor=10.0, processes=None):
+    """ Run the fixed, adaptive and reference runs of every configuration
+
+    Returns a dict from configuration file name to a dict of the three
+    runs, see run().
+    """
+    import gipl_ensemble
+
+    tasks = []
+    for cfg_filename in cfg_filenames:
+        if taum is None:
+            lines = gipl_ensemble.read_config(cfg_filename)[0]
+            cfg_taum = float(lines[_cfg_step_line].split()[1])
+        else:
+            cfg_taum = taum
+        tasks.append((cfg_filename, cfg_taum, 0, None))
+        tasks.append((cfg_filename, cfg_taum, 1, step_tolerance))
+        tasks.append((cfg_filename, cfg_taum / reference_factor, 0, None))
+
+    pool = gipl_ensemble._make_pool(processes)
+    try:
+        results = pool.map(_run_star, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    runs = {}
+    for i_cfg, cfg_filename in enumerate(cfg_filenames):
+        runs[cfg_filename] = dict(zip(('fixed', 'adaptive', 'reference'),
+                                      results[3 * i_cfg:3 * i_cfg + 3]))
+    return runs
+
+
+def print_report(cfg_filename, runs):
+    reference = runs['reference']['temperature']
+    print(cfg_filename)
+    print('  {:10s} {:>8s} {:>12s} {:>9s} {:>10s} {:>10s} {:>10s}'.format(
+        'run', 'taum', 'iterations', 'halvings', 'solver s', 'max |dT|',
+        'mean |dT|'))
+    for name in ('fixed', 'adaptive', 'reference'):
+        result = runs[name]
+        error = np.abs(result['temperature'] - reference)
+        print('  {:10s} {:8.4g} {:12d} {:9d} {:10.3f} {:10.4f} {:10.4f}'.format(
+            name, result['taum'], int(result['iterations'].sum()),
+            int(result['halvings'].sum()), result['time_solver'],
+            error.max(), error.mean()))
+
+    # Iterations per site and timestep, by timestep of the year
+    n_time = runs['fixed']['n_time']
+    print('  iterations per site and timestep, by timestep of the year:')
+    for name in ('fixed', 'adaptive'):
+        iterations = runs[name]['iterations']
+        n_years = iterations.shape[1] // n_time
+        by_step = iterations[:, :n_years * n_time].reshape(
+            (iterations.shape[0], n_years, n_time)).mean(axis=(0, 1))
+        print('  {:10s} '.format(name) +
+              ' '.join('{:6.1f}'.format(value) for value in by_step))
+    print('')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare the fixed and adaptive sub-steps of GIPL')
+    parser.add_argument('cfg_filenames', nargs='*',
+                        default=['../examples/gipl_config_3yr.cfg',
+                                 '../examples/gipl_config.cfg'])
+    parser.add_argument('--taum', type=float, default=None,
+                        help="TAUM of the fixed and adaptive runs "
+                             "(default: the configuration's)")
+    parser.add_argument('--step-tolerance', type=float, default=None,
+                        help='step_tolerance of the adaptive runs')
+    parser.add_argument('--reference-factor', type=float, default=10.0,
+                        help='TAUM of the reference runs is TAUM divided '
+                             'by this')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--gipl-dir', default=os.getcwd(),
+                        help='directory with f2py_gipl and bmi_gipl.py')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.abspath(args.gipl_dir))
+
+    runs = compare(args.cfg_filenames, taum=args.taum,
+                   step_tolerance=args.step_tolerance,
+                   reference_factor=args.reference_factor,
+                   processes=args.processes)
+    for cfg_filename in args.cfg_filenames:
+        print_report(cfg_filename, runs[cfg_filename])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,17 +7,27 @@ Python 2 code providing the BMI interface to GIPL
 See also example usage code in bmi_gipl_examples.py
 
 NOTES:
-    Regarding namespace independence:
-        Tested instantiating two different BmiGiplMethods at once.
-            If they use the same shared object library via 'import',
-            for instance both use f2py_gipl, then the namespaces of
-            the two Methods collide.
-        If two different shared object libraries are used, e.g. by
-            compiling the same code to f2py_gipl2.so, then the namespaces
-            are independent.
-        If two different python calls are made to the same shared object
-            library, then the two namespaces are independent: e.g. by
-            running make and creating a different .so file.
+    Regarding several serialized instances per process:
+        All model state lives in Fortran module variables.  Each
+            BmiGiplMethod creates its own model instance in f2py_gipl
+            (see gipl_state.f90) and selects it before every call into
+            the Fortran code, so several BmiGiplMethods can share one
+            shared object library.
+        The Fortran code is not reentrant, and only one instance is active
+            at a time.  Calls from different threads are serialized by a
+            lock shared by all BmiGiplMethods, so models driven from
+            several threads take turns and do not run in parallel.  Run
+            them in processes of their own for that, e.g. with
+            gipl_ensemble.py or gipl_server.py.
+        Arrays returned by get_value_ptr() stay attached to the instance
+            they came from, but scalars are copied in and out of the
+            module variables when instances are switched, so scalar
+            references are only valid while their instance is selected.
+        Each instance writes the output files named in its cfg file.  When
+            another instance already has a file open, e.g. when several
+            BmiGiplMethods are initialized from the same cfg file, '_2',
+            '_3', ... is added before the extension, so the second one
+            writes output/result_2.txt (see output_file_name in gipl.f90).
 
     Regarding direct access to Fortran variables from Python:
         Variables in Fortran modeles are accessible from Python
@@ -37,8 +47,6 @@ CONVENTIONS:
 
 
 TODO:
-    add BMI grid functions
-
     change Fortran code to use a single array of input values,
         e.g. don't overwrite with interpolated values if a value has already
             been specified, and  use setattr/getattr to pass arrays
@@ -53,6 +61,8 @@ TODO:
 from __future__ import print_function
 
 import sys
+import functools
+import threading
 import numpy as np
 import f2py_gipl
 
@@ -60,6 +70,23 @@ import f2py_gipl
 # Unset the default of printing numpy arrays in scientific notation
 np.set_printoptions(suppress=True)
 
+# Only one model instance in f2py_gipl can be active at a time, so all
+# calls into it, from any thread, are serialized
+_model_lock = threading.RLock()
+
+
+def _selects_instance(method):
+    """ Select the BmiGiplMethod's model instance around a method call """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._handle is None:
+            raise RuntimeError('{}() called on a finalized BmiGiplMethod'
+                               .format(method.__name__))
+        with _model_lock:
+            self._model.select_instance(self._handle)
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 def print_usage():
     print('Usage:')
@@ -79,6 +106,10 @@ class BmiGiplMethod(object):
         #   in the gipl_bmi module.
         self._fortran_module_ref = self._model.gipl_bmi
 
+        # Each BmiGiplMethod runs its own model instance
+        with _model_lock:
+            self._handle = self._model.new_instance()
+
         self._grids = {}
         self.ngrids = 0
 
@@ -127,6 +158,10 @@ class BmiGiplMethod(object):
                 'snow_thermal_conductivity',
             'soil__temperature':
                 'temp',
+            'soil__temperature__monthly':
+                'monthly_temperature',
+            'soil__temperature__annual':
+                'annual_temperature',
             'freeze_up__time__monthly':
                 'monthly_time',
             'freeze_up__temperature__monthly':
@@ -173,11 +208,13 @@ class BmiGiplMethod(object):
             'surface__snow_depth':                   'm',
             'surface__snow_thermal_conductivity':    'W m^-1 K^-1',
             'soil__temperature':                     'deg_c',
+            'soil__temperature__monthly':            'deg_c',
+            'soil__temperature__annual':             'deg_c',
             'freeze_up__time__monthly':              'years',
-            'freeze_up__temperature_monthly':        'deg C',
+            'freeze_up__temperature__monthly':       'deg C',
             'snow_level__monthly':                   'm',
             'freeze_up__time__annual':               'years',
-            'freeze_up__temperature_annual':         'deg C',
+            'freeze_up__temperature__annual':        'deg C',
             'snow_level__annual':                    'm',
             'freezing_front__depth':                 'm',
             'freeze_up__time_current':               'years',
@@ -201,13 +238,15 @@ class BmiGiplMethod(object):
             'surface__snow_thermal_conductivity':    'grid_float_everyts',
 
             'soil__temperature':                     'grid_float_site_z',
+            'soil__temperature__monthly':            'grid_float_site_month_zsel',
+            'soil__temperature__annual':             'grid_float_site_zsel',
 
             'freeze_up__time__monthly':              'grid_float_month_site',
-            'freeze_up__temperature_monthly':        'grid_float_month_site',
+            'freeze_up__temperature__monthly':       'grid_float_month_site',
             'snow_level__monthly':                   'grid_float_month_site',
 
             'freeze_up__time__annual':               'grid_float_site',
-            'freeze_up__temperature_annual':         'grid_float_site',
+            'freeze_up__temperature__annual':        'grid_float_site',
             'snow_level__annual':                    'grid_float_site',
 
             'freezing_front__depth':                 'grid_float_site',
@@ -234,8 +273,80 @@ class BmiGiplMethod(object):
             'grid_float_site_z':      3,
             'grid_float_everyts':     4,
             'grid_float_month_site':  5,
+            'grid_float_site_month_zsel':  6,
+            'grid_float_site_zsel':   7,
+        }
+
+        # Variables that update_until() can record after every step, with
+        #   their code in record_values() (gipl_bmi_methods.f90) and grid.
+        #   'soil__temperature__selected' is soil__temperature at the
+        #   zdepth_id depths of the output files, and the others are the
+        #   values of the step.
+        self._record_vars = {
+            'model_current__timestep':       (0, 1),
+            'soil__temperature':             (1, 3),
+            'soil__temperature__selected':   (2, 7),
+            'freeze_up__temperature':        (3, 2),
+            'snow_level':                    (4, 2),
+            'freezing_front__depth':         (5, 2),
+        }
+
+        # Options that can also be set in the &gipl_options namelist at the
+        #   end of the cfg file, and the Fortran module that holds each one
+        self._option_modules = {
+            'table_resolution':       'thermo',
+            'table_tolerance':        'thermo',
+            'table_t_min':            'thermo',
+            'output_format':          'bnd',
+            'profile':                'prof',
+            'input_cache':            'bnd',
+            'step_control':           'bnd',
+            'step_tolerance':         'bnd',
+            'grid_stretch':           'grd',
+            'grid_dz_min':            'grd',
+            'grid_dz_front':          'grd',
+            'monthly_output':         'bnd',
+            'reduction_file':         'bnd',
+            'site_dedup':             'bnd',
+            'dedup_tolerance':        'bnd',
+            'storage_precision':      'bnd',
+        }
+
+        # The kinds of reduction that add_reduction() accepts, and their
+        #   red_kind codes (see reduce_step in gipl.f90)
+        self._reduction_kinds = {
+            'mean':             1,
+            'max':              2,
+            'min':              3,
+            'crossing_time':    4,
+            'degree_sum':       5,
+            'percentile':       6,
+        }
+
+        # The reductions added so far, as (name, kind, threshold,
+        #   percentile, steps) tuples, see add_reduction()
+        self._reductions = []
+
+        # The Fortran modules whose arrays get_memory_usage() counts
+        self._memory_modules = ('gipl_bmi', 'bnd', 'thermo', 'grd', 'alt',
+                                'prof', 'red')
+
+        # The (layer, site) soil property arrays of thermo that
+        #   scale_parameters() accepts
+        self._site_parameters = ('vwc', 'a_coef', 'b_coef', 'hcap_frz',
+                                 'hcap_thw', 'tcon_frz', 'tcon_thw')
+
+        # Input variables that set_forcing() accepts, and the name of the
+        #   forcing input file each one replaces
+        self._forcing_names = {
+            'atmosphere_bottom_air__temperature':    'bound',
+            'surface__snow_depth':                   'snow',
+            'surface__snow_thermal_conductivity':    'rsnow',
         }
 
+        # Streamed forcing sources, see set_forcing_source()
+        self._forcing_sources = {}
+
         self._grid_types = {
             0:              'point',
             1:              'point',
@@ -243,15 +354,56 @@ class BmiGiplMethod(object):
             3:              'rectilinear',
             4:              'uniform_rectilinear',
             5:              'uniform_rectilinear',
+            6:              'rectilinear',
+            7:              'rectilinear',
         }
 
+        # The axes of each grid, in the order of the array dimensions
+        #   'site' (x) numbers the sites, 'month' (y) the timesteps of a
+        #   year and 'time' (y) holds the model times of every timestep.
+        #   'depth' (z) holds zdepth and 'depth_selected' (z) the depths
+        #   of the zdepth_id selection written to the output files.
+        self._grid_axes = {
+            0:      (),
+            1:      (),
+            2:      ('site',),
+            3:      ('site', 'depth'),
+            4:      ('time',),
+            5:      ('site', 'month'),
+            6:      ('site', 'month', 'depth_selected'),
+            7:      ('site', 'depth_selected'),
+        }
+        self._axis_coordinates = {
+            'x':    ('site',),
+            'y':    ('month', 'time'),
+            'z':    ('depth', 'depth_selected'),
+        }
 
+        # Grid and variable metadata, built on first use after initialize()
+        #   or load_state(), see _metadata()
+        self._grid_cache = None
+        self._var_cache = None
+
+
+    @_selects_instance
     def initialize(self, cfg_filename=None):
         if cfg_filename:
             self._model.initialize(cfg_filename)
         else:
             self._model.initialize(self.default_config_filename)
 
+        self._grid_cache = None
+        self._var_cache = None
+
+        # The first year's window of each streamed forcing
+        times_i = self._model.bnd.utemp_time_i
+        for var_name, source in self._forcing_sources.items():
+            self.set_forcing(var_name,
+                             *source.window(times_i[0], times_i[-1]))
+
+        if self._reductions:
+            self._push_reductions()
+
 
     def get_attribute(self, attribute_name):
         try:
@@ -276,72 +428,706 @@ class BmiGiplMethod(object):
         return self._var_units_map[long_var_name]
 
 
+    @_selects_instance
     def update(self):
         #Note: gipl's update function calls the write_output() routine too
+        if self._forcing_sources and self._steps_to_year_end() == 0:
+            self._push_forcing_windows()
         self._model.update()
 
 
-    def update_until(self, target_time):
-        self._model.update_until(target_time)
+    @_selects_instance
+    def update_until(self, target_time, record=None):
+        """ Advance the model to target_time
 
+        record is a list of names of variables to capture after every step
+        (see self._record_vars).  They are copied by the Fortran code into
+        one buffer allocated up front, and returned as a dict of
+        (n_steps, ...) views of it.  Without record, returns None.
+        """
+        if record is None:
+            advance = self._model.update_until
+            recorded = None
+        else:
+            buffer, recorded, codes = self._record_buffer(target_time, record)
+            done = [0]
+
+            def advance(until_time):
+                # The rows still to fill, as the (value, step) Fortran array
+                done[0] += self._model.update_until_record(
+                    until_time, codes, buffer[done[0]:].T)
+
+        if not self._forcing_sources:
+            advance(target_time)
+            return recorded
+
+        # Stop before each year end to give the next year's forcing window
+        model_vars = self._fortran_module_ref
+        while model_vars.time_loop < target_time:
+            steps = self._steps_to_year_end()
+            if steps > 0:
+                advance(min(
+                    target_time,
+                    model_vars.time_loop + steps * model_vars.time_step))
+            else:
+                self._push_forcing_windows()
+                advance(min(
+                    target_time,
+                    model_vars.time_loop + model_vars.time_step))
+        return recorded
+
+
+    def _record_buffer(self, target_time, record):
+        """ Allocate the buffer of update_until(target_time, record)
+
+        Returns the (n_steps, n_values) buffer, a dict of (n_steps, ...)
+        views of it for the names in record, and their record codes
+        """
+        # Unknown codes stop the process in record_values
+        if isinstance(record, str):
+            record = [record]
+        unknown = [name for name in record if name not in self._record_vars]
+        if unknown:
+            raise ValueError('Cannot record: {}, only: {}'.format(
+                ', '.join(unknown), ', '.join(sorted(self._record_vars))))
+        model_vars = self._fortran_module_ref
+        time_step = float(model_vars.time_step)
+        time_loop = float(model_vars.time_loop)
+        n_steps = 0
+        while time_loop < target_time:
+            time_loop += time_step
+            n_steps += 1
+
+        shapes = [self.get_grid_shape(self._record_vars[name][1])
+                  for name in record]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        buffer = np.empty((n_steps, sum(sizes)), dtype=np.float64)
+
+        # The values of each step are in Fortran order
+        recorded = {}
+        offset = 0
+        for name, shape, size in zip(record, shapes, sizes):
+            rank = len(shape)
+            recorded[name] = buffer[:, offset:offset + size].reshape(
+                (n_steps,) + shape[::-1]).transpose(
+                    (0,) + tuple(range(rank, 0, -1)))
+            offset += size
+        codes = np.array([self._record_vars[name][0] for name in record],
+                         dtype=np.int32)
+        return buffer, recorded, codes
+
+
+    def _forcing_arrays(self, var_name, times, values):
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            values = values.reshape((-1, 1))
+        if values.shape[0] != times.shape[0]:
+            raise ValueError(
+                '{} has {} times but {} records of values'.format(
+                    var_name, times.shape[0], values.shape[0]))
+        return self._forcing_names[var_name], times, values
+
+
+    @_selects_instance
+    def set_forcing(self, var_name, times, values):
+        """ Set a forcing series from arrays instead of from its input file
+
+        var_name is one of the input variable names.  times holds the times
+        of the n_rec forcing records, and values is (n_rec, n_site), or
+        (n_rec,) for a single site, as the columns of the forcing file.
+
+        Before initialize() the series is used and its file is not read.
+        After initialize() it replaces the current series, and the forcing
+        of the current year is interpolated again.
+        """
+        # f2py copies a C-ordered array to Fortran order in one pass
+        self._model.set_forcing(
+            *self._forcing_arrays(var_name, times, values))
+
+
+    @_selects_instance
+    def set_forcing_source(self, var_name, source):
+        """ Stream a forcing series from a source, a window at a time
+
+        source has a window(t_first, t_last) method returning the times and
+        (n_rec, n_site) values of the records around that time span, e.g.
+        the sources in gipl_forcing.py.  Before every year end, update() and
+        update_until() pass the Fortran code the window of the next year,
+        so only that window is held there.
+
+        Set before initialize(), the first record of the source is used
+        instead of the forcing file, and the first year's window is given
+        once the model is initialized.
+        """
+        self._forcing_sources[var_name] = source
+        times_i = self._model.bnd.utemp_time_i
+        if times_i is None:
+            # The first record sets the model's start time, time_restart
+            self.set_forcing(var_name, *source.window(-np.inf, -np.inf))
+        else:
+            self.set_forcing(var_name,
+                             *source.window(times_i[0], times_i[-1]))
+
+
+    def _steps_to_year_end(self):
+        """ Return the number of steps before the one that ends the year """
+        model_vars = self._fortran_module_ref
+        n_time = int(model_vars.n_time)
+        return n_time - 1 - int(model_vars.time_loop) % n_time
+
+
+    def _push_forcing_windows(self, t_first=None):
+        """ Give the streamed forcing that covers the next year, or the
+        year whose first interpolation time is t_first """
+        model_vars = self._fortran_module_ref
+        time_step = float(model_vars.time_step)
+        # The times interpolated at the year end (see update_model), with
+        #   a step to spare on either side
+        if t_first is None:
+            t_first = (float(model_vars.time_loop) + time_step +
+                       float(self._model.bnd.time_restart))
+        t_last = t_first + (int(model_vars.n_time) + 1) * time_step
+        for var_name, source in self._forcing_sources.items():
+            times, values = source.window(t_first - time_step,
+                                          t_last + time_step)
+            self._model.set_forcing_window(
+                *self._forcing_arrays(var_name, times, values))
+
+
+    @_selects_instance
+    def set_option(self, option_name, value):
+        """ Set one of the options of the &gipl_options namelist
+
+        Values given in the cfg file's namelist take priority over values
+        set before initialize()
+        """
+        module = getattr(self._model, self._option_modules[option_name])
+        setattr(module, option_name, value)
+        if option_name.startswith('table_'):
+            # Rebuild the property tables of an initialized model
+            self._model.build_property_tables()
+        elif option_name == 'profile':
+            # Start the counters of an initialized model from here
+            self._model.profile_start()
+        elif option_name == 'storage_precision':
+            # Keep the forcing series held so far in the new precision
+            self._model.convert_forcing()
+        # Any option can change how the sites evolve, so they are grouped
+        #   again at the next update (site_dedup, see group_sites)
+        self._model.bnd.sites_grouped = False
+
+
+    @_selects_instance
+    def get_option(self, option_name):
+        module = getattr(self._model, self._option_modules[option_name])
+        value = getattr(module, option_name)[()]
+        if isinstance(value, bytes):
+            # Fortran character variables come back blank-padded
+            value = value.decode('ascii').strip()
+        return value
+
+
+    @_selects_instance
+    def get_table_error(self):
+        """ Return the largest relative deviations of the property tables
+
+        The deviations from the closed forms of the unfrozen water content,
+        its derivative and the ground thermal conductivity, or None if the
+        tables are not in use
+        """
+        thermo = self._model.thermo
+        if thermo.n_tbl_sub[()] <= 0:
+            return None
+        return {
+            'unfrozen_water':         float(thermo.table_error_unf),
+            'unfrozen_water_slope':   float(thermo.table_error_dunf),
+            'thermal_conductivity':   float(thermo.table_error_tcon),
+        }
+
+
+    @_selects_instance
+    def add_reduction(self, name, kind, threshold=0.0, percentile=50.0,
+                      steps=None):
+        """ Add a yearly reduction of the temperatures at the zdepth_id depths
+
+        kind is one of 'mean', 'max', 'min', 'crossing_time' (the first time
+        of the year at which the temperature reached threshold from below),
+        'degree_sum' (the degrees above threshold summed over the timesteps
+        times the timestep, e.g. thawing degree-days) and 'percentile' (the
+        given percentile, 0 to 100, estimated as the year goes).  steps
+        holds the 1-based timesteps of the year that are taken, e.g.
+        [6, 7, 8] for a summer mean of a monthly run, by default all.
+
+        The reductions are updated after every step in the Fortran code,
+        per site and depth, see reduce_step() in gipl.f90.  After a year
+        ends, get_reductions() returns them, and with the reduction_file
+        option they are written to that file.  Adding a reduction to an
+        initialized model starts all reductions afresh from the current
+        timestep, so mid-year the year under way is only partly taken.
+        The percentile is the P-square estimate, which needs many timesteps
+        per year: with the 12 of a monthly run it is rough.
+        """
+        if kind not in self._reduction_kinds:
+            raise ValueError('Not a kind of reduction: {}'.format(kind))
+        if name in [reduction[0] for reduction in self._reductions]:
+            raise ValueError('A reduction is already named: {}'.format(name))
+        if not 0.0 <= percentile <= 100.0:
+            raise ValueError(
+                'percentile must be from 0 to 100, not {}'.format(percentile))
+        if steps is not None:
+            steps = [int(step) for step in steps]
+            if self._model.bnd.utemp_time_i is not None:
+                self._check_reduction_steps(name, steps)
+            elif not steps or min(steps) < 1:
+                raise ValueError(
+                    'The steps of reduction {} must be timesteps of the '
+                    'year, counted from 1: {}'.format(name, steps))
+        self._reductions.append((name, kind, float(threshold),
+                                 float(percentile), steps))
+        if self._model.bnd.utemp_time_i is not None:
+            self._push_reductions()
+
+
+    @_selects_instance
+    def clear_reductions(self):
+        """ Remove all reductions """
+        self._reductions = []
+        if self._model.bnd.utemp_time_i is not None:
+            self._push_reductions()
+
+
+    def _check_reduction_steps(self, name, steps):
+        """ Raise ValueError unless steps are timesteps of the model's year
+
+        The Fortran code stops the process on steps it cannot take
+        """
+        n_time = int(self._fortran_module_ref.n_time)
+        if not steps or min(steps) < 1 or max(steps) > n_time:
+            raise ValueError(
+                'The steps of reduction {} must be timesteps of the year, '
+                'from 1 to {}: {}'.format(name, n_time, steps))
+
+
+    def _push_reductions(self):
+        """ Give the Fortran code the reductions of self._reductions """
+        for name, kind, threshold, percentile, red_steps in self._reductions:
+            if red_steps is not None:
+                self._check_reduction_steps(name, red_steps)
+        n_time = int(self._fortran_module_ref.n_time)
+        n_red = len(self._reductions)
+        kinds = np.zeros(n_red, dtype=np.int32)
+        thresholds = np.zeros(n_red, dtype=np.float64)
+        fractions = np.zeros(n_red, dtype=np.float64)
+        steps = np.zeros((n_time, n_red), dtype=np.int32, order='F')
+        for i_red, (name, kind, threshold, percentile, red_steps) in \
+                enumerate(self._reductions):
+            kinds[i_red] = self._reduction_kinds[kind]
+            thresholds[i_red] = threshold
+            fractions[i_red] = percentile / 100.0
+            if red_steps is None:
+                steps[:, i_red] = 1
+            else:
+                steps[np.asarray(red_steps) - 1, i_red] = 1
+        self._model.set_reductions(kinds, thresholds, fractions, steps)
+
+
+    @_selects_instance
+    def get_reductions(self):
+        """ Return the reductions of the last complete year
+
+        Returns a dict from the name of each reduction to a (site, depth)
+        array, the depths being those of the zdepth_id selection.  Values
+        are -7777 before the first year is complete, and where a crossing
+        did not occur.
+        """
+        values = self._model.red.red_value
+        return dict((reduction[0], np.array(values[:, :, i_red]))
+                    for i_red, reduction in enumerate(self._reductions))
+
+
+    @_selects_instance
+    def get_site_groups(self):
+        """ Return the groups of sites solved together with site_dedup
+
+        Returns an array with, for each site, the 0-based number of the
+        site whose solution it takes, the site itself for the first site
+        of a group, or None before the first grouping.  The sites are
+        grouped at the first update after initialize and after every
+        change of their inputs, e.g. at each year start, and the array
+        holds the last grouping.
+        """
+        bnd = self._model.bnd
+        if bnd.n_groups[()] <= 0:
+            return None
+        return np.array(bnd.site_group) - 1
+
+
+    @_selects_instance
+    def scale_parameters(self, factors, layers=None):
+        """ Scale the soil properties of each site, before the first update
+
+        factors maps the names of the (layer, site) property arrays, 'vwc',
+        'a_coef', 'b_coef', 'hcap_frz', 'hcap_thw', 'tcon_frz' and
+        'tcon_thw', to one factor per site.  The factors apply to all soil
+        layers, or to the 1-based layer numbers in layers.  The freezing
+        points and property tables are then derived again.
+        """
+        thermo = self._model.thermo
+        if layers is None:
+            rows = slice(None)
+        else:
+            rows = np.asarray(layers) - 1
+        for name, site_factors in factors.items():
+            if name not in self._site_parameters:
+                raise ValueError('Not a soil property array: {}'.format(name))
+            values = getattr(thermo, name)
+            values[rows, :] *= np.asarray(site_factors, dtype=np.float64)
+        self._model.refresh_parameters()
+
+
+    @_selects_instance
+    def spin_up(self, year=1, tolerance=1.0e-3, max_cycles=100):
+        """ Repeat one year of forcing until the soil temperatures settle
+
+        Call this at the start of a year, e.g. right after initialize().
+        year counts the years of forcing from the model's start time,
+        starting at 1.  A site stops cycling once the largest change of its
+        annual mean temperature profile from one cycle to the next is below
+        tolerance, or after max_cycles.  The model is left at the same time
+        with the spun-up temperatures, and nothing is written to the output
+        files.
+
+        Returns a dict of per-site arrays: 'cycles' run, the last 'change'
+        of the annual mean profile and whether the site 'converged'.
+        """
+        model_vars = self._fortran_module_ref
+        n_time = int(model_vars.n_time)
+        time_step = float(model_vars.time_step)
+        # The Fortran code stops the process when it is not at a year start
+        if int(model_vars.time_loop) % n_time != 0:
+            raise ValueError(
+                'spin_up must be called at the start of a year, not at '
+                'timestep {}'.format(float(model_vars.time_loop)))
+        if self._forcing_sources:
+            self._push_forcing_windows(
+                float(self._model.bnd.time_restart) +
+                (year - 1) * n_time * time_step)
+
+        cycles, change = self._model.spin_up(year, tolerance, max_cycles,
+                                             int(model_vars.n_site))
+
+        if self._forcing_sources:
+            # Back to the window of the current year
+            self._push_forcing_windows(
+                float(self._model.bnd.utemp_time_i[0]))
+        return {
+            'cycles':     cycles,
+            'change':     change,
+            'converged':  change < tolerance,
+        }
+
+
+    @_selects_instance
+    def save_state(self, filename):
+        """ Write the complete model state to a binary snapshot file
+
+        Besides the soil temperatures this holds the forcing and its
+        interpolation, the time counters and the monthly, annual and
+        freezing front accumulators, so that a model given the snapshot
+        with load_state() continues exactly as this one would.
+        """
+        self._model.save_state(filename)
+
+
+    @_selects_instance
+    def load_state(self, filename):
+        """ Replace the model state with a snapshot from save_state()
+
+        Call this after initialize(): the model keeps the output files it
+        was initialized with, and continues writing to them from the time
+        of the snapshot.  Forcing sources given to set_forcing_source() are
+        asked for windows from that time on.  The snapshot must have the
+        model's numbers of sites, grid levels, output depths and timesteps
+        per year; otherwise, or when the file is not a snapshot, ValueError
+        is raised and the model state is left as it was.
+        """
+        ierr = self._model.load_state(filename)
+        if ierr == 1:
+            raise IOError('Cannot open snapshot file: {}'.format(filename))
+        elif ierr == 2:
+            raise ValueError('Not a GIPL snapshot file: {}'.format(filename))
+        elif ierr == 3:
+            raise ValueError('load_state() needs an initialized model')
+        elif ierr == 4:
+            raise ValueError(
+                'Snapshot {} does not match the model\'s numbers of sites, '
+                'grid levels, output depths and timesteps per year'.format(
+                    filename))
+        self._grid_cache = None
+        self._var_cache = None
+
+
+    @_selects_instance
+    def get_profile(self):
+        """ Return the solver counters and phase timers, or None
+
+        The counters are (site, timestep) arrays: 'iterations' (Picard
+        sweeps), 'halvings' (of the sub-step), 'min_timei' (the shortest
+        sub-step) and 'solver_time' (seconds).  Timesteps not run yet hold
+        zeros.  The phase timers are the total seconds spent in the solver, in active_layer,
+        in interpolating the forcing and in output.
+        Needs the 'profile' option to be set.
+        """
+        prof = self._model.prof
+        if prof.prof_iterations is None:
+            return None
+        return {
+            'iterations':         np.array(prof.prof_iterations),
+            'halvings':           np.array(prof.prof_halvings),
+            'min_timei':          np.array(prof.prof_min_timei),
+            'solver_time':        np.array(prof.prof_solver_time),
+            'time_solver':        float(prof.prof_time_solver),
+            'time_active_layer':  float(prof.prof_time_active_layer),
+            'time_interpolation': float(prof.prof_time_interpolation),
+            'time_output':        float(prof.prof_time_output),
+        }
 
+
+    def write_profile_report(self, filename=None, n_top=10):
+        """ Write a summary of get_profile() to a file, or to stdout
+
+        Lists the time spent in each phase, the n_top sites with the most
+        solver time and the n_top timesteps with the most step halvings
+        """
+        profile = self.get_profile()
+        if profile is None:
+            raise ValueError("Set the 'profile' option to collect a profile")
+
+        lines = ['Phase               seconds']
+        for phase in ('solver', 'active_layer', 'interpolation', 'output'):
+            lines.append('{:16s} {:10.4f}'.format(
+                phase, profile['time_' + phase]))
+
+        iterations = profile['iterations']
+        halvings = profile['halvings']
+        site_time = profile['solver_time'].sum(axis=1)
+        lines.append('')
+        lines.append('Site  solver_seconds  iterations  halvings  min_timei')
+        for i_site in np.argsort(site_time)[::-1][:n_top]:
+            steps = iterations[i_site] > 0
+            min_timei = (profile['min_timei'][i_site][steps].min()
+                         if steps.any() else 0.0)
+            lines.append('{:4d} {:15.4f} {:11d} {:9d} {:10.4g}'.format(
+                i_site + 1, site_time[i_site], int(iterations[i_site].sum()),
+                int(halvings[i_site].sum()), min_timei))
+
+        step_halvings = halvings.sum(axis=0)
+        lines.append('')
+        lines.append('Step  halvings  iterations')
+        for i_step in np.argsort(step_halvings)[::-1][:n_top]:
+            if step_halvings[i_step] == 0:
+                break
+            lines.append('{:4d} {:9d} {:11d}'.format(
+                i_step + 1, int(step_halvings[i_step]),
+                int(iterations[:, i_step].sum())))
+
+        report = '\n'.join(lines) + '\n'
+        if filename is None:
+            sys.stdout.write(report)
+        else:
+            with open(filename, 'w') as report_file:
+                report_file.write(report)
+
+
+    @_selects_instance
+    def get_memory_usage(self):
+        """ Return the bytes held by each allocated array of the model
+
+        Returns a dict from 'module.variable' (e.g. 'bnd.utemp') to the
+        size in bytes of that Fortran array, for the arrays that are
+        allocated.  With many sites and a long run, the forcing series
+        (bnd.utemp, bnd.snd and bnd.stcon) are usually the largest, and the
+        storage_precision option halves them.
+        """
+        usage = {}
+        for module_name in self._memory_modules:
+            module = getattr(self._model, module_name)
+            # f2py lists a module's variables, one per line, in its doc
+            for line in module.__doc__.splitlines():
+                fields = line.split(' : ')
+                if len(fields) != 2 or '-array(' not in fields[1]:
+                    continue
+                values = getattr(module, fields[0])
+                if values is not None:
+                    usage[module_name + '.' + fields[0]] = values.nbytes
+        return usage
+
+
+    def write_memory_report(self, filename=None, n_top=20):
+        """ Write the n_top largest arrays of get_memory_usage() and the
+        total to a file, or to stdout """
+        usage = self.get_memory_usage()
+        lines = ['{:32s} {:>9s} {:>6s}'.format('Array', 'MiB', 'share')]
+        total = float(sum(usage.values()))
+        for name in sorted(usage, key=usage.get, reverse=True)[:n_top]:
+            lines.append('{:32s} {:9.2f} {:6.1%}'.format(
+                name, usage[name] / 2.0**20, usage[name] / max(total, 1.0)))
+        lines.append('{:32s} {:9.2f}'.format('total', total / 2.0**20))
+
+        report = '\n'.join(lines) + '\n'
+        if filename is None:
+            sys.stdout.write(report)
+        else:
+            with open(filename, 'w') as report_file:
+                report_file.write(report)
+
+
+    def set_num_threads(self, n_threads):
+        """ Set the number of threads used for the site loops
+
+        Only has an effect if f2py_gipl was built with 'make f2py_gipl_omp.so'
+        and is imported from build_omp/
+        """
+        if n_threads < 1:
+            raise ValueError(
+                'n_threads must be at least 1, not {}'.format(n_threads))
+        with _model_lock:
+            self._model.set_num_threads(n_threads)
+
+
+    @_selects_instance
     def finalize(self):
         self._model.finalize()
+        self._model.free_instance(self._handle)
+        self._handle = None
 
 
     def get_start_time(self):
         return 0.0
 
 
+    @_selects_instance
     def get_end_time(self):
         #return self.get_value('model_last__timestep')
         return self._model.get_end_time()
 
 
+    @_selects_instance
     def get_time_step(self):
         #return self.get_value('model__timestep')
         return self._model.get_time_step()
 
 
+    @_selects_instance
     def get_current_time(self):
         return self.get_value('model_current__timestep')
 
 
-    def get_value_ref(self, var_name):
+    @_selects_instance
+    def get_value_ptr(self, var_name):
+        """ Return a writable numpy view of a model variable
+
+        Arrays are the Fortran arrays themselves, in Fortran order, and
+        stay valid until the model is finalized or the variable is
+        reallocated.  Scalars are 0-d views of the module variables, which
+        are only valid while this instance is selected (see NOTES).
+        """
         return getattr(self._fortran_module_ref,
                        self._var_name_map[var_name])
 
 
-    def get_value(self, var_name):
-        #return self.get_value_ref(var_name).copy()
+    def get_value_ref(self, var_name):
+        return self.get_value_ptr(var_name)
+
 
-        #thevalue = None
-        #self._model.get_value(var_name, thevalue)
-        #return thevalue
+    @_selects_instance
+    def get_value(self, var_name, dest=None):
+        """ Return a copy of a model variable
 
-        return self._model.get_value(var_name)
+        If dest is given, the values are copied into it, without allocating
+        a new array, and dest is returned.  dest must have the variable's
+        shape, in either C or Fortran order.
+        """
+        ref = self.get_value_ptr(var_name)
+        if dest is not None:
+            np.copyto(dest, ref)
+            return dest
+        if ref.ndim == 0:
+            return ref[()]
+        return ref.copy(order='K')
 
 
+    @_selects_instance
     def set_value(self, var_name, src):
         setattr(self._fortran_module_ref,
                 self._var_name_map[var_name],
                 src)
 
 
+    @_selects_instance
     def get_value_at_indices(self, var_name, indices):
         return self.get_value_ref(var_name).take(indices)
 
 
+    @_selects_instance
     def set_value_at_indices(self, var_name, indices, new_var_values):
         self.get_value_ref(var_name).flat[indices] = new_var_values
 
 
+    @_selects_instance
+    def _build_metadata(self):
+        """ Build the coordinates of every grid axis and the element type
+        of every variable from the model's dimensions """
+        model_vars = self._fortran_module_ref
+        n_time = int(model_vars.n_time)
+        zdepth = np.array(self._model.grd.zdepth)
+        coordinates = {
+            'site':             np.arange(1, int(model_vars.n_site) + 1,
+                                          dtype=np.float64),
+            'month':            np.arange(1, n_time + 1, dtype=np.float64),
+            'time':             (float(model_vars.time_s) +
+                                 float(model_vars.time_step) *
+                                 np.arange(int(model_vars.n_total_timesteps))),
+            'depth':            zdepth,
+            'depth_selected':   zdepth[np.array(self._model.grd.zdepth_id) - 1],
+        }
+        grid_cache = {}
+        for grid_id, axes in self._grid_axes.items():
+            shape = tuple(len(coordinates[axis]) for axis in axes)
+            grid_cache[grid_id] = {
+                'axes':         dict(zip(axes, [coordinates[axis]
+                                                for axis in axes])),
+                'shape':        shape,
+                'size':         int(np.prod(shape)),
+            }
+
+        var_cache = {}
+        for var_name, grid_name in self._var_grid_map.items():
+            dtype = np.asarray(self.get_value_ptr(var_name)).dtype
+            size = grid_cache[self._grid_numbers[grid_name]]['size']
+            var_cache[var_name] = {
+                'type':         str(dtype),
+                'itemsize':     dtype.itemsize,
+                'nbytes':       dtype.itemsize * size,
+            }
+        self._grid_cache = grid_cache
+        self._var_cache = var_cache
+
+
+    def _metadata(self):
+        """ Return the grid and variable metadata, building it if needed """
+        if self._grid_cache is None:
+            self._build_metadata()
+        return self._grid_cache, self._var_cache
+
+
     def get_var_type(self, var_name):
-        return str(self.get_value_ref(var_name).dtype)
+        return self._metadata()[1][var_name]['type']
 
 
     def get_var_nbytes(self, var_name):
-        return np.asarray(self.get_value_ref(var_name)).nbytes
+        return self._metadata()[1][var_name]['nbytes']
 
 
     def get_component_name(self):
@@ -349,7 +1135,7 @@ class BmiGiplMethod(object):
 
 
     def get_var_itemsize(self, var_name):
-        return np.asarray(self.get_value_ref(var_name)).flatten()[0].nbytes
+        return self._metadata()[1][var_name]['itemsize']
 
 
     def get_var_grid(self, var_name):
@@ -362,25 +1148,61 @@ class BmiGiplMethod(object):
 
 
     def get_grid_shape(self, grid_id):
-        """ find a variable with this grid id, and return its shape """
-        for var in self._var_grid_map.keys():
-            if self._grid_numbers[self._var_grid_map[var]] == grid_id:
-                return self.get_value_ref(var).shape
+        return self._metadata()[0][grid_id]['shape']
 
 
     def get_grid_rank(self, grid_id):
-        """ find a variable with this grid id, and return its shape """
-        for var in self._var_grid_map.keys():
-            if self._grid_numbers[self._var_grid_map[var]] == grid_id:
-                return self.get_value_ref(var).ndim
+        return len(self._grid_axes[grid_id])
 
 
     def get_grid_size(self, grid_id):
-        grid_size = self.get_grid_shape(grid_id)
-        if grid_size == ():
-            return 1
-        else:
-            return int(np.prod(grid_size))
+        return self._metadata()[0][grid_id]['size']
+
+
+    def _get_grid_coordinate(self, grid_id, coordinate):
+        axes = self._metadata()[0][grid_id]['axes']
+        for axis in self._axis_coordinates[coordinate]:
+            if axis in axes:
+                return axes[axis]
+        raise ValueError('Grid {} has no {} coordinate'.format(grid_id,
+                                                             coordinate))
+
+
+    def get_grid_x(self, grid_id):
+        """ Return the site numbers of a grid """
+        return self._get_grid_coordinate(grid_id, 'x')
+
+
+    def get_grid_y(self, grid_id):
+        """ Return the timesteps within a year, or the model times, of a grid
+        """
+        return self._get_grid_coordinate(grid_id, 'y')
+
+
+    def get_grid_z(self, grid_id):
+        """ Return the depths of a grid: zdepth, or its selection zdepth_id """
+        return self._get_grid_coordinate(grid_id, 'z')
+
+
+    def _check_uniform(self, grid_id):
+        if self._grid_types[grid_id] != 'uniform_rectilinear':
+            raise ValueError('Grid {} is not uniform'.format(grid_id))
+        axes = self._metadata()[0][grid_id]['axes']
+        return [axes[axis] for axis in self._grid_axes[grid_id]]
+
+
+    def get_grid_spacing(self, grid_id):
+        """ Return the spacing of a uniform grid along each dimension """
+        return np.array([coordinates[1] - coordinates[0]
+                         if len(coordinates) > 1 else 0.0
+                         for coordinates in self._check_uniform(grid_id)])
+
+
+    def get_grid_origin(self, grid_id):
+        """ Return the first coordinate of a uniform grid in each dimension
+        """
+        return np.array([coordinates[0]
+                         for coordinates in self._check_uniform(grid_id)])
 
 
 if __name__ == '__main__':
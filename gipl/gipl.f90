@@ -19,18 +19,83 @@ subroutine update_model()
   use thermo
   use grd
   use alt
+  use prof
+  use red
 
   implicit none
 
   integer :: i_site,j_time
+  logical :: dedup
+  real*8 :: t_phase
+  real*8 :: wall_seconds
+
+  ! Sites are independent within a timestep, so the site loops below can
+  ! be run in parallel when compiled with OpenMP (make gipl_omp)
+  if (profile .gt. 0) t_phase = wall_seconds()
+  if (step_control .gt. 0) call step_control_start()
+
+  ! With site_dedup, a site whose group was formed from the same inputs
+  ! takes the solution of the first site of its group, as long as it still
+  ! starts the timestep from the same temperatures and sub-step
+  dedup = site_dedup .gt. 0
+  if (dedup) then
+    if (.not. sites_grouped) call group_sites()
+    !$omp parallel do
+    do i_site=1,n_site
+      site_solved(i_site) = site_group(i_site) .eq. i_site
+      if (.not. site_solved(i_site)) then
+        site_solved(i_site) = &
+          any(temp(i_site,:) .ne. temp(site_group(i_site),:))
+        if (step_control .gt. 0) site_solved(i_site) = site_solved(i_site) &
+          .or. timei_site(i_site) .ne. timei_site(site_group(i_site))
+      endif
+    enddo
+    !$omp end parallel do
+  endif
 
-  do i_site=1,n_site
-    call stefan1D(temp(i_site,:),dz,i_site,lay_id(i_site,:), &
-      temp_grd(i_site), n_grd)
-  enddo
+  if (step_control .gt. 0) then
+    ! Advance each site with its own sub-steps (see stefan1D_adaptive)
+    !$omp parallel do schedule(dynamic)
+    do i_site=1,n_site
+      if (dedup) then
+        if (.not. site_solved(i_site)) cycle
+      endif
+      call stefan1D_adaptive(temp(i_site,:),dz,i_site,lay_id(i_site,:), &
+        temp_grd(i_site), n_grd)
+    enddo
+    !$omp end parallel do
+  else
+    !$omp parallel do schedule(dynamic)
+    do i_site=1,n_site
+      if (dedup) then
+        if (.not. site_solved(i_site)) cycle
+      endif
+      call stefan1D(temp(i_site,:),dz,i_site,lay_id(i_site,:), &
+        temp_grd(i_site), n_grd)
+    enddo
+    !$omp end parallel do
+  endif
+
+  if (dedup) then
+    ! Hand the solutions out to the rest of each group
+    !$omp parallel do
+    do i_site=1,n_site
+      if (site_solved(i_site)) cycle
+      temp(i_site,:) = temp(site_group(i_site),:)
+      if (step_control .gt. 0) then
+        timei_site(i_site) = timei_site(site_group(i_site))
+      endif
+    enddo
+    !$omp end parallel do
+  endif
+  if (profile .gt. 0) then
+    prof_time_solver = prof_time_solver + wall_seconds() - t_phase
+    t_phase = wall_seconds()
+  endif
 
   time_loop=time_loop+time_step
 
+  !$omp parallel do
   do i_site=1,n_site
     if (mod(int(time_loop), n_time) .eq. 0) then
       i_time(i_site) = 1
@@ -38,8 +103,13 @@ subroutine update_model()
       i_time(i_site) = i_time(i_site)+1
     endif
     call save_results(i_site,time_loop, time_restart)
+    if (n_red .gt. 0) call reduce_step(i_site, time_loop + time_restart)
     call active_layer(i_site)
   enddo
+  !$omp end parallel do
+  if (profile .gt. 0) then
+    prof_time_active_layer = prof_time_active_layer + wall_seconds() - t_phase
+  endif
 
   if (mod(int(time_loop), n_time) .eq. 0) then
     ! Perform year-end operations
@@ -48,21 +118,19 @@ subroutine update_model()
     ! This means that there isn't a clear set-the-value-at-this-time
     ! operation without computing how to index such a time
 
-    do i_site=1,n_site
-      i_time(i_site) = 1
-
-      do j_time=1,n_time+2
-        utemp_time_i(j_time)= &
-          time_loop + time_restart + DBLE(j_time - 1) * time_step
-      enddo
-      call interpolate(utemp_time,utemp(:,i_site),n_temp,utemp_time_i,&
-              utemp_i(:,i_site),n_time+2)
-      call interpolate(snd_time,snd(:,i_site),n_snow,utemp_time_i,&
-              snd_i(:,i_site),n_time+2)
-      call snowfix(utemp_i(:,i_site),snd_i(:,i_site),n_time+2)
-      call interpolate(stcon_time,stcon(:,i_site),n_stcon,utemp_time_i,&
-              stcon_i(:,i_site),n_time+2)
+    ! The interpolation times are the same for every site
+    do j_time=1,n_time+2
+      utemp_time_i(j_time)= &
+        time_loop + time_restart + DBLE(j_time - 1) * time_step
     enddo
+
+    i_time = 1
+    if (profile .gt. 0) t_phase = wall_seconds()
+    call interpolate_forcing()
+    if (profile .gt. 0) then
+      prof_time_interpolation = prof_time_interpolation + &
+        wall_seconds() - t_phase
+    endif
   endif
 
   if (mod(int(time_loop), n_time) .eq. 0) then
@@ -72,27 +140,339 @@ subroutine update_model()
 end subroutine update_model
 
 
-subroutine write_output()
+subroutine group_sites()
+  ! Group the sites that have the same soil properties, layers, lower
+  ! boundary flux, temperatures and forcing of the current year
+  ! (site_dedup=1)
+  !
+  ! The sites of a group evolve alike, so update_model solves only the
+  ! first site of each group, and the others take its temperatures (and
+  ! its sub-step with step_control=1).  Every site keeps its own forcing
+  ! arrays and results, so the output and the BMI values are those of the
+  ! sites solved one by one.  With dedup_tolerance greater than 0, a site
+  ! also joins a group when its forcing differs by at most dedup_tolerance
+  ! from that of the group's first site, whose forcing it is solved with.
+  !
+  ! Each site's values are hashed, and the sites are entered in an open
+  ! addressing hash table, where sites with the same hash are compared
+  ! value by value.  With dedup_tolerance, the hash takes the yearly means
+  ! of the forcing rounded to multiples of ten times dedup_tolerance, so
+  ! close forcing usually, but not always, meets in the same slot.
+  !
+  ! sites_grouped is cleared whenever the forcing or the soil properties
+  ! change (interpolate_forcing, refresh_parameters, load_state and
+  ! set_option), and update_model then groups the sites again.
   use gipl_bmi
+  use bnd
+  use thermo
   use grd
+
+  implicit none
+
+  integer :: i_site,n_slot,i_slot
+  integer*8 :: hash(n_site)
+  integer, allocatable :: slot_site(:)
+
+  if (allocated(site_group)) deallocate(site_group)
+  if (allocated(site_solved)) deallocate(site_solved)
+  allocate(site_group(n_site),site_solved(n_site))
+
+  !$omp parallel do
+  do i_site=1,n_site
+    hash(i_site)=site_hash(i_site)
+  enddo
+  !$omp end parallel do
+
+  n_slot=1
+  do while (n_slot.LT.2*n_site)
+    n_slot=2*n_slot
+  enddo
+  allocate(slot_site(0:n_slot-1))
+  slot_site=0
+  n_groups=0
+  do i_site=1,n_site
+    i_slot=int(iand(hash(i_site),int(n_slot-1,8)))
+    do
+      if (slot_site(i_slot).EQ.0) then
+        slot_site(i_slot)=i_site
+        site_group(i_site)=i_site
+        n_groups=n_groups+1
+        exit
+      elseif (hash(slot_site(i_slot)).EQ.hash(i_site)) then
+        if (same_site(slot_site(i_slot),i_site)) then
+          site_group(i_site)=slot_site(i_slot)
+          exit
+        endif
+      endif
+      i_slot=iand(i_slot+1,n_slot-1)
+    enddo
+  enddo
+  deallocate(slot_site)
+  site_solved=.true.
+  sites_grouped=.true.
+
+contains
+
+  logical function same_forcing(x1, x2)
+    real*8, intent(in) :: x1(n_time+2), x2(n_time+2)
+    if (dedup_tolerance.GT.0.D0) then
+      same_forcing=all(abs(x1-x2).LE.dedup_tolerance)
+    else
+      same_forcing=all(x1.EQ.x2)
+    endif
+  end function same_forcing
+
+  subroutine mix_forcing(h, x)
+    integer*8, intent(inout) :: h
+    real*8, intent(in) :: x(n_time+2)
+    integer :: j_time
+    if (dedup_tolerance.GT.0.D0) then
+      call mix(h,anint(sum(x)/dble(n_time+2)/(10.D0*dedup_tolerance)))
+    else
+      do j_time=1,n_time+2
+        call mix(h,x(j_time))
+      enddo
+    endif
+  end subroutine mix_forcing
+
+  subroutine mix(h, x)
+    ! Mix the bits of x into h, with shifts only, so nothing overflows
+    integer*8, intent(inout) :: h
+    real*8, intent(in) :: x
+    h=ieor(ishftc(h,7),transfer(x,h))
+  end subroutine mix
+
+  integer*8 function site_hash(k)
+    integer, intent(in) :: k
+    integer :: i_lay,i_grd
+
+    site_hash=int(n_lay_cur(k),8)
+    do i_lay=1,n_lay_cur(k)
+      call mix(site_hash,vwc(i_lay,k))
+      call mix(site_hash,a_coef(i_lay,k))
+      call mix(site_hash,b_coef(i_lay,k))
+      call mix(site_hash,hcap_frz(i_lay,k))
+      call mix(site_hash,tcon_frz(i_lay,k))
+    enddo
+    call mix(site_hash,temp_grd(k))
+    do i_grd=1,n_grd
+      call mix(site_hash,temp(k,i_grd))
+      call mix(site_hash,dble(lay_id(k,i_grd)))
+    enddo
+    call mix_forcing(site_hash,utemp_i(:,k))
+    call mix_forcing(site_hash,snd_i(:,k))
+    call mix_forcing(site_hash,stcon_i(:,k))
+    ! Fold the high bits into the low bits, which pick the slot
+    site_hash=ieor(site_hash,ishft(site_hash,-32))
+    site_hash=ieor(site_hash,ishft(site_hash,-16))
+  end function site_hash
+
+  logical function same_site(k1, k2)
+    ! Whether sites k1 and k2 evolve alike: everything stefan1D reads of a
+    ! site is compared
+    integer, intent(in) :: k1, k2
+    integer :: i_lay
+
+    same_site=.false.
+    if (n_lay_cur(k1).NE.n_lay_cur(k2)) return
+    do i_lay=1,n_lay_cur(k1)
+      if (vwc(i_lay,k1).NE.vwc(i_lay,k2) .or. &
+          a_coef(i_lay,k1).NE.a_coef(i_lay,k2) .or. &
+          b_coef(i_lay,k1).NE.b_coef(i_lay,k2) .or. &
+          temp_frz(i_lay,k1).NE.temp_frz(i_lay,k2) .or. &
+          EE(i_lay,k1).NE.EE(i_lay,k2) .or. &
+          hcap_frz(i_lay,k1).NE.hcap_frz(i_lay,k2) .or. &
+          hcap_thw(i_lay,k1).NE.hcap_thw(i_lay,k2) .or. &
+          tcon_frz(i_lay,k1).NE.tcon_frz(i_lay,k2) .or. &
+          tcon_thw(i_lay,k1).NE.tcon_thw(i_lay,k2)) return
+      if (n_tbl_sub.GT.0) then
+        if (tbl_set(i_lay,k1).NE.tbl_set(i_lay,k2)) return
+      endif
+    enddo
+    if (temp_grd(k1).NE.temp_grd(k2)) return
+    if (any(temp(k1,:).NE.temp(k2,:))) return
+    if (any(lay_id(k1,:).NE.lay_id(k2,:))) return
+    if (step_control.GT.0 .and. allocated(timei_site)) then
+      if (timei_site(k1).NE.timei_site(k2)) return
+    endif
+    same_site=same_forcing(utemp_i(:,k1),utemp_i(:,k2)) .and. &
+      same_forcing(snd_i(:,k1),snd_i(:,k2)) .and. &
+      same_forcing(stcon_i(:,k1),stcon_i(:,k2))
+  end function same_site
+
+end subroutine group_sites
+
+subroutine spin_up(year, tolerance, max_cycles, cycles, change, n_sites)
+  ! Repeat the forcing of one year until the soil temperatures of every
+  ! site reach equilibrium, starting from the current year start
+  !
+  ! year counts the years of forcing from time_restart, starting at 1.
+  ! After each cycle the annual mean temperature profile of a site is
+  ! compared with that of the cycle before, and a site whose largest
+  ! change is below tolerance is not advanced any further.  Sites stop
+  ! after max_cycles in any case.  cycles returns the cycles run for each
+  ! site and change its last change of the annual mean profile.
+  !
+  ! The model time is left at the year start, with temp holding the
+  ! spun-up temperatures, so the run continues from there.  Nothing is
+  ! written to the output files.
+  use gipl_bmi
+  use bnd
   use thermo
+  use grd
   use alt
-  use bnd
 
   implicit none
 
-  integer :: i_site, j_time, i_grd
+  integer, intent(in) :: year, max_cycles, n_sites
+  real*8, intent(in) :: tolerance
+  integer, intent(out) :: cycles(n_sites)
+  real*8, intent(out) :: change(n_sites)
+
+  integer :: i_site, j_time, i_cycle, k, n_active
+  integer :: active(n_site)
+  integer :: cursors(3)
+  real*8 :: time_start
+  real*8 :: times_i(n_time+2)
+  real*8 :: utemp_year(n_time+2,n_site), snd_year(n_time+2,n_site)
+  real*8 :: stcon_year(n_time+2,n_site)
+  real*8 :: mean_new(n_site,n_grd), mean_old(n_site,n_grd)
+
+  if (n_sites .ne. n_site) then
+    print*, 'spin_up was given ', n_sites, ' sites, but the model has ', n_site
+    stop
+  endif
+  if (mod(int(time_loop), n_time) .ne. 0) then
+    print*, 'spin_up must start at the start of a year, not at ', time_loop
+    stop
+  endif
+
+  ! Keep the forcing of the current year to put back at the end
+  time_start = time_loop
+  times_i = utemp_time_i
+  utemp_year = utemp_i
+  snd_year = snd_i
+  stcon_year = stcon_i
+  cursors = (/ utemp_cursor, snd_cursor, stcon_cursor /)
+
+  ! Interpolate the forcing of the chosen year, then shift its times to the
+  ! current year, which is where futemp, fsnow_level and ftcon look for it
+  do j_time=1,n_time+2
+    utemp_time_i(j_time) = time_restart + &
+      DBLE((year - 1) * n_time + j_time - 1) * time_step
+  enddo
+  call interpolate_forcing()
+  do j_time=1,n_time+2
+    utemp_time_i(j_time) = time_start + time_restart + &
+      DBLE(j_time - 1) * time_step
+  enddo
+
+  if (step_control .gt. 0) call step_control_start()
+  cycles = 0
+  change = huge(1.D0)
+  n_active = n_site
+  active = (/ (i_site, i_site=1,n_site) /)
+  mean_old = 0.D0
+  do i_cycle=1,max_cycles
+    mean_new = 0.D0
+    do j_time=1,n_time
+      time_loop = time_start + DBLE(j_time - 1) * time_step
+      !$omp parallel do schedule(dynamic) private(i_site)
+      do k=1,n_active
+        i_site = active(k)
+        if (step_control .gt. 0) then
+          call stefan1D_adaptive(temp(i_site,:),dz,i_site,lay_id(i_site,:), &
+            temp_grd(i_site), n_grd)
+        else
+          call stefan1D(temp(i_site,:),dz,i_site,lay_id(i_site,:), &
+            temp_grd(i_site), n_grd)
+        endif
+        mean_new(i_site,:) = mean_new(i_site,:) + temp(i_site,:)
+      enddo
+      !$omp end parallel do
+    enddo
+
+    ! Keep only the sites that have not reached equilibrium
+    k = 0
+    do i_site=1,n_active
+      mean_new(active(i_site),:) = mean_new(active(i_site),:) / DBLE(n_time)
+      cycles(active(i_site)) = i_cycle
+      if (i_cycle .gt. 1) then
+        change(active(i_site)) = &
+          maxval(abs(mean_new(active(i_site),:) - mean_old(active(i_site),:)))
+      endif
+      if (change(active(i_site)) .ge. tolerance) then
+        k = k + 1
+        active(k) = active(i_site)
+      endif
+    enddo
+    n_active = k
+    mean_old = mean_new
+    if (n_active .eq. 0) exit
+  enddo
+
+  ! Back to the current year, with its forcing
+  time_loop = time_start
+  utemp_time_i = times_i
+  utemp_i = utemp_year
+  snd_i = snd_year
+  stcon_i = stcon_year
+  utemp_cursor = cursors(1)
+  snd_cursor = cursors(2)
+  stcon_cursor = cursors(3)
+  do i_site=1,n_site
+    call save_results(i_site, time_loop, time_restart)
+    call active_layer(i_site)
+  enddo
+
+end subroutine spin_up
+
+
+subroutine write_output()
+  use gipl_bmi
+  use grd
+  use thermo
+  use alt
+  use bnd
+  use prof
+  use red
 
-  real*8 :: dfrz_frn(n_time)         ! depth of the freezing front
-  real :: frz_up_time_cur            ! freezeup time current (within a year)
-  real :: frz_up_time_tot            ! freezeup time global
+  implicit none
 
-  ! Write to results file
-  if (mod(int(time_loop), n_time) .eq. n_time-1) then
+  integer :: i_site, j_time, i_grd, i_frn
+
+  real*8 :: z_frz_top(n_site)         ! depth of the last freezing front
+  real :: frz_up_time_cur(n_site)     ! freezeup time current (within a year)
+  real :: frz_up_time_tot(n_site)     ! freezeup time global
+  real*8, allocatable :: block(:,:,:) ! a year of binary output
+  real*8 :: t_start
+  real*8 :: wall_seconds
+
+  if (profile .gt. 0) t_start = wall_seconds()
+
+  ! Write to results file, unless monthly_output is 0
+  if (monthly_output .eq. 0) then
+    ! The values stay available in the monthly_* arrays
+  elseif (mod(int(time_loop), n_time) .eq. n_time-1 .and. &
+          output_format .eq. 'binary') then
+    if(time_s.LT.time_e.AND.time_loop.GT.time_s)then
+      allocate(block(3+m_grd,n_site,n_time))
+      do j_time=1,n_time
+        do i_site=1,n_site
+          block(1,i_site,j_time)=monthly_time(i_site, j_time)
+          block(2,i_site,j_time)=monthly_freeze_up_temp(i_site, j_time)
+          block(3,i_site,j_time)=monthly_snow_level(i_site, j_time)
+          block(4:,i_site,j_time)=monthly_temperature(i_site, j_time, :)
+        enddo
+      enddo
+      write(result_unit) block
+      deallocate(block)
+    endif
+  elseif (mod(int(time_loop), n_time) .eq. n_time-1) then
     do i_site=1,n_site
       if(time_s.LT.time_e.AND.time_loop.GT.time_s)then
         do j_time=1,n_time
-          write(1,FMT1) i_site, &
+          write(result_unit,FMT1) i_site, &
             monthly_time(i_site, j_time), &
             monthly_freeze_up_temp(i_site, j_time), &
             monthly_snow_level(i_site, j_time), &
@@ -117,40 +497,62 @@ subroutine write_output()
       enddo
     enddo
 
-    do i_site=1,n_site
-      frz_up_time_cur=-7777.D0
-      frz_up_time_tot=frz_up_time_cur
-      do j_time=2,n_time
-        if((n_frz_frn(j_time,i_site)-n_frz_frn(j_time-1,i_site)).EQ.-2)then
-          if(z_frz_frn(j_time-1,n_frz_frn(j_time-1,i_site),i_site).GE.&
-                  frz_frn_min) frz_up_time_cur=SNGL(monthly_time(j_time,1))
-        endif
+    ! Freeze-up is the last time of the year at which two freezing fronts
+    ! merged while the last front of the step before, n_frz_frn(j_time-1),
+    ! was at frz_frn_min or deeper.  The sites are taken together, a time
+    ! and a front at a time.
+    frz_up_time_cur=-7777.0
+    do j_time=2,n_time
+      z_frz_top=sea_level
+      do i_frn=2,n_frz_max
+        where (n_frz_frn(j_time-1,:).EQ.i_frn) &
+          z_frz_top=z_frz_frn(j_time-1,i_frn,:)
       enddo
-
-      if(frz_up_time_cur.GT.0.0)then
-        frz_up_time_tot=AMOD(frz_up_time_cur,REAL(n_time))
-        if(frz_up_time_tot.EQ.0.0)frz_up_time_tot=REAL(n_time)
-      endif
-      dfrz_frn=z_frz_frn(:,1,i_site)
+      where ((n_frz_frn(j_time,:)-n_frz_frn(j_time-1,:)).EQ.-2 .AND. &
+          z_frz_top.GE.frz_frn_min) &
+        frz_up_time_cur=SNGL(monthly_time(:,j_time))
     enddo
 
-    do i_site = 1, n_site
-      freeze_up_depth(i_site) = dfrz_frn(n_time)
-      freeze_up_time_current(i_site) = frz_up_time_cur
-      freeze_up_time_total(i_site) = frz_up_time_tot
-    enddo
+    frz_up_time_tot=frz_up_time_cur
+    where (frz_up_time_cur.GT.0.0)
+      frz_up_time_tot=AMOD(frz_up_time_cur,REAL(n_time))
+    endwhere
+    where (frz_up_time_cur.GT.0.0 .AND. frz_up_time_tot.EQ.0.0)
+      frz_up_time_tot=REAL(n_time)
+    endwhere
+
+    freeze_up_depth = z_frz_frn(n_time,1,:)
+    freeze_up_time_current = frz_up_time_cur
+    freeze_up_time_total = frz_up_time_tot
+
+    if (output_format .eq. 'binary') then
+      allocate(block(6+m_grd,n_site,1))
+      do i_site=1,n_site
+        block(1,i_site,1)=annual_average_time(i_site)
+        block(2,i_site,1)=annual_freeze_up_temp(i_site)
+        block(3,i_site,1)=annual_snow_level(i_site)
+        block(4:3+m_grd,i_site,1)=annual_temperature(i_site, :)
+        block(4+m_grd,i_site,1)=freeze_up_depth(i_site)
+        block(5+m_grd,i_site,1)=freeze_up_time_current(i_site)
+        block(6+m_grd,i_site,1)=freeze_up_time_total(i_site)
+      enddo
+      write(aver_res_unit) block
+      deallocate(block)
+    else
+      do i_site=1,n_site
+        write(aver_res_unit,FMT2) &
+          i_site, &
+          annual_average_time(i_site), &
+          annual_freeze_up_temp(i_site), &
+          annual_snow_level(i_site), &
+          (annual_temperature(i_site, i_grd), i_grd=1,m_grd), &
+          freeze_up_depth(i_site), &
+          freeze_up_time_current(i_site), &
+          freeze_up_time_total(i_site)
+      enddo
+    endif
 
-    do i_site=1,n_site
-      write(2,FMT2) &
-        i_site, &
-        annual_average_time(i_site), &
-        annual_freeze_up_temp(i_site), &
-        annual_snow_level(i_site), &
-        (annual_temperature(i_site, i_grd), i_grd=1,m_grd), &
-        freeze_up_depth(i_site), &
-        freeze_up_time_current(i_site), &
-        freeze_up_time_total(i_site)
-    enddo
+    if (n_red .gt. 0 .and. reduction_file .ne. '') call write_reductions()
   endif
 
   ! Write to the restart file
@@ -158,9 +560,130 @@ subroutine write_output()
     call save_restart()
   endif
 
+  if (profile .gt. 0) then
+    prof_time_output = prof_time_output + wall_seconds() - t_start
+  endif
+
 end subroutine write_output
 
 
+subroutine profile_start()
+  ! Allocate and clear the solver counters and phase timers of module prof
+  ! The counters have a column for every timestep up to time_e
+  use gipl_bmi
+  use prof
+
+  implicit none
+
+  integer :: n_steps
+
+  if (profile .le. 0 .or. .not. allocated(monthly_time)) return
+  n_steps = max(1, ceiling(time_e / time_step))
+  if (allocated(prof_iterations)) then
+    deallocate(prof_iterations, prof_halvings, prof_min_timei, &
+      prof_solver_time)
+  endif
+  allocate(prof_iterations(n_site, n_steps))
+  allocate(prof_halvings(n_site, n_steps))
+  allocate(prof_min_timei(n_site, n_steps))
+  allocate(prof_solver_time(n_site, n_steps))
+  prof_iterations = 0
+  prof_halvings = 0
+  prof_min_timei = 0.D0
+  prof_solver_time = 0.D0
+  prof_time_solver = 0.D0
+  prof_time_active_layer = 0.D0
+  prof_time_interpolation = 0.D0
+  prof_time_output = 0.D0
+
+end subroutine profile_start
+
+
+subroutine profile_step(isite, n_iterations, n_halvings, min_timei, seconds)
+  ! Record the solver counters of a site for the current timestep
+  use gipl_bmi
+  use prof
+
+  implicit none
+
+  integer, intent(in) :: isite, n_iterations, n_halvings
+  real*8, intent(in) :: min_timei, seconds
+  integer :: i_step
+
+  if (.not. allocated(prof_iterations)) return
+  i_step = int(time_loop / time_step + 0.5D0) + 1
+  if (i_step .gt. size(prof_iterations, 2)) return
+  prof_iterations(isite, i_step) = n_iterations
+  prof_halvings(isite, i_step) = n_halvings
+  prof_min_timei(isite, i_step) = min_timei
+  prof_solver_time(isite, i_step) = seconds
+
+end subroutine profile_step
+
+
+real*8 function wall_seconds()
+  ! Wall clock time in seconds
+  implicit none
+  integer*8 :: count, count_rate
+
+  call system_clock(count, count_rate)
+  wall_seconds = dble(count) / dble(count_rate)
+end function wall_seconds
+
+
+subroutine interpolate_forcing()
+  ! Interpolate the forcing of every site to the times in utemp_time_i
+  !
+  ! All sites share the forcing times, so the intervals are found once
+  ! for all sites, starting from where they were found the year before
+  use gipl_bmi
+  use bnd
+
+  implicit none
+
+  integer :: i_site
+  integer :: utemp_idx(n_time+2),snd_idx(n_time+2),stcon_idx(n_time+2)
+
+  call locate_intervals(utemp_time,n_temp,utemp_time_i,utemp_idx,&
+          n_time+2,utemp_cursor)
+  call locate_intervals(snd_time,n_snow,utemp_time_i,snd_idx,&
+          n_time+2,snd_cursor)
+  call locate_intervals(stcon_time,n_stcon,utemp_time_i,stcon_idx,&
+          n_time+2,stcon_cursor)
+
+  !$omp parallel do
+  do i_site=1,n_site
+    if (allocated(utemp_s)) then
+      call interpolate_at_single(utemp_time,utemp_s(:,i_site),n_temp,&
+              utemp_time_i,utemp_idx,utemp_i(:,i_site),n_time+2)
+    else
+      call interpolate_at(utemp_time,utemp(:,i_site),n_temp,utemp_time_i,&
+              utemp_idx,utemp_i(:,i_site),n_time+2)
+    endif
+    if (allocated(snd_s)) then
+      call interpolate_at_single(snd_time,snd_s(:,i_site),n_snow,&
+              utemp_time_i,snd_idx,snd_i(:,i_site),n_time+2)
+    else
+      call interpolate_at(snd_time,snd(:,i_site),n_snow,utemp_time_i,&
+              snd_idx,snd_i(:,i_site),n_time+2)
+    endif
+    call snowfix(utemp_i(:,i_site),snd_i(:,i_site),n_time+2)
+    if (allocated(stcon_s)) then
+      call interpolate_at_single(stcon_time,stcon_s(:,i_site),n_stcon,&
+              utemp_time_i,stcon_idx,stcon_i(:,i_site),n_time+2)
+    else
+      call interpolate_at(stcon_time,stcon(:,i_site),n_stcon,utemp_time_i,&
+              stcon_idx,stcon_i(:,i_site),n_time+2)
+    endif
+  enddo
+  !$omp end parallel do
+
+  ! The sites are grouped again with the new forcing (see group_sites)
+  sites_grouped=.false.
+
+end subroutine interpolate_forcing
+
+
 !subroutine save_restart(n_site)
 subroutine save_restart()
   use gipl_bmi
@@ -172,20 +695,200 @@ subroutine save_restart()
 
   integer :: i_site,i_grd
 
-  rewind(3)
-  write(3, * ) time_restart
+  if (output_format .eq. 'binary') then
+    write(restart_unit,pos=1) 'GIPL_RST', n_site, n_grd, zdepth, &
+      time_restart, temp
+    return
+  endif
+
+  rewind(restart_unit)
+  write(restart_unit, * ) time_restart
   do i_grd=1,n_grd
-    write (3,* ) ( temp(i_site,i_grd),i_site=1,n_site)
+    write (restart_unit,* ) ( temp(i_site,i_grd),i_site=1,n_site)
   enddo
 
 end subroutine save_restart
 
 
+subroutine open_output()
+  ! Open the result, mean and restart files in the selected output_format
+  !
+  ! In the 'binary' format a '.txt' at the end of the file names of the cfg
+  ! file is replaced by '.bin' (or '.bin' is appended).  In both formats, a
+  ! file that another model instance has open gets a '_2', '_3', ...
+  ! suffix (see output_file_name).  The binary files are little-endian
+  ! streams of int32 and float64 values with the columns of the text
+  ! files, less the site number:
+  !   result.bin: 'GIPL_RES', n_site, n_time, n_col=3+m_grd, m_grd,
+  !               the depths of the m_grd stored grid points, then one
+  !               (n_time, n_site, n_col) block per year (C order)
+  !   mean.bin:   'GIPL_MEA', n_site, 1, n_col=6+m_grd, m_grd, the depths,
+  !               then one (n_site, n_col) block per year
+  !   start.bin:  'GIPL_RST', n_site, n_grd, zdepth, time_restart, and
+  !               temp as (n_grd, n_site), rewritten at each save_restart
+  ! gipl_output.py reads these files as numpy memory maps.
+  ! With monthly_output=0 the result file is neither opened nor written.
+  use gipl_bmi
+  use bnd
+  use grd
+
+  implicit none
+
+  character(72) :: file_name
+
+  if (output_format .eq. 'binary') then
+    if (monthly_output .ne. 0) then
+      call output_file_name(result_file, result_unit, file_name)
+      open(result_unit,file=file_name,access='stream', &
+        form='unformatted',convert='little_endian',status='replace')
+      write(result_unit) 'GIPL_RES', n_site, n_time, 3+m_grd, m_grd, &
+        zdepth(zdepth_id)
+    endif
+    call output_file_name(aver_res_file, aver_res_unit, file_name)
+    open(aver_res_unit,file=file_name,access='stream', &
+      form='unformatted',convert='little_endian',status='replace')
+    call output_file_name(restart_file, restart_unit, file_name)
+    open(restart_unit,file=file_name,access='stream', &
+      form='unformatted',convert='little_endian',status='replace')
+    write(aver_res_unit) 'GIPL_MEA', n_site, 1, 6+m_grd, m_grd, &
+      zdepth(zdepth_id)
+  elseif (output_format .eq. 'text') then
+    if (monthly_output .ne. 0) then
+      call output_file_name(result_file, result_unit, file_name)
+      open(result_unit,file=file_name,STATUS='unknown')
+    endif
+    call output_file_name(aver_res_file, aver_res_unit, file_name)
+    open(aver_res_unit,file=file_name,STATUS='unknown')
+    call output_file_name(restart_file, restart_unit, file_name)
+    open(restart_unit,file=file_name,STATUS='unknown')
+  else
+    print*, 'Unknown output_format: ', trim(output_format)
+    stop
+  endif
+
+end subroutine open_output
+
+
+subroutine format_file_name(text_name, file_name, n, ext)
+  ! The name of an output file in the selected output_format: for 'binary'
+  ! a '.txt' at the end of the name is replaced by '.bin' (or '.bin' is
+  ! appended).  n is the length of the name without its extension ext.
+  use bnd
+
+  implicit none
+
+  character(*), intent(in) :: text_name
+  character(*), intent(out) :: file_name
+  integer, intent(out) :: n
+  character(4), intent(out) :: ext
+
+  n=len_trim(text_name)
+  ext=''
+  if (n.GE.4) then
+    if (text_name(n-3:n).EQ.'.txt') then
+      n=n-4
+      ext='.txt'
+    endif
+  endif
+  if (output_format .eq. 'binary') ext='.bin'
+  file_name=text_name(1:n)//trim(ext)
+
+end subroutine format_file_name
+
+
+subroutine output_file_name(text_name, unit, file_name)
+  ! The name of an output file in the selected output_format, see
+  ! format_file_name
+  !
+  ! Model instances initialized from the same cfg file (see gipl_state.f90)
+  ! would write to the same files, which gfortran does not allow.  When the
+  ! file is already open on another unit than unit, '_2', '_3', ... is
+  ! added before the extension until the name is free, e.g. the second
+  ! instance writes output/result_2.txt.
+  use bnd
+
+  implicit none
+
+  character(*), intent(in) :: text_name
+  integer, intent(in) :: unit
+  character(*), intent(out) :: file_name
+  character(4) :: ext
+  integer :: n, i_copy, open_unit
+  logical :: is_open
+
+  call format_file_name(text_name, file_name, n, ext)
+
+  i_copy=1
+  do
+    inquire(file=trim(file_name), opened=is_open, number=open_unit)
+    if (.not. is_open .or. open_unit .eq. unit) exit
+    i_copy=i_copy+1
+    write(file_name,'(A,A,I0,A)') text_name(1:n), '_', i_copy, trim(ext)
+  enddo
+  if (i_copy.GT.1) then
+    print*, trim(text_name), ' is open for another model instance, ', &
+      'writing to ', trim(file_name)
+  endif
+
+end subroutine output_file_name
+
+
+subroutine write_reductions()
+  ! Write the reductions of the year that just ended (red_value, see
+  ! reduce_step) to reduction_file
+  !
+  ! The file is opened at the first write after set_reductions, when the
+  ! number of reductions is known.  In the 'text' format every line holds
+  ! a site number and the m_grd values of each reduction in turn.  In the
+  ! 'binary' format the file is laid out as mean.bin (see open_output):
+  !   'GIPL_RED', n_site, 1, n_col=n_red*m_grd, m_grd, the depths,
+  !   then one (n_site, n_col) block per year
+  use gipl_bmi
+  use bnd
+  use grd
+  use red
+
+  implicit none
+
+  logical :: is_open
+  integer :: i_site, i_red, i_grd
+  character(72) :: file_name
+  character(64) :: fmt_red
+
+  inquire(unit=reduction_unit, opened=is_open)
+  if (.not. is_open) then
+    call output_file_name(reduction_file, reduction_unit, file_name)
+    if (output_format .eq. 'binary') then
+      open(reduction_unit,file=file_name,access='stream', &
+        form='unformatted',convert='little_endian',status='replace')
+      write(reduction_unit) 'GIPL_RED', n_site, 1, n_red*m_grd, m_grd, &
+        zdepth(zdepth_id)
+    else
+      open(reduction_unit,file=file_name,STATUS='replace')
+    endif
+  endif
+
+  if (output_format .eq. 'binary') then
+    write(reduction_unit) ((red_value(i_site, :, i_red), i_red=1,n_red), &
+      i_site=1,n_site)
+  else
+    write(fmt_red,'(A,I0,A)') '(1I10,', n_red*m_grd, '(1X,F14.6))'
+    do i_site=1,n_site
+      write(reduction_unit,fmt_red) i_site, &
+        ((red_value(i_site, i_grd, i_red), i_grd=1,m_grd), i_red=1,n_red)
+    enddo
+  endif
+
+end subroutine write_reductions
+
+
 subroutine finalize_f90()
+  use bnd
 
   implicit none
 
-  close(1);close(2);close(3)
+  close(result_unit);close(aver_res_unit);close(restart_unit)
+  close(reduction_unit)
 
 end subroutine finalize_f90
 
@@ -197,13 +900,14 @@ subroutine initialize_f90(named_config_file)
   use thermo
   use grd
   use alt
+  use prof
 
   implicit none
 
   character(64) :: named_config_file
 
   integer :: IREAD,ierr
-  integer :: i,j,k,z_num,i_grd,j_time,i_site,i_lay
+  integer :: i,j,k,z_num,i_grd,j_time,i_site
 
 
   real*8 ,allocatable ::gtzone(:,:)
@@ -225,6 +929,15 @@ subroutine initialize_f90(named_config_file)
   real*8, allocatable :: z(:) ! vertical grid
   real*8 :: hcscale
 
+  character(64) :: input_files(9)
+  logical :: use_cache
+  logical :: load_input_cache
+
+  namelist /gipl_options/ table_resolution,table_tolerance,table_t_min, &
+    output_format,profile,input_cache,step_control,step_tolerance, &
+    grid_stretch,grid_dz_min,grid_dz_front,monthly_output,reduction_file, &
+    site_dedup,dedup_tolerance,storage_precision
+
   ! For now, the pre-set value of fconfig takes priority over the passed value
   if (fconfig .eq. '') then
     ! No pre-set fconfig, use named_config if it exists, or a default if not
@@ -278,18 +991,41 @@ subroutine initialize_f90(named_config_file)
   read(60,*) frz_frn_min,frz_frn_max
   read(60,'(A)')stdummy
   read(60,*) sat_coef
+  ! Optional settings, given as a namelist after the parameters above, e.g.
+  !   &gipl_options output_format='binary' /
+  ! Settings that are not given keep their current values
+  read(60,nml=gipl_options,iostat=ierr)
+  if (ierr .gt. 0) then
+    print*, 'Error reading &gipl_options in ', fconfig
+    stop
+  endif
 
   close(60)
 
   call filexist(file_sites)
-  call filexist(file_bound)
-  call filexist(file_snow)
-  call filexist(file_rsnow)
+  ! Forcing given by set_forcing before initialize takes priority over files
+  if (.not. utemp_preset) call filexist(file_bound)
+  if (.not. snd_preset) call filexist(file_snow)
+  if (.not. stcon_preset) call filexist(file_rsnow)
   call filexist(file_grid)
   call filexist(file_init)
   call filexist(file_mineral)
   call filexist(file_organic)
 
+  ! Inputs parsed by an earlier initialize, from the same files with the
+  ! same options, are read back from input_cache instead
+  input_files = (/ fconfig, file_sites, file_bound, file_snow, file_rsnow, &
+    file_init, file_grid, file_organic, file_mineral /)
+  use_cache = input_cache .ne. '' .and. restart .ne. 0 .and. &
+    .not. (utemp_preset .or. snd_preset .or. stcon_preset)
+  if (use_cache) then
+    if (load_input_cache(input_files, 9)) then
+      call open_output()
+      call profile_start()
+      return
+    endif
+  endif
+
   open(60,FILE=file_sites)
   read(60,*)n_site
   allocate(snow_code(n_site),STAT=IERR)
@@ -303,32 +1039,11 @@ subroutine initialize_f90(named_config_file)
   enddo
   close(60)
 
-  open(60,file=file_bound)
-  read(60,*)n_temp
-  allocate(utemp_time(n_temp),STAT=IERR)
-  allocate(utemp(n_temp,n_site),STAT=IERR)
-  do i=1,n_temp
-    read(60,*) utemp_time(I),(utemp(I,i_site),i_site=1,n_site)
-  enddo
-  close(60)
-
-  open(60,file=file_rsnow)
-  read(60,*)n_stcon
-  allocate(stcon_time(n_stcon),STAT=IERR)
-  allocate(stcon(n_stcon,n_site),STAT=IERR)
-  do i=1,n_stcon
-    read(60,*) stcon_time(i),(stcon(i,i_site),i_site=1,n_site)
-  enddo
-  close(60)
-
-  open(60,file=file_snow)
-  read(60,*)n_snow
-  allocate(snd_time(n_snow),STAT=IERR)
-  allocate(snd(n_snow,n_site),STAT=IERR)
-  do I=1,n_snow
-    read(60,*) snd_time(i),(snd(i,i_site),i_site=1,n_site)
-  enddo
-  close(60)
+  ! Forcing given by set_forcing is kept, in storage_precision
+  call convert_forcing()
+  call read_forcing('bound', file_bound)
+  call read_forcing('rsnow', file_rsnow)
+  call read_forcing('snow', file_snow)
 
   open(60,file=file_init,action='read')
   read(60,*)z_num,n_ini!,time_restart
@@ -360,6 +1075,7 @@ subroutine initialize_f90(named_config_file)
     read(60,*)zdepth_id(j)
   enddo
   close(60)
+  if (grid_stretch .GT. 1.D0) call generate_grid()
 
   open (60, file=file_organic)
   ! reads numbers of  classes
@@ -478,6 +1194,8 @@ subroutine initialize_f90(named_config_file)
   L_fus=hcscale*Lf
   call  assign_layer_id(n_lay,n_lay_cur,n_site,n_grd,zdepth,n_bnd_lay,lay_id)
   call init_cond(restart,n_site)
+  ! The initial profile of every site is in temp now
+  deallocate(ztemp_ini)
 
   ! allocating interval variable after interation
   allocate(utemp_time_i(n_time+2),STAT=IERR)
@@ -489,21 +1207,14 @@ subroutine initialize_f90(named_config_file)
   do j_time=1,n_time+2
     utemp_time_i(j_time)=time_restart+DBLE(j_time-1)*time_step
   enddo
+  utemp_cursor=0
+  snd_cursor=0
+  stcon_cursor=0
   do i_site=1,n_site
     if (lbound.EQ.2)temp_grd(i_site)=temp_grd(i_site)*zdepth(n_grd)
-    do i_lay=1,n_lay_cur(i_site)
-      temp_frz(i_lay,i_site)=-(vwc(i_lay,i_site)/&
-              a_coef(i_lay,i_site))**(1.d0/b_coef(i_lay,i_site))
-    enddo
-    call interpolate(utemp_time,utemp(:,i_site),n_temp,utemp_time_i,&
-            utemp_i(:,i_site),n_time+2)
-    call interpolate(snd_time,snd(:,i_site),n_snow,utemp_time_i,&
-            snd_i(:,i_site),n_time+2)
-    call snowfix(utemp_i(:,i_site),snd_i(:,i_site),n_time+2)
-    call interpolate(stcon_time,stcon(:,i_site),n_stcon,utemp_time_i,&
-            stcon_i(:,i_site),n_time+2)
-    call active_layer(i_site)
   enddo
+  call interpolate_forcing()
+  call refresh_parameters()
 
   ! Allocate output arrays
   allocate(monthly_time(n_site, n_time))
@@ -518,9 +1229,7 @@ subroutine initialize_f90(named_config_file)
   allocate(freeze_up_time_current(n_site))
   allocate(freeze_up_time_total(n_site))
 
-  open(1,file=result_file,STATUS='unknown')
-  open(2,file=aver_res_file,STATUS='unknown')
-  open(3,file=restart_file,STATUS='unknown')
+  call open_output()
   write(FMT1,'(A30,I0,A12)')'(1x,I10,1x,F12.3,2(1x,F16.12),',&
           m_grd,'(1x,F16.12))'
   write(FMT2,'(A28,I0,A40)')'(1x,I10,1x,F12.3,2(1x,F8.3),',&
@@ -543,74 +1252,352 @@ subroutine initialize_f90(named_config_file)
   allocate(snow_depth(n_total_timesteps))
   allocate(snow_thermal_conductivity(n_total_timesteps))
 
-end subroutine initialize_f90
+  call profile_start()
 
+  if (use_cache) call save_input_cache(input_files, 9)
 
-subroutine init_cond(q,last)
+end subroutine initialize_f90
 
-  use gipl_bmi
+
+subroutine input_cache_key(files, n_files, key)
+  ! Describe what initialize parses: the names, sizes and modification
+  ! times of the configuration and input files, and the options, which
+  ! also shape the initialized state
   use bnd
   use thermo
   use grd
+  use prof
 
   implicit none
-  integer q,last
-  integer i,j
-  character(64) :: file_init
 
-  if(q.EQ.1)then !restart=1 means reading initial data from
-    do I=1,last
-      call interpolate(zdepth_ini,ztemp_ini(:,I),n_ini,zdepth,temp(I,:),n_grd)
-    enddo
-  elseif(restart.EQ.0)then              !restart=0 enbales spinup
-    write(file_init,'(A14)') 'output/start.txt'
-    open(60,file=file_init,action='READ')
-    read(60,*)time_restart              ! day number in restart file
-    do J=1,n_grd
-      read (60,* ) ( temp(i,j),i=1,last)
-    enddo
-    close(60)
+  integer, intent(in) :: n_files
+  character(64), intent(in) :: files(n_files)
+  character(*), intent(out) :: key
+  integer :: values(13), status, i
+  character(256) :: item
+
+  key = ''
+  do i=1,n_files
+    ! stat is a GNU extension: values(8) is the size, values(10) the mtime
+    call stat(trim(files(i)), values, status)
+    write(item,'(A,3(1X,I0))') trim(files(i)), status, values(8), values(10)
+    key = trim(key)//';'//trim(item)
+  enddo
+  write(item,'(I0,1X,2(ES24.16E3,1X),A,1X,I0,1X,I0,4(1X,ES24.16E3))') &
+    table_resolution, table_tolerance, table_t_min, &
+    trim(output_format), profile, step_control, step_tolerance, &
+    grid_stretch, grid_dz_min, grid_dz_front
+  key = trim(key)//';'//trim(item)//';'//trim(storage_precision)
+
+end subroutine input_cache_key
+
+
+logical function load_input_cache(files, n_files)
+  ! Replace the module variables with the state that initialize wrote to
+  ! input_cache, if it was written from the same files and options
+  !
+  ! The file holds 'GIPL_INC', the input_cache_key of its inputs and a
+  ! snapshot of the initialized state (see write_snapshot in gipl_state.f90)
+  use bnd
+  use gipl_state
+
+  implicit none
+
+  integer, intent(in) :: n_files
+  character(64), intent(in) :: files(n_files)
+  character(2048) :: key, cached_key
+  character(8) :: magic
+  integer :: unit, ierr
+  logical :: found
+
+  load_input_cache = .false.
+  inquire(file=trim(input_cache), exist=found)
+  if (.not. found) return
+
+  call input_cache_key(files, n_files, key)
+  open(newunit=unit,file=trim(input_cache),access='stream', &
+    form='unformatted',convert='little_endian',status='old',action='read')
+  read(unit,iostat=ierr) magic, cached_key
+  if (ierr .eq. 0 .and. magic .eq. 'GIPL_INC' .and. cached_key .eq. key) then
+    call read_snapshot(unit)
+    load_input_cache = .true.
   endif
+  close(unit)
 
-end subroutine init_cond
+end function load_input_cache
 
 
-subroutine active_layer(k)
+subroutine save_input_cache(files, n_files)
+  ! Write the initialized state to input_cache, for load_input_cache
+  use bnd
+  use gipl_state
+
+  implicit none
 
+  integer, intent(in) :: n_files
+  character(64), intent(in) :: files(n_files)
+  character(2048) :: key
+  integer :: unit
+
+  call input_cache_key(files, n_files, key)
+  open(newunit=unit,file=trim(input_cache),access='stream', &
+    form='unformatted',convert='little_endian',status='replace')
+  write(unit) 'GIPL_INC', key
+  call write_snapshot(unit)
+  close(unit)
+
+end subroutine save_input_cache
+
+
+subroutine read_forcing(forcing_name, file_name)
+  ! Read the forcing file of forcing_name ('bound', 'snow' or 'rsnow', see
+  ! store_forcing), unless the series was given by set_forcing
+  !
+  ! With storage_precision='single' the values are kept in utemp_s, snd_s
+  ! and stcon_s instead of utemp, snd and stcon, which halves the memory of
+  ! the series, the largest arrays of a long run with many sites.  The file
+  ! is read a record at a time, so the series is never held in double
+  ! precision.  interpolate_forcing takes the values back to double
+  ! precision, and the solver works in double precision throughout.
   use gipl_bmi
   use bnd
-  use thermo
-  use grd
-  use alt
 
   implicit none
 
-  integer :: k,j,jj
-  real*8 GA,GB,YFRON,GX,GY
-  real*8 fsat_unf_water
+  character(*), intent(in) :: forcing_name, file_name
+  integer :: n_rec, i_rec
+  real*8 :: time_rec
+  real*8, allocatable :: row(:)
+  logical :: single
+
+  select case (forcing_name)
+  case ('bound')
+    if (utemp_preset) then
+      if (allocated(utemp_s)) then
+        call check_forcing_sites(forcing_name, size(utemp_s,2))
+      else
+        call check_forcing_sites(forcing_name, size(utemp,2))
+      endif
+      return
+    endif
+  case ('snow')
+    if (snd_preset) then
+      if (allocated(snd_s)) then
+        call check_forcing_sites(forcing_name, size(snd_s,2))
+      else
+        call check_forcing_sites(forcing_name, size(snd,2))
+      endif
+      return
+    endif
+  case ('rsnow')
+    if (stcon_preset) then
+      if (allocated(stcon_s)) then
+        call check_forcing_sites(forcing_name, size(stcon_s,2))
+      else
+        call check_forcing_sites(forcing_name, size(stcon,2))
+      endif
+      return
+    endif
+  end select
+
+  single = storage_precision .eq. 'single'
+  allocate(row(n_site))
+  open(60,file=file_name)
+  read(60,*) n_rec
+  select case (forcing_name)
+  case ('bound')
+    n_temp = n_rec
+    allocate(utemp_time(n_rec))
+    if (single) then
+      allocate(utemp_s(n_rec,n_site))
+    else
+      allocate(utemp(n_rec,n_site))
+    endif
+  case ('snow')
+    n_snow = n_rec
+    allocate(snd_time(n_rec))
+    if (single) then
+      allocate(snd_s(n_rec,n_site))
+    else
+      allocate(snd(n_rec,n_site))
+    endif
+  case ('rsnow')
+    n_stcon = n_rec
+    allocate(stcon_time(n_rec))
+    if (single) then
+      allocate(stcon_s(n_rec,n_site))
+    else
+      allocate(stcon(n_rec,n_site))
+    endif
+  end select
+
+  do i_rec=1,n_rec
+    read(60,*) time_rec, row
+    select case (forcing_name)
+    case ('bound')
+      utemp_time(i_rec) = time_rec
+      if (single) then
+        utemp_s(i_rec,:) = real(row)
+      else
+        utemp(i_rec,:) = row
+      endif
+    case ('snow')
+      snd_time(i_rec) = time_rec
+      if (single) then
+        snd_s(i_rec,:) = real(row)
+      else
+        snd(i_rec,:) = row
+      endif
+    case ('rsnow')
+      stcon_time(i_rec) = time_rec
+      if (single) then
+        stcon_s(i_rec,:) = real(row)
+      else
+        stcon(i_rec,:) = row
+      endif
+    end select
+  enddo
+  close(60)
+  deallocate(row)
+
+end subroutine read_forcing
+
+
+subroutine convert_forcing()
+  ! Move the forcing series that are held to storage_precision, e.g. those
+  ! given by set_forcing before storage_precision was set
+  use bnd
+
+  implicit none
+
+  if (storage_precision .eq. 'single') then
+    if (allocated(utemp)) then
+      allocate(utemp_s(size(utemp,1),size(utemp,2)))
+      utemp_s = real(utemp)
+      deallocate(utemp)
+    endif
+    if (allocated(snd)) then
+      allocate(snd_s(size(snd,1),size(snd,2)))
+      snd_s = real(snd)
+      deallocate(snd)
+    endif
+    if (allocated(stcon)) then
+      allocate(stcon_s(size(stcon,1),size(stcon,2)))
+      stcon_s = real(stcon)
+      deallocate(stcon)
+    endif
+  else
+    if (allocated(utemp_s)) then
+      allocate(utemp(size(utemp_s,1),size(utemp_s,2)))
+      utemp = dble(utemp_s)
+      deallocate(utemp_s)
+    endif
+    if (allocated(snd_s)) then
+      allocate(snd(size(snd_s,1),size(snd_s,2)))
+      snd = dble(snd_s)
+      deallocate(snd_s)
+    endif
+    if (allocated(stcon_s)) then
+      allocate(stcon(size(stcon_s,1),size(stcon_s,2)))
+      stcon = dble(stcon_s)
+      deallocate(stcon_s)
+    endif
+  endif
+
+end subroutine convert_forcing
+
+
+subroutine init_cond(q,last)
+
+  use gipl_bmi
+  use bnd
+  use thermo
+  use grd
+
+  implicit none
+  integer q,last
+  integer i,j
+  character(72) :: file_init
+  character(4) :: ext
+  character(8) :: magic
+  integer :: n, n_site_rst, n_grd_rst
+  real*8 :: zdepth_rst(n_grd)
+
+  if(q.EQ.1)then !restart=1 means reading initial data from
+    do I=1,last
+      call interpolate(zdepth_ini,ztemp_ini(:,I),n_ini,zdepth,temp(I,:),n_grd)
+    enddo
+  elseif(restart.EQ.0)then              !restart=0 enbales spinup
+    ! Start from the restart file of the cfg file, as save_restart writes
+    ! it in this run's output_format (start.bin for 'binary')
+    call format_file_name(restart_file, file_init, n, ext)
+    call filexist(file_init)
+    if (output_format .eq. 'binary') then
+      open(60,file=file_init,access='stream',form='unformatted', &
+        convert='little_endian',status='old',action='read')
+      read(60) magic, n_site_rst, n_grd_rst
+      if (magic.NE.'GIPL_RST' .or. n_site_rst.NE.last .or. &
+          n_grd_rst.NE.n_grd) then
+        print*, trim(file_init), ' is not a restart file for ', last, &
+          ' sites and ', n_grd, ' grid points'
+        stop
+      endif
+      read(60) zdepth_rst, time_restart, temp
+      close(60)
+    else
+      open(60,file=file_init,action='READ')
+      read(60,*)time_restart              ! day number in restart file
+      do J=1,n_grd
+        read (60,* ) ( temp(i,j),i=1,last)
+      enddo
+      close(60)
+    endif
+  endif
+
+end subroutine init_cond
+
+
+subroutine active_layer(k)
+  ! Find the freezing fronts of site k at the current time i_time(k): the
+  ! depths between nodes frz_frn_first and frz_frn_last+1 where the
+  ! unfrozen water saturation crosses sat_coef, from the bottom up.  The
+  ! saturation of each node is evaluated once, and serves both intervals
+  ! the node bounds.
+
+  use gipl_bmi
+  use bnd
+  use thermo
+  use grd
+  use alt
+
+  implicit none
+
+  integer :: k,j
+  real*8 GA,GB,YFRON,GX,GY
+  real*8 fsat_unf_water
 
   z_frz_frn(i_time(k),:,k)=sea_level
   n_frz_frn(i_time(k),k)=0
-  do 1329 JJ=1,n_grd-1
-    J=n_grd-JJ
-    if (zdepth(J).GE.sea_level.AND.zdepth(J+1).LE.frz_frn_max)then
-      GA=fsat_unf_water(temp(k,J),lay_id(k,J),k)
-      GB=fsat_unf_water(temp(k,J+1),lay_id(k,J+1),k)
-      if((GA-sat_coef)*(GB-sat_coef).LE.0.D0) then
-        GY=(GA-GB)/(zdepth(J)-zdepth(J+1))
-        GX=(GA+GB-GY*(zdepth(J)+zdepth(J+1)))/2.D0
-        if(GY.EQ.0.D0) then
-          YFRON=(zdepth(J)+zdepth(J+1))/2.D0
-        else
-          YFRON=(sat_coef-GX)/GY
-        endif
+  if (frz_frn_last.LT.frz_frn_first) return
+
+  GA=fsat_unf_water(temp(k,frz_frn_last+1),lay_id(k,frz_frn_last+1),k)
+  do 1329 J=frz_frn_last,frz_frn_first,-1
+    GB=GA
+    GA=fsat_unf_water(temp(k,J),lay_id(k,J),k)
+    if((GA-sat_coef)*(GB-sat_coef).LE.0.D0) then
+      GY=(GA-GB)/(zdepth(J)-zdepth(J+1))
+      GX=(GA+GB-GY*(zdepth(J)+zdepth(J+1)))/2.D0
+      if(GY.EQ.0.D0) then
+        YFRON=(zdepth(J)+zdepth(J+1))/2.D0
       else
-        GOTO 1329
-      endif
-      if(n_frz_frn(i_time(k),k).LT.n_frz_max)then
-        n_frz_frn(i_time(k),k)=n_frz_frn(i_time(k),k)+1
-        z_frz_frn(i_time(k),n_frz_frn(i_time(k),k),k)=YFRON
+        YFRON=(sat_coef-GX)/GY
       endif
+    else
+      GOTO 1329
+    endif
+    if(n_frz_frn(i_time(k),k).LT.n_frz_max)then
+      n_frz_frn(i_time(k),k)=n_frz_frn(i_time(k),k)+1
+      z_frz_frn(i_time(k),n_frz_frn(i_time(k),k),k)=YFRON
     endif
 1329 CONTINUE
 
@@ -640,6 +1627,402 @@ subroutine save_results(k, time2, restart_time)
 end subroutine save_results
 
 
+subroutine reduce_step(k, time_cur)
+  ! Take the temperatures of site k at the zdepth_id depths, after the step
+  ! ending at model time time_cur, into the reductions (see set_reductions)
+  !
+  ! A reduction takes the timesteps of the year marked in its column of
+  ! red_steps.  At the last timestep of the year the reductions of the year
+  ! go to red_value, by red_kind:
+  !   1 the mean, 2 the largest and 3 the smallest temperature
+  !   4 the first time at which the temperature reached red_threshold from
+  !     below, the step before possibly in the year before
+  !   5 the sum over the timesteps of the degrees above red_threshold times
+  !     time_step, e.g. thawing degree-days with a threshold of 0
+  !   6 the red_fraction quantile, estimated with the P2 algorithm (see
+  !     p2_add), exact up to five timesteps
+  ! A reduction that took no timestep, or a crossing that did not occur,
+  ! gives -7777.
+  use gipl_bmi
+  use grd
+  use alt
+  use red
+
+  implicit none
+
+  integer :: k
+  real*8 :: time_cur
+  integer :: i_red, j, n_obs
+  real*8 :: x(m_grd)
+  real*8 :: p2_value
+
+  if (i_time(k) .eq. 1) call reduce_reset(k)
+  x = temp(k, zdepth_id)
+
+  do i_red=1,n_red
+    if (red_steps(i_time(k), i_red) .eq. 0) cycle
+    red_count(k, i_red) = red_count(k, i_red) + 1
+    select case (red_kind(i_red))
+    case (1)
+      red_acc(k,:,i_red) = red_acc(k,:,i_red) + x
+    case (2)
+      red_acc(k,:,i_red) = max(red_acc(k,:,i_red), x)
+    case (3)
+      red_acc(k,:,i_red) = min(red_acc(k,:,i_red), x)
+    case (4)
+      where (red_acc(k,:,i_red) .EQ. -7777.D0 .AND. &
+          red_prev(k,:) .LT. red_threshold(i_red) .AND. &
+          x .GE. red_threshold(i_red)) red_acc(k,:,i_red) = time_cur
+    case (5)
+      red_acc(k,:,i_red) = red_acc(k,:,i_red) + &
+        max(x - red_threshold(i_red), 0.D0) * time_step
+    case (6)
+      do j=1,m_grd
+        call p2_add(red_q(:,k,j,i_red), red_n(:,k,j,i_red), &
+          red_count(k, i_red), red_fraction(i_red), x(j))
+      enddo
+    end select
+  enddo
+  red_prev(k,:) = x
+
+  if (i_time(k) .lt. n_time) return
+
+  ! The year is complete
+  do i_red=1,n_red
+    n_obs = red_count(k, i_red)
+    if (n_obs .eq. 0) then
+      red_value(k,:,i_red) = -7777.D0
+    elseif (red_kind(i_red) .eq. 1) then
+      red_value(k,:,i_red) = red_acc(k,:,i_red) / DBLE(n_obs)
+    elseif (red_kind(i_red) .eq. 6) then
+      do j=1,m_grd
+        red_value(k,j,i_red) = p2_value(red_q(:,k,j,i_red), n_obs, &
+          red_fraction(i_red))
+      enddo
+    else
+      red_value(k,:,i_red) = red_acc(k,:,i_red)
+    endif
+  enddo
+
+end subroutine reduce_step
+
+
+subroutine reduce_reset(k)
+  ! Start the reductions of a new year for site k
+  use red
+
+  implicit none
+
+  integer :: k, i_red
+
+  red_count(k,:) = 0
+  do i_red=1,n_red
+    select case (red_kind(i_red))
+    case (2)
+      red_acc(k,:,i_red) = -huge(1.D0)
+    case (3)
+      red_acc(k,:,i_red) = huge(1.D0)
+    case (4)
+      red_acc(k,:,i_red) = -7777.D0
+    case default
+      red_acc(k,:,i_red) = 0.D0
+    end select
+  enddo
+
+end subroutine reduce_reset
+
+
+subroutine p2_add(q, n, n_obs, p, x)
+  ! Take x, the n_obs-th value of a series, into the P2 estimate of its p
+  ! quantile (Jain and Chlamtac, 1985, Communications of the ACM 28,
+  ! 1076-1085): five markers with heights q and positions n, the middle
+  ! one at the quantile, are moved towards their desired positions with
+  ! piecewise-parabolic height changes.  The first five values are kept
+  ! sorted in q.
+  implicit none
+
+  real*8, intent(inout) :: q(5)
+  integer, intent(inout) :: n(5)
+  integer, intent(in) :: n_obs
+  real*8, intent(in) :: p, x
+  real*8 :: desired(5), d, qp
+  integer :: i, kk, ds
+
+  if (n_obs .le. 5) then
+    i = n_obs
+    do while (i .gt. 1)
+      if (q(i-1) .le. x) exit
+      q(i) = q(i-1)
+      i = i - 1
+    enddo
+    q(i) = x
+    n = (/ 1, 2, 3, 4, 5 /)
+    return
+  endif
+
+  ! The cell of x, with the extreme markers moved out to it
+  if (x .LT. q(1)) then
+    q(1) = x
+    kk = 1
+  elseif (x .GE. q(5)) then
+    q(5) = x
+    kk = 4
+  else
+    kk = 1
+    do while (x .GE. q(kk+1))
+      kk = kk + 1
+    enddo
+  endif
+  n(kk+1:5) = n(kk+1:5) + 1
+
+  desired = (/ 1.D0, 1.D0 + 2.D0*p, 1.D0 + 4.D0*p, 3.D0 + 2.D0*p, 5.D0 /) + &
+    DBLE(n_obs - 5) * (/ 0.D0, p/2.D0, p, (1.D0 + p)/2.D0, 1.D0 /)
+  do i=2,4
+    d = desired(i) - DBLE(n(i))
+    if ((d .GE. 1.D0 .AND. n(i+1) - n(i) .GT. 1) .OR. &
+        (d .LE. -1.D0 .AND. n(i-1) - n(i) .LT. -1)) then
+      ds = int(sign(1.D0, d))
+      qp = q(i) + DBLE(ds) / DBLE(n(i+1) - n(i-1)) * &
+        (DBLE(n(i) - n(i-1) + ds) * (q(i+1) - q(i)) / DBLE(n(i+1) - n(i)) + &
+         DBLE(n(i+1) - n(i) - ds) * (q(i) - q(i-1)) / DBLE(n(i) - n(i-1)))
+      if (q(i-1) .LT. qp .AND. qp .LT. q(i+1)) then
+        q(i) = qp
+      else
+        q(i) = q(i) + DBLE(ds) * (q(i+ds) - q(i)) / DBLE(n(i+ds) - n(i))
+      endif
+      n(i) = n(i) + ds
+    endif
+  enddo
+
+end subroutine p2_add
+
+
+real*8 function p2_value(q, n_obs, p)
+  ! The p quantile of a series of n_obs values taken by p2_add: the middle
+  ! marker, or for up to five values their linear interpolation
+  implicit none
+
+  real*8, intent(in) :: q(5)
+  integer, intent(in) :: n_obs
+  real*8, intent(in) :: p
+  real*8 :: pos
+  integer :: i
+
+  if (n_obs .gt. 5) then
+    p2_value = q(3)
+    return
+  endif
+  pos = 1.D0 + p * DBLE(n_obs - 1)
+  i = min(int(pos), n_obs - 1)
+  if (i .lt. 1) then
+    p2_value = q(1)
+  else
+    p2_value = q(i) + (pos - DBLE(i)) * (q(i+1) - q(i))
+  endif
+
+end function p2_value
+
+
+subroutine refresh_parameters()
+  ! Derive the freezing points, the property tables, the nodes searched for
+  ! freezing fronts and the freezing fronts of the initial temperatures from
+  ! the soil properties in thermo
+  !
+  ! initialize calls this once the properties are read.  Call it again
+  ! after changing vwc, a_coef, b_coef, hcap_frz, hcap_thw, tcon_frz or
+  ! tcon_thw of an initialized model, before its first update.  The sites
+  ! are then grouped again (site_dedup, see group_sites).
+  use gipl_bmi
+  use thermo
+  use grd
+  use bnd
+  use alt
+
+  implicit none
+
+  integer :: i_site,i_lay,i_grd
+
+  do i_site=1,n_site
+    do i_lay=1,n_lay_cur(i_site)
+      temp_frz(i_lay,i_site)=-(vwc(i_lay,i_site)/&
+              a_coef(i_lay,i_site))**(1.d0/b_coef(i_lay,i_site))
+    enddo
+  enddo
+  call build_property_tables()
+  sites_grouped=.false.
+
+  ! The grid deepens with the node index, so the intervals between
+  ! sea_level and frz_frn_max are those of nodes frz_frn_first to
+  ! frz_frn_last
+  frz_frn_first=1
+  frz_frn_last=0
+  do i_grd=n_grd-1,1,-1
+    if (zdepth(i_grd).GE.sea_level.AND.zdepth(i_grd+1).LE.frz_frn_max) then
+      if (frz_frn_last.EQ.0) frz_frn_last=i_grd
+      frz_frn_first=i_grd
+    endif
+  enddo
+
+  do i_site=1,n_site
+    call active_layer(i_site)
+  enddo
+
+end subroutine refresh_parameters
+
+
+subroutine build_property_tables()
+  ! Tabulate the unfrozen water content, its derivative and the ground
+  ! thermal conductivity of every soil layer below its freezing depression
+  !
+  ! |T| is split into octaves [2**(o-1),2**o), each cut into n_tbl_sub
+  ! equal intervals, so that a table entry is found from the binary
+  ! exponent and fraction of |T| and the intervals get finer towards the
+  ! freezing point, where the power law bends most.  Layers that have the
+  ! same parameters share a table.  The number of intervals per octave
+  ! starts at table_resolution and is doubled until the largest relative
+  ! deviation from the closed forms, taken at the middle of every interval,
+  ! is within table_tolerance.
+  use gipl_bmi
+  use gipl_const
+  use thermo
+  use grd
+
+  implicit none
+
+  integer, parameter :: max_sub=4096
+  integer :: i_site,i_lay,k,n_set,io,j
+  integer, allocatable :: set_lay(:),set_site(:)
+  real*8 :: x,err_unf,err_dunf,err_tcon
+
+  n_tbl_sub=0
+  if (allocated(prop_tbl)) deallocate(prop_tbl)
+  if (allocated(tbl_set)) deallocate(tbl_set)
+  if (table_resolution.LE.0 .OR. .NOT.allocated(temp_frz)) return
+
+  ! Find the distinct parameter sets and the octaves they need
+  allocate(tbl_set(n_lay,n_site))
+  allocate(set_lay(n_lay*n_site),set_site(n_lay*n_site))
+  tbl_set=0
+  n_set=0
+  tbl_oct_hi=exponent(DABS(table_t_min))
+  tbl_oct_lo=tbl_oct_hi
+  do i_site=1,n_site
+    do i_lay=1,n_lay_cur(i_site)
+      ! Neighbouring sites usually share their classes, try theirs first
+      k=0
+      if (i_site.GT.1) k=tbl_set(i_lay,i_site-1)
+      if (k.GT.0) then
+        if (.NOT.same_layer(set_lay(k),set_site(k),i_lay,i_site)) k=0
+      endif
+      if (k.EQ.0) then
+        do k=n_set,1,-1
+          if (same_layer(set_lay(k),set_site(k),i_lay,i_site)) exit
+        enddo
+      endif
+      if (k.EQ.0) then
+        n_set=n_set+1
+        k=n_set
+        set_lay(k)=i_lay
+        set_site(k)=i_site
+        x=DABS(temp_frz(i_lay,i_site)-EE(i_lay,i_site))
+        tbl_oct_lo=min(tbl_oct_lo,max(exponent(x),exponent(1.D-6)))
+      endif
+      tbl_set(i_lay,i_site)=k
+    enddo
+  enddo
+  tbl_t_small=scale(1.D0,tbl_oct_lo-1)
+  tbl_t_big=scale(1.D0,tbl_oct_hi)
+
+  n_tbl_sub=table_resolution
+  do
+    allocate(prop_tbl(0:n_tbl_sub,tbl_oct_lo:tbl_oct_hi,n_set,3))
+    do k=1,n_set
+      do io=tbl_oct_lo,tbl_oct_hi
+        do j=0,n_tbl_sub
+          x=scale(1.D0,io-1)*(1.D0+DBLE(j)/DBLE(n_tbl_sub))
+          call closed_forms(x,k,prop_tbl(j,io,k,1),prop_tbl(j,io,k,2),&
+                  prop_tbl(j,io,k,3))
+        enddo
+      enddo
+    enddo
+
+    err_unf=0.D0
+    err_dunf=0.D0
+    err_tcon=0.D0
+    do k=1,n_set
+      i_lay=set_lay(k)
+      i_site=set_site(k)
+      x=DABS(temp_frz(i_lay,i_site)-EE(i_lay,i_site))
+      do io=max(tbl_oct_lo,exponent(x)),tbl_oct_hi
+        do j=0,n_tbl_sub-1
+          x=scale(1.D0,io-1)*(1.D0+(DBLE(j)+0.5D0)/DBLE(n_tbl_sub))
+          call check_node(x,k)
+        enddo
+      enddo
+    enddo
+    table_error_unf=err_unf
+    table_error_dunf=err_dunf
+    table_error_tcon=err_tcon
+
+    if (max(err_unf,err_dunf,err_tcon).LE.table_tolerance) exit
+    if (2*n_tbl_sub.GT.max_sub) then
+      print*, 'Warning: property tables of ', n_tbl_sub, &
+        ' intervals per octave do not reach table_tolerance'
+      exit
+    endif
+    deallocate(prop_tbl)
+    n_tbl_sub=2*n_tbl_sub
+  enddo
+
+  print '(A,I0,A,I0,A)', ' Property tables: ', n_set, ' tables of ', &
+    n_tbl_sub, ' intervals per octave'
+  print '(A,3ES10.2)', ' Largest relative deviation (unfrozen water, '//&
+    'derivative, conductivity):', table_error_unf, table_error_dunf, &
+    table_error_tcon
+
+  deallocate(set_lay,set_site)
+
+contains
+
+  logical function same_layer(j1,i1,j2,i2)
+    integer, intent(in) :: j1,i1,j2,i2
+    same_layer=vwc(j1,i1).EQ.vwc(j2,i2) .AND. &
+      a_coef(j1,i1).EQ.a_coef(j2,i2) .AND. b_coef(j1,i1).EQ.b_coef(j2,i2) .AND. &
+      temp_frz(j1,i1).EQ.temp_frz(j2,i2) .AND. EE(j1,i1).EQ.EE(j2,i2) .AND. &
+      tcon_thw(j1,i1).EQ.tcon_thw(j2,i2) .AND. tcon_frz(j1,i1).EQ.tcon_frz(j2,i2)
+  end function same_layer
+
+  subroutine closed_forms(xt,kt,unf,dunf,tcon)
+    ! The branches of funf_water, fdunf_water and ftcon for T=-xt<=temp_frz-EE
+    real*8, intent(in) :: xt
+    integer, intent(in) :: kt
+    real*8, intent(out) :: unf,dunf,tcon
+    real*8 :: a,b,wc
+    integer :: jt,it
+    jt=set_lay(kt)
+    it=set_site(kt)
+    a=a_coef(jt,it)
+    b=b_coef(jt,it)
+    unf=a*(xt**b)
+    dunf=-b*a*(xt**(b-1.0D0))
+    WC=unf/vwc(jt,it)
+    tcon=(tcon_thw(jt,it)**WC)*(tcon_frz(jt,it)**(1.0-WC))
+  end subroutine closed_forms
+
+  subroutine check_node(xt,kt)
+    real*8, intent(in) :: xt
+    integer, intent(in) :: kt
+    real*8 :: unf,dunf,tcon
+    real*8 :: ftable
+    call closed_forms(xt,kt,unf,dunf,tcon)
+    err_unf=max(err_unf,DABS(ftable(xt,kt,1)-unf)/vwc(set_lay(kt),set_site(kt)))
+    err_dunf=max(err_dunf,DABS((ftable(xt,kt,2)-dunf)/dunf))
+    err_tcon=max(err_tcon,DABS((ftable(xt,kt,3)-tcon)/tcon))
+  end subroutine check_node
+
+end subroutine build_property_tables
+
+
 !________________________________________________
 !__________________FUNCTIONS_____________________
 !________________________________________________
@@ -653,6 +2036,9 @@ real*8 function funf_water(T,NNN,I)
   real*8 :: a,b,e
   real*8 :: theta
 
+  ! Functions
+  real*8 :: ftable
+
   temp_dep=temp_frz(NNN,I) ! change I to k0 everywhere except temp_dep
   e=EE(NNN,I)
   theta=vwc(NNN,I)
@@ -660,6 +2046,12 @@ real*8 function funf_water(T,NNN,I)
   b=b_coef(NNN,I)
 
   IF(T.LE.temp_dep-e)THEN
+    if (n_tbl_sub.GT.0) then
+      if (DABS(T).GE.tbl_t_small.AND.DABS(T).LT.tbl_t_big) then
+        funf_water=ftable(DABS(T),tbl_set(NNN,I),1)
+        return
+      endif
+    endif
     funf_water=a*((DABS(T))**b)
   ELSEIF(T.GT.temp_dep)THEN
     funf_water=theta
@@ -683,12 +2075,21 @@ real*8 function fsat_unf_water(T,NNN,I)!Saturated unfrozen water
   real*8 :: a,b,e
   real*8 :: theta
 
+  ! Functions
+  real*8 :: ftable
+
   temp_dep=temp_frz(NNN,I) ! freezing temperature depression
   e=EE(NNN,I)
   theta=vwc(NNN,I)
   a=a_coef(NNN,I)
   b=b_coef(NNN,I)
   IF(T.LE.temp_dep-e)THEN
+    if (n_tbl_sub.GT.0) then
+      if (DABS(T).GE.tbl_t_small.AND.DABS(T).LT.tbl_t_big) then
+        fsat_unf_water=ftable(DABS(T),tbl_set(NNN,I),1)/theta
+        return
+      endif
+    endif
     fsat_unf_water=a*((DABS(T))**b)
   ELSEIF(T.GT.temp_dep)THEN
     fsat_unf_water=theta
@@ -713,6 +2114,9 @@ real*8 function fdunf_water(T,NNN,I)
   real*8 :: a,b,e
   real*8 :: theta
 
+  ! Functions
+  real*8 :: ftable
+
   temp_dep=temp_frz(NNN,I)
   e=EE(NNN,I)
   theta=vwc(NNN,I)
@@ -720,6 +2124,12 @@ real*8 function fdunf_water(T,NNN,I)
   b=b_coef(NNN,I)
 
   if(T.LE.temp_dep-e)THEN
+    if (n_tbl_sub.GT.0) then
+      if (DABS(T).GE.tbl_t_small.AND.DABS(T).LT.tbl_t_big) then
+        fdunf_water=ftable(DABS(T),tbl_set(NNN,I),2)
+        return
+      endif
+    endif
     fdunf_water=-b*a*((DABS(T))**(b-1.0D0))
   elseif(T.GT.temp_dep)THEN
     fdunf_water=0.0D0
@@ -732,6 +2142,25 @@ real*8 function fdunf_water(T,NNN,I)
 end function fdunf_water
 
 
+!-----------------------------------------------
+real*8 function ftable(X,K,IPROP)
+  ! Property IPROP of table K at |T|=X, see build_property_tables
+  use thermo
+  implicit none
+  real*8, intent(in) :: X
+  integer, intent(in) :: K, IPROP
+  real*8 :: p
+  integer :: io, j
+
+  io=exponent(X)
+  p=(fraction(X)-0.5D0)*DBLE(2*n_tbl_sub)
+  j=min(INT(p),n_tbl_sub-1)
+  ftable=prop_tbl(j,io,K,IPROP)+(p-DBLE(j))* &
+    (prop_tbl(j+1,io,K,IPROP)-prop_tbl(j,io,K,IPROP))
+  return
+end function ftable
+
+
 !----------------------------------------
 real*8 function futemp(T,I)
   use gipl_bmi
@@ -771,34 +2200,235 @@ end subroutine snowfix
 !----------------------------------------
 subroutine interpolate(XIN,YIN,NIN,XOUT,YOUT,n_itime)
 ! Linear interpolation
+! XIN and XOUT must be increasing
   implicit none
   real*8, intent(in) :: XIN(NIN),YIN(NIN)
-  real*8, intent(out) :: XOUT(n_itime),YOUT(n_itime)
+  real*8, intent(in) :: XOUT(n_itime)
+  real*8, intent(out) :: YOUT(n_itime)
   integer :: NIN,n_itime
-  integer :: i, j
+  integer :: IDX(n_itime)
+  integer :: cursor
+
+  cursor=0
+  call locate_intervals(XIN,NIN,XOUT,IDX,n_itime,cursor)
+  call interpolate_at(XIN,YIN,NIN,XOUT,IDX,YOUT,n_itime)
+  return
+end
+
 
+!----------------------------------------
+subroutine locate_intervals(XIN,NIN,XOUT,IDX,n_itime,cursor)
+! Find the interval of XIN that holds each point of XOUT:
+! IDX(I)=J where XIN(J)<XOUT(I)<=XIN(J+1), 0 where XOUT(I)<=XIN(1) and
+! NIN where XOUT(I)>XIN(NIN).  XIN and XOUT must be increasing.
+! The search walks forward from the interval of the previous point, and
+! for the first point from cursor, the interval of the first point of the
+! previous call.  It falls back to a binary search if XOUT went back.
+  implicit none
+  integer, intent(in) :: NIN,n_itime
+  real*8, intent(in) :: XIN(NIN)
+  real*8, intent(in) :: XOUT(n_itime)
+  integer, intent(out) :: IDX(n_itime)
+  integer, intent(inout) :: cursor
+  integer :: i, j, lo, hi, mid
+
+  J=cursor
   do I=1,n_itime
     if(XOUT(I).LE.XIN(1))THEN
-      YOUT(I)=YIN(1)
-      GOTO 1
+      IDX(I)=0
     elseif(XOUT(I).GT.XIN(NIN))THEN
+      IDX(I)=NIN
+    else
+      if (J.LT.1 .OR. J.GT.NIN-1) then
+        J=0
+      elseif (XIN(J).GE.XOUT(I)) then
+        J=0
+      endif
+      if (J.EQ.0) then
+        ! XIN(lo)<XOUT(I)<=XIN(hi)
+        lo=1
+        hi=NIN
+        do while (hi-lo.GT.1)
+          mid=(lo+hi)/2
+          if (XIN(mid).LT.XOUT(I)) then
+            lo=mid
+          else
+            hi=mid
+          endif
+        enddo
+        J=lo
+      else
+        do while (XIN(J+1).LT.XOUT(I))
+          J=J+1
+        enddo
+      endif
+      IDX(I)=J
+    endif
+  enddo
+  if (n_itime.GT.0) cursor=IDX(1)
+  return
+end subroutine locate_intervals
+
+
+!----------------------------------------
+subroutine interpolate_at(XIN,YIN,NIN,XOUT,IDX,YOUT,n_itime)
+! Linear interpolation in the intervals IDX found by locate_intervals
+  implicit none
+  integer, intent(in) :: NIN,n_itime
+  real*8, intent(in) :: XIN(NIN),YIN(NIN)
+  real*8, intent(in) :: XOUT(n_itime)
+  integer, intent(in) :: IDX(n_itime)
+  real*8, intent(out) :: YOUT(n_itime)
+  integer :: i, j
+
+  do I=1,n_itime
+    J=IDX(I)
+    if(J.EQ.0)THEN
+      YOUT(I)=YIN(1)
+    elseif(J.EQ.NIN)THEN
       YOUT(I)=YIN(NIN)
-      GOTO 1
     else
-      do J=1,NIN-1
-        if (XIN(J).LT.XOUT(I).AND.XOUT(I).LE.XIN(J+1))THEN
-          YOUT(I)=YIN(J)+(XOUT(I)-XIN(J))*(YIN(J+1)-YIN(J))/(XIN(J+1)-XIN(J))
-          GOTO 1
-        endif
-      enddo
+      YOUT(I)=YIN(J)+(XOUT(I)-XIN(J))*(YIN(J+1)-YIN(J))/(XIN(J+1)-XIN(J))
     endif
-1   continue
   enddo
   return
-end
+end subroutine interpolate_at
+
+
+!----------------------------------------
+subroutine interpolate_at_single(XIN,YIN,NIN,XOUT,IDX,YOUT,n_itime)
+! As interpolate_at, for a forcing series kept in single precision
+  implicit none
+  integer, intent(in) :: NIN,n_itime
+  real*8, intent(in) :: XIN(NIN)
+  real, intent(in) :: YIN(NIN)
+  real*8, intent(in) :: XOUT(n_itime)
+  integer, intent(in) :: IDX(n_itime)
+  real*8, intent(out) :: YOUT(n_itime)
+  integer :: i, j
+
+  do I=1,n_itime
+    J=IDX(I)
+    if(J.EQ.0)THEN
+      YOUT(I)=DBLE(YIN(1))
+    elseif(J.EQ.NIN)THEN
+      YOUT(I)=DBLE(YIN(NIN))
+    else
+      YOUT(I)=DBLE(YIN(J))+(XOUT(I)-XIN(J))*(DBLE(YIN(J+1))-DBLE(YIN(J)))/&
+        (XIN(J+1)-XIN(J))
+    endif
+  enddo
+  return
+end subroutine interpolate_at_single
 
 
 !----------------------------------------
+subroutine generate_grid()
+  ! Replace the nodes of grid.txt below sea_level by a generated grid
+  !
+  ! The nodes at and above sea_level (the snow) and the bottom node are
+  ! kept.  From sea_level down, the spacing starts at grid_dz_min and grows
+  ! by the factor grid_stretch from node to node, up to grid_dz_front as
+  ! far as frz_frn_max, where the freezing fronts are searched, and without
+  ! a limit below.  The depths of the output nodes zdepth_id, frz_frn_min
+  ! and frz_frn_max are nodes of the generated grid: a node that would come
+  ! closer than half a spacing to one of them is moved onto it.  zdepth_id
+  ! is renumbered to the same depths.
+  use gipl_bmi
+  use grd
+  use thermo
+  use bnd
+
+  implicit none
+
+  real*8, allocatable :: anchor(:), z_new(:), z_out(:)
+  real*8 :: z_bot, z, step
+  integer :: n_anchor, n_new, n_max, i_grd, i_anchor, j
+
+  z_bot = zdepth(n_grd)
+  allocate(z_out(m_grd))
+  z_out = zdepth(zdepth_id)
+
+  ! The depths the grid must hold below sea_level, in increasing order
+  allocate(anchor(m_grd+3))
+  n_anchor = 0
+  call add_anchor(frz_frn_min)
+  call add_anchor(frz_frn_max)
+  do j=1,m_grd
+    call add_anchor(z_out(j))
+  enddo
+  call add_anchor(z_bot)
+
+  n_max = n_grd + n_anchor + int((z_bot - sea_level) / grid_dz_min) + 1
+  allocate(z_new(n_max))
+  n_new = 0
+  do i_grd=1,n_grd
+    if (zdepth(i_grd) .GT. sea_level) exit
+    n_new = n_new + 1
+    z_new(n_new) = zdepth(i_grd)
+  enddo
+  if (n_new .EQ. 0) then
+    print*, 'generate_grid: the grid file has no nodes at or above', &
+      ' sea_level ', sea_level
+    stop
+  endif
+
+  z = z_new(n_new)
+  step = grid_dz_min
+  i_anchor = 1
+  do while (z .LT. z_bot)
+    if (z + 1.5D0*step .GE. anchor(i_anchor)) then
+      z = anchor(i_anchor)
+      i_anchor = i_anchor + 1
+    else
+      z = z + step
+    endif
+    n_new = n_new + 1
+    z_new(n_new) = z
+    if (z .LT. frz_frn_max) then
+      step = min(step*grid_stretch, max(grid_dz_front, grid_dz_min))
+    else
+      step = step*grid_stretch
+    endif
+  enddo
+
+  print*, 'generate_grid: ', n_new, ' nodes instead of the ', n_grd, &
+    ' of the grid file'
+
+  n_grd = n_new
+  deallocate(zdepth)
+  allocate(zdepth(n_grd))
+  zdepth = z_new(1:n_grd)
+  do j=1,m_grd
+    do i_grd=1,n_grd
+      if (zdepth(i_grd) .EQ. z_out(j)) then
+        zdepth_id(j) = i_grd
+        exit
+      endif
+    enddo
+  enddo
+
+contains
+
+  subroutine add_anchor(depth)
+    ! Insert a depth below sea_level and above the bottom into anchor,
+    ! keeping anchor increasing and free of repeats
+    real*8, intent(in) :: depth
+    integer :: i
+
+    if (depth .LE. sea_level .OR. depth .GT. z_bot) return
+    do i=1,n_anchor
+      if (anchor(i) .EQ. depth) return
+      if (anchor(i) .GT. depth) exit
+    enddo
+    anchor(i+1:n_anchor+1) = anchor(i:n_anchor)
+    anchor(i) = depth
+    n_anchor = n_anchor + 1
+  end subroutine add_anchor
+
+end subroutine generate_grid
+
+
 subroutine assign_layer_id(n_lay,n_lay_cur,n_site,n_grd,zdepth,n_bnd_lay,lay_id)
   !assigns correspond layer id to the grid point
   !starting from surface to the bottom
@@ -863,6 +2493,7 @@ real*8 function ftcon(T,id,j,time_cur)
   ! Define types for functions
   real*8 :: fsnow_level
   real*8 :: funf_water
+  real*8 :: ftable
 
   gr_sur=sea_level
   dsnow=sea_level-fsnow_level(id,time_cur)
@@ -877,6 +2508,17 @@ real*8 function ftcon(T,id,j,time_cur)
       (stcon_i(II+1,id)-stcon_i(II,id))/(utemp_time_i(II+1)-utemp_time_i(II))
   else
     !ground
+    if (n_tbl_sub.GT.0) then
+      if (T.GT.temp_frz(NS,id)) then
+        ! Thawed, funf_water(T)=vwc
+        ftcon=tcon_thw(NS,id)
+        return
+      elseif (T.LE.temp_frz(NS,id)-EE(NS,id).AND.DABS(T).GE.tbl_t_small &
+              .AND.DABS(T).LT.tbl_t_big) then
+        ftcon=ftable(DABS(T),tbl_set(NS,id),3)
+        return
+      endif
+    endif
     WC=funf_water(T,NS,id)/vwc(NS,id)
     ftcon=(tcon_thw(NS,id)**WC)*(tcon_frz(NS,id)**(1.0-WC))
   endif
@@ -920,13 +2562,39 @@ end function fhcap
 !----------------------------------------
 real*8 function fapp_hcap(T,I,J,n_grd_passed)       ! Apparent heat capacity
   use gipl_bmi
-  use thermo
-  use grd
 
   implicit none
 
   integer :: n_grd_passed
   real*8, dimension(n_grd_passed) :: T
+  integer :: i, j
+  real*8 :: TM, TP
+
+  ! Functions
+  real*8 :: fapp_hcap_node
+
+  ! Neighbours outside the column are not used by fapp_hcap_node
+  TM=T(J)
+  TP=T(J)
+  if(J.GT.1)TM=T(J-1)
+  if(J.LT.n_grd)TP=T(J+1)
+  fapp_hcap=fapp_hcap_node(TM,T(J),TP,I,J)
+
+  return
+end
+
+
+!----------------------------------------
+real*8 function fapp_hcap_node(TM,T0,TP,I,J) ! Apparent heat capacity
+  ! Apparent heat capacity at node J of site I, from the temperatures
+  ! at nodes J-1 (TM), J (T0) and J+1 (TP)
+  use gipl_bmi
+  use thermo
+  use grd
+
+  implicit none
+
+  real*8 :: TM, T0, TP
   real*8, dimension(2) :: WW
   integer, dimension(2) :: NN
 
@@ -942,33 +2610,33 @@ real*8 function fapp_hcap(T,I,J,n_grd_passed)       ! Apparent heat capacity
   li=lay_id(I,J)                      ! layer index
   gr_sur=sea_level                    ! ground surface
   if(zdepth(J).lE.gr_sur)then
-    fapp_hcap=hcap_s                  ! heat capacity for snow
+    fapp_hcap_node=hcap_s             ! heat capacity for snow
   else
-    WC=funf_water(T(J),li,I)/vwc(li,I)
-    fapp_hcap=hcap_thw(li,I)*WC+hcap_frz(li,I)*(1.0-WC)
+    WC=funf_water(T0,li,I)/vwc(li,I)
+    fapp_hcap_node=hcap_thw(li,I)*WC+hcap_frz(li,I)*(1.0-WC)
     if(J.GT.(1).AND.J.LT.n_grd)then
-      WW(1)=(T(J-1)+T(J))/2.D0
+      WW(1)=(TM+T0)/2.D0
       NN(1)=lay_id(I,J-1)
-      WW(2)=T(J)
+      WW(2)=T0
       NN(2)=lay_id(I,J)
-      fapp_hcap=fapp_hcap+fhcap(WW,NN,I)*dz(J)/(dz(J+1)+dz(J))
-      WW(1)=T(J)
+      fapp_hcap_node=fapp_hcap_node+fhcap(WW,NN,I)*dz(J)/(dz(J+1)+dz(J))
+      WW(1)=T0
       NN(1)=lay_id(I,J)
-      WW(2)=(T(J+1)+T(J))/2.D0
+      WW(2)=(TP+T0)/2.D0
       NN(2)=lay_id(I,J+1)
-      fapp_hcap=fapp_hcap+fhcap(WW,NN,I)*dz(J+1)/(dz(J+1)+dz(J))
+      fapp_hcap_node=fapp_hcap_node+fhcap(WW,NN,I)*dz(J+1)/(dz(J+1)+dz(J))
     elseif(J.EQ.1)then
-      WW(1)=T(J)
+      WW(1)=T0
       NN(1)=lay_id(I,J)
-      WW(2)=(T(J+1)+T(J))/2.D0
+      WW(2)=(TP+T0)/2.D0
       NN(2)=lay_id(I,J+1)
-      fapp_hcap=fapp_hcap+fhcap(WW,NN,I)
+      fapp_hcap_node=fapp_hcap_node+fhcap(WW,NN,I)
     elseif(J.EQ.n_grd)then
-      WW(1)=(T(J-1)+T(J))/2.D0
+      WW(1)=(TM+T0)/2.D0
       NN(1)=lay_id(I,J-1)
-      WW(2)=T(J)
+      WW(2)=T0
       NN(2)=lay_id(I,J)
-      fapp_hcap=fapp_hcap+fhcap(WW,NN,I)
+      fapp_hcap_node=fapp_hcap_node+fhcap(WW,NN,I)
     endif
   endif
 
@@ -980,29 +2648,22 @@ end
 subroutine stefan1D(temps,dz, isite,lay_idx,flux, nn_grd)
 
   use gipl_bmi
-  use thermo
   use bnd
   use gipl_const
+  use prof
 
   implicit none
 
   integer, intent(in) :: nn_grd
   real*8, intent(in) :: dz(nn_grd)
-  real*8, intent(inout) :: temps(nn_grd)
+  real*8, intent(inout) :: temps(nn_grd)            ! temp(isite,:), passed as a contiguous copy
   integer, intent(in) :: lay_idx(nn_grd)
-  real*8 :: futemp,flux,fapp_hcap,ftcon,fsat_unf_water
-
-  integer :: isite,i_grd,IT
+  real*8 :: flux
 
-! tridiagonal variables
-  real*8 :: RAB1,RAB2,AKAPA2,AMU2,Q2
-  real*8 :: A,B,C,D
-  real*8 :: ALF(nn_grd),BET(nn_grd)
-  real*8 :: EEY,EEY1,abs1,abs2
+  integer :: isite,n_iter
+  logical :: converged
 
-  ! old temperature before tridiagonal method
-  real*8 :: temp_o(nn_grd)
-  ! new temperature after tridiagonal method
+  ! new temperature after the Picard iterations
   real*8 :: temp_n(nn_grd)
 
 ! time counter internal to this subroutine
@@ -1011,22 +2672,286 @@ subroutine stefan1D(temps,dz, isite,lay_idx,flux, nn_grd)
   real*8 :: timei                     ! main subroutine timer
   real :: time_swith                  ! for timei
 
+! counters for profile_step
+  integer :: n_sweep,n_halving
+  real*8 :: timei_min,t_start
+  real*8 :: wall_seconds
+
+  if (profile.GT.0) t_start=wall_seconds()
+  n_sweep=0
+  n_halving=0
   time_l=time_loop
   time_swith=-1.0
   timei=TAUM
-  temps=temp(isite,:)
+  timei_min=timei
 64 continue
+  timei_min=min(timei_min,timei)
   time_p=time_l+timei
+  call stefan_solve(temps,temp_n,dz,isite,lay_idx,flux,nn_grd,time_p,timei, &
+    n_iter,converged)
+  n_sweep=n_sweep+n_iter
+  if(.not.converged) then
+    timei=timei/2.D0
+    time_swith=-1.0
+    n_halving=n_halving+1
+    GOTO 64
+  endif
+
+  if(time_p.LT.time_loop+time_step-1.D-12)then
+    time_l=time_p
+    temps=temp_n
+    if(time_swith>0) then
+      if(timei.LT.TAUM) then
+        timei=timei*2.D0
+        time_swith=-1.0
+      endif
+    else
+      time_swith=1.0
+    endif
+    GOTO 64
+  elseif(time_p.GT.time_loop+time_step+1.D-12)then
+    timei=(time_loop+time_step-time_l)
+    goto 64
+  else
+    temps=temp_n
+  endif
+
+  if (profile.GT.0) then
+    call profile_step(isite,n_sweep,n_halving,timei_min,wall_seconds()-t_start)
+  endif
+
+end subroutine stefan1D
+
+
+subroutine stefan1D_adaptive(temps,dz, isite,lay_idx,flux, nn_grd)
+
+  ! Advances one site over a timestep like stefan1D, with sub-steps longer
+  ! than TAUM where step doubling shows them to be accurate (step_control=1).
+  ! Sub-steps up to TAUM are taken as in stefan1D: halved when the Picard
+  ! iterations do not converge, doubled after two that do.  After n_wait
+  ! sub-steps at TAUM, a sub-step twice as long is tried, once as two
+  ! halves and once at full length.  The largest difference of the two
+  ! profiles estimates the local error of the full step; when it is within
+  ! step_tolerance the two-half profile is kept and the next sub-step is
+  ! scaled by 0.9*sqrt(step_tolerance/error), by at most a factor 2, the
+  ! local error of the implicit scheme growing as the square of the
+  ! sub-step.  Otherwise the site goes back to TAUM, keeping the two halves
+  ! if only the full step failed to converge, and waits twice as many
+  ! sub-steps before the next try.  The sub-step is carried over to the
+  ! next timestep in timei_site, so quiet periods are crossed in a few
+  ! long sub-steps.
+  !
+  ! A long sub-step takes three solves, each with more Picard iterations
+  ! than one at TAUM, so it only saves work when it is several times TAUM
+  ! long.  With a TAUM of 0.1 and a timestep of 1 that is rare, and this is
+  ! slower than stefan1D.  With a TAUM well below 0.1 it saves time, but no
+  ! more than stefan1D with a larger TAUM for the same accuracy (see the
+  ! README).
+
+  use gipl_bmi
+  use bnd
+  use gipl_const
+  use prof
+
+  implicit none
+
+  integer, intent(in) :: nn_grd
+  real*8, intent(in) :: dz(nn_grd)
+  real*8, intent(inout) :: temps(nn_grd)            ! temp(isite,:), passed as a contiguous copy
+  integer, intent(in) :: lay_idx(nn_grd)
+  real*8 :: flux
+
+  integer :: isite,n_iter
+  logical :: converged
+
+  ! profiles after one full and after two half sub-steps
+  real*8 :: temp_full(nn_grd),temp_half(nn_grd),temp_n(nn_grd)
+
+  real*8 :: time_l                    ! loop time in a subroutine
+  real*8 :: time_stop                 ! end of the timestep
+  real*8 :: timei                     ! sub-step taken
+  real*8 :: timei_next                ! sub-step proposed for the next one
+  real*8 :: timei_long                ! the same after a long sub-step
+  real :: time_swith                  ! for timei
+  integer :: n_calm,n_wait            ! sub-steps at TAUM, and before a long one
+  real*8 :: error,factor
+
+! counters for profile_step
+  integer :: n_sweep,n_halving
+  real*8 :: timei_min,t_start
+  real*8 :: wall_seconds
+
+  if (profile.GT.0) t_start=wall_seconds()
+  n_sweep=0
+  n_halving=0
+  time_l=time_loop
+  time_stop=time_loop+time_step
+  time_swith=-1.0
+  n_calm=0
+  n_wait=2
+  timei_next=min(max(timei_site(isite),TMIN),time_step)
+  timei_min=timei_next
+
+  do while (time_l.LT.time_stop-1.D-12)
+    timei=min(timei_next,time_stop-time_l)
+    timei_min=min(timei_min,timei)
+
+    if(timei.GT.TAUM) then
+      ! a long sub-step, checked by step doubling
+      call stefan_solve(temps,temp_half,dz,isite,lay_idx,flux,nn_grd, &
+        time_l+timei/2.D0,timei/2.D0,n_iter,converged)
+      n_sweep=n_sweep+n_iter
+      if(converged) then
+        call stefan_solve(temp_half,temp_n,dz,isite,lay_idx,flux,nn_grd, &
+          time_l+timei,timei/2.D0,n_iter,converged)
+        n_sweep=n_sweep+n_iter
+      endif
+      if(.not.converged) then
+        timei_next=TAUM
+        n_wait=2*n_wait
+        n_halving=n_halving+1
+        cycle
+      endif
+      call stefan_solve(temps,temp_full,dz,isite,lay_idx,flux,nn_grd, &
+        time_l+timei,timei,n_iter,converged)
+      n_sweep=n_sweep+n_iter
+      if(converged) then
+        error=maxval(DABS(temp_n-temp_full))
+      else
+        error=huge(error)
+      endif
+
+      if(error.LE.step_tolerance) then
+        if(error.GT.0.D0) then
+          factor=min(0.9D0*sqrt(step_tolerance/error),2.D0)
+        else
+          factor=2.D0
+        endif
+        timei_long=min(max(timei*factor,TAUM),time_step)
+        if(timei.LT.timei_next) then
+          ! a sub-step cut short by the end of the timestep says little
+          ! about the next one
+          timei_next=max(timei_next,timei_long)
+        else
+          timei_next=timei_long
+        endif
+      elseif(converged) then
+        ! too long, go back to TAUM
+        timei_next=TAUM
+        n_wait=2*n_wait
+        n_halving=n_halving+1
+        cycle
+      else
+        ! the full sub-step did not converge, keep the two halves
+        timei_next=TAUM
+        n_wait=2*n_wait
+        n_halving=n_halving+1
+      endif
+      time_l=time_l+timei
+      temps=temp_n
+      time_swith=-1.0
+    else
+      ! as in stefan1D
+      call stefan_solve(temps,temp_n,dz,isite,lay_idx,flux,nn_grd, &
+        time_l+timei,timei,n_iter,converged)
+      n_sweep=n_sweep+n_iter
+      if(.not.converged) then
+        timei_next=timei/2.D0
+        time_swith=-1.0
+        n_calm=0
+        n_halving=n_halving+1
+        cycle
+      endif
+      time_l=time_l+timei
+      temps=temp_n
+      if(timei.GE.TAUM) n_calm=n_calm+1
+      if(timei.LT.timei_next) then
+        ! cut short by the end of the timestep
+        continue
+      elseif(timei.GE.TAUM) then
+        if(n_calm.GE.n_wait) then
+          timei_next=min(TAUM*2.D0,time_step)
+          n_calm=0
+        endif
+      elseif(time_swith>0) then
+        timei_next=min(timei*2.D0,TAUM)
+        time_swith=-1.0
+      else
+        time_swith=1.0
+      endif
+    endif
+  enddo
+  timei_site(isite)=timei_next
+
+  if (profile.GT.0) then
+    call profile_step(isite,n_sweep,n_halving,timei_min,wall_seconds()-t_start)
+  endif
+
+end subroutine stefan1D_adaptive
+
+
+subroutine step_control_start()
+  ! The sub-steps of stefan1D_adaptive start from TAUM, also when
+  ! step_control is set after initialize
+  use gipl_bmi
+  use bnd
+
+  implicit none
+
+  if (.not. allocated(timei_site)) then
+    allocate(timei_site(n_site))
+    timei_site = TAUM
+  endif
+
+end subroutine step_control_start
+
+
+subroutine stefan_solve(temps,temp_n,dz,isite,lay_idx,flux,nn_grd,time_p,timei, &
+  n_iter,converged)
+
+  ! Takes one sub-step of length timei, ending at time_p, from the profile
+  ! temps to temp_n: Picard iterations of the implicit scheme, each solved
+  ! by the tridiagonal method, until the unfrozen water content and the
+  ! temperatures settle.  converged is .false. when this takes more than
+  ! ITMAX iterations; n_iter is the number of iterations done.
+
+  use gipl_bmi
+  use thermo
+  use bnd
+  use gipl_const
+
+  implicit none
+
+  integer, intent(in) :: nn_grd
+  real*8, intent(in) :: dz(nn_grd)
+  real*8, intent(in) :: temps(nn_grd)
+  real*8, intent(out) :: temp_n(nn_grd)
+  integer, intent(in) :: lay_idx(nn_grd)
+  real*8, intent(in) :: time_p,timei
+  integer, intent(out) :: n_iter
+  logical, intent(out) :: converged
+  real*8 :: futemp,flux,fapp_hcap,ftcon,fsat_unf_water
+
+  integer :: isite,i_grd,IT
+
+! tridiagonal variables
+  real*8 :: RAB1,RAB2,AKAPA2,AMU2,Q2
+  real*8 :: A,B,C,D
+  real*8 :: ALF(nn_grd),BET(nn_grd)
+  real*8 :: EEY,EEY1,abs1,abs2
+
+  ! old temperature before tridiagonal method
+  real*8 :: temp_o(nn_grd)
+
   temp_o=temps
   IT=1
+  n_iter=0
+  converged=.false.
   ALF(2)=0.D0
   BET(2)=futemp(time_p,isite)
 22 continue
-  if(IT.GT.ITMAX) then
-    timei=timei/2.D0
-    time_swith=-1.0
-    GOTO 64
-  endif
+  if(IT.GT.ITMAX) return
+  n_iter=n_iter+1
 
   do i_grd=2,n_grd-1
     D=fapp_hcap(temp_o,isite,i_grd,n_grd)/timei
@@ -1077,29 +3002,27 @@ subroutine stefan1D(temps,dz, isite,lay_idx,flux, nn_grd)
       endif
     enddo
   endif
+  converged=.true.
 
-  if(time_p.LT.time_loop+time_step-1.D-12)then
-    time_l=time_p
-    temps=temp_n
-    if(time_swith>0) then
-      if(timei.LT.TAUM) then
-        timei=timei*2.D0
-        time_swith=-1.0
-      endif
-    else
-      time_swith=1.0
-    endif
-    GOTO 64
-  elseif(time_p.GT.time_loop+time_step+1.D-12)then
-    timei=(time_loop+time_step-time_l)
-    goto 64
-  else
-    temps=temp_n
-  endif
+end subroutine stefan_solve
 
-end subroutine stefan1D
+
+subroutine check_forcing_sites(forcing_name, n_forcing_sites)
+  ! Stop if a forcing series given by set_forcing has the wrong number of sites
+  use gipl_bmi
+  implicit none
+  character(*) :: forcing_name
+  integer :: n_forcing_sites
+
+  if (n_forcing_sites .ne. n_site) then
+    print*, 'The ', forcing_name, ' forcing has ', n_forcing_sites, &
+      ' sites, but the sites file has ', n_site
+    stop
+  endif
+end subroutine check_forcing_sites
 
 
+!----------------------------------------
 subroutine filexist(filename)
   implicit none
   character(64) :: filename
@@ -30,12 +30,299 @@ subroutine update_until(target_time)
 end subroutine update_until
 
 
+subroutine update_until_record(target_time, codes, buffer, n_codes, n_values, &
+    n_steps, n_done)
+  ! Advance the model towards target_time as update_until does, and after
+  ! every step copy the variables listed in codes (see record_values) into
+  ! the next column of buffer.  Stops early when buffer is full; n_done
+  ! returns the number of steps taken.
+  use gipl_bmi
+
+  implicit none
+
+  real*8, intent(in) :: target_time
+  integer, intent(in) :: n_codes, n_values, n_steps
+  integer, intent(in) :: codes(n_codes)
+  real*8, intent(inout) :: buffer(n_values, n_steps)
+  integer, intent(out) :: n_done
+
+  n_done = 0
+  do while (time_loop .lt. target_time .and. n_done .lt. n_steps)
+    call update_model()
+    n_done = n_done + 1
+    call record_values(codes, n_codes, buffer(:, n_done), n_values)
+  enddo
+
+end subroutine update_until_record
+
+
+subroutine record_values(codes, n_codes, column, n_values)
+  ! Copy the current values of the variables listed in codes into column,
+  ! one after the other, each in Fortran order:
+  !   0  time_loop
+  !   1  temp                          (site, depth)
+  !   2  temp at the zdepth_id depths  (site, selected depth)
+  !   3  air temperature of the step   (site), as monthly_freeze_up_temp
+  !   4  snow level of the step        (site), as monthly_snow_level
+  !   5  depth of the upper freezing front of the step (site)
+  use gipl_bmi
+  use grd
+  use alt
+
+  implicit none
+
+  integer, intent(in) :: n_codes, n_values
+  integer, intent(in) :: codes(n_codes)
+  real*8, intent(out) :: column(n_values)
+  integer :: i, k, n, i_site
+
+  k = 0
+  do i = 1, n_codes
+    select case (codes(i))
+    case (0)
+      n = 1
+    case (1)
+      n = n_site * n_grd
+    case (2)
+      n = n_site * m_grd
+    case (3:5)
+      n = n_site
+    case default
+      print*, 'No recorded variable with code: ', codes(i)
+      stop
+    end select
+    if (k + n .gt. n_values) then
+      print*, 'The record buffer has ', n_values, ' values per step, too few'
+      stop
+    endif
+
+    select case (codes(i))
+    case (0)
+      column(k+1) = time_loop
+    case (1)
+      column(k+1:k+n) = reshape(temp, (/ n /))
+    case (2)
+      column(k+1:k+n) = reshape(temp(:, zdepth_id), (/ n /))
+    case (3)
+      do i_site = 1, n_site
+        column(k+i_site) = monthly_freeze_up_temp(i_site, i_time(i_site))
+      enddo
+    case (4)
+      do i_site = 1, n_site
+        column(k+i_site) = monthly_snow_level(i_site, i_time(i_site))
+      enddo
+    case (5)
+      do i_site = 1, n_site
+        column(k+i_site) = z_frz_frn(i_time(i_site), 1, i_site)
+      enddo
+    end select
+    k = k + n
+  enddo
+
+end subroutine record_values
+
+
 subroutine finalize()
   call finalize_f90()
 
 end subroutine finalize
 
 
+subroutine set_num_threads(n_threads)
+  ! Set the number of threads used by the site loops in update_model
+  ! Only has an effect in builds compiled with OpenMP (make gipl_omp)
+  !$ use omp_lib
+
+  implicit none
+
+  integer, intent(in) :: n_threads
+
+  if (n_threads .lt. 1) then
+    print*, 'set_num_threads: n_threads must be at least 1, not ', n_threads
+    return
+  endif
+  !$ call omp_set_num_threads(n_threads)
+
+end subroutine set_num_threads
+
+
+subroutine set_reductions(kinds, thresholds, fractions, steps, n_reductions, &
+    n_steps)
+  ! Replace the yearly reductions of the temperatures at the zdepth_id
+  ! depths (see reduce_step in gipl.f90), after initialize
+  !   kinds(n_reductions):      red_kind, 1 to 6
+  !   thresholds, fractions:    red_threshold and red_fraction
+  !   steps(n_steps, n_reductions): 1 for the timesteps of the year taken
+  ! The reductions start afresh with the temperatures of the current
+  ! timestep, e.g. those of the first timestep of the year after
+  ! initialize, and red_value holds -7777 until a year is complete.  A reduction file that was
+  ! written is closed, and the next write starts it anew.
+  use gipl_bmi
+  use bnd
+  use grd
+  use red
+
+  implicit none
+
+  integer, intent(in) :: n_reductions, n_steps
+  integer, intent(in) :: kinds(n_reductions)
+  real*8, intent(in) :: thresholds(n_reductions), fractions(n_reductions)
+  integer, intent(in) :: steps(n_steps, n_reductions)
+  integer :: i_site
+
+  if (n_steps .ne. n_time) then
+    print*, 'set_reductions was given ', n_steps, &
+      ' timesteps per year, but the model has ', n_time
+    stop
+  endif
+  if (any(kinds .lt. 1 .or. kinds .gt. 6)) then
+    print*, 'set_reductions: unknown kind of reduction in ', kinds
+    stop
+  endif
+
+  if (allocated(red_kind)) then
+    deallocate(red_kind, red_threshold, red_fraction, red_steps, red_count)
+    deallocate(red_acc, red_q, red_n, red_prev, red_value)
+  endif
+  close(reduction_unit)
+
+  n_red = n_reductions
+  allocate(red_kind(n_red), red_threshold(n_red), red_fraction(n_red))
+  allocate(red_steps(n_time, n_red), red_count(n_site, n_red))
+  allocate(red_acc(n_site, m_grd, n_red), red_prev(n_site, m_grd))
+  allocate(red_value(n_site, m_grd, n_red))
+  ! The P2 markers are only needed for percentiles
+  if (any(kinds .eq. 6)) then
+    allocate(red_q(5, n_site, m_grd, n_red), red_n(5, n_site, m_grd, n_red))
+  else
+    allocate(red_q(5, n_site, m_grd, 0), red_n(5, n_site, m_grd, 0))
+  endif
+
+  red_kind = kinds
+  red_threshold = thresholds
+  red_fraction = fractions
+  red_steps = steps
+  red_value = -7777.D0
+  red_prev = temp(:, zdepth_id)
+  do i_site=1,n_site
+    call reduce_reset(i_site)
+    call reduce_step(i_site, time_loop + time_restart)
+  enddo
+
+end subroutine set_reductions
+
+
+subroutine set_forcing(forcing_name, times, values, n_rec, n_sites)
+  ! Set a forcing series from arrays instead of from its input file
+  !   forcing_name:  'bound' (air temperature), 'snow' (snow depth) or
+  !                  'rsnow' (snow thermal conductivity)
+  !   times(n_rec), values(n_rec, n_sites): as the columns of the file
+  ! Before initialize, the series is used instead of the file named in
+  ! the cfg file.  After initialize, it replaces the current series and
+  ! the forcing of the current year is interpolated again.
+  use bnd
+
+  implicit none
+
+  character(64) :: forcing_name
+  integer, intent(in) :: n_rec, n_sites
+  real*8, intent(in) :: times(n_rec)
+  real*8, intent(in) :: values(n_rec, n_sites)
+
+  call store_forcing(forcing_name, times, values, n_rec, n_sites)
+  ! The interpolated arrays are allocated by initialize
+  if (allocated(utemp_time_i)) call interpolate_forcing()
+
+end subroutine set_forcing
+
+
+subroutine set_forcing_window(forcing_name, times, values, n_rec, n_sites)
+  ! As set_forcing, but the current year is not interpolated again
+  ! Used to stream the forcing: the records given must cover the times of
+  ! every year-end interpolation until the next call
+  implicit none
+
+  character(64) :: forcing_name
+  integer, intent(in) :: n_rec, n_sites
+  real*8, intent(in) :: times(n_rec)
+  real*8, intent(in) :: values(n_rec, n_sites)
+
+  call store_forcing(forcing_name, times, values, n_rec, n_sites)
+
+end subroutine set_forcing_window
+
+
+subroutine store_forcing(forcing_name, times, values, n_rec, n_sites)
+  ! Replace a forcing series, see set_forcing
+  use bnd
+
+  implicit none
+
+  character(64) :: forcing_name
+  integer, intent(in) :: n_rec, n_sites
+  real*8, intent(in) :: times(n_rec)
+  real*8, intent(in) :: values(n_rec, n_sites)
+
+  if (allocated(utemp_time_i)) call check_forcing_sites(forcing_name, n_sites)
+
+  ! The values are kept in storage_precision (see read_forcing)
+  select case (forcing_name)
+  case ('bound')
+    if (allocated(utemp_time)) deallocate(utemp_time)
+    if (allocated(utemp)) deallocate(utemp)
+    if (allocated(utemp_s)) deallocate(utemp_s)
+    n_temp = n_rec
+    allocate(utemp_time(n_rec))
+    utemp_time = times
+    if (storage_precision .eq. 'single') then
+      allocate(utemp_s(n_rec, n_sites))
+      utemp_s = real(values)
+    else
+      allocate(utemp(n_rec, n_sites))
+      utemp = values
+    endif
+    utemp_cursor = 0
+    utemp_preset = .true.
+  case ('snow')
+    if (allocated(snd_time)) deallocate(snd_time)
+    if (allocated(snd)) deallocate(snd)
+    if (allocated(snd_s)) deallocate(snd_s)
+    n_snow = n_rec
+    allocate(snd_time(n_rec))
+    snd_time = times
+    if (storage_precision .eq. 'single') then
+      allocate(snd_s(n_rec, n_sites))
+      snd_s = real(values)
+    else
+      allocate(snd(n_rec, n_sites))
+      snd = values
+    endif
+    snd_cursor = 0
+    snd_preset = .true.
+  case ('rsnow')
+    if (allocated(stcon_time)) deallocate(stcon_time)
+    if (allocated(stcon)) deallocate(stcon)
+    if (allocated(stcon_s)) deallocate(stcon_s)
+    n_stcon = n_rec
+    allocate(stcon_time(n_rec))
+    stcon_time = times
+    if (storage_precision .eq. 'single') then
+      allocate(stcon_s(n_rec, n_sites))
+      stcon_s = real(values)
+    else
+      allocate(stcon(n_rec, n_sites))
+      stcon = values
+    endif
+    stcon_cursor = 0
+    stcon_preset = .true.
+  case default
+    print*, 'Unknown forcing: ', forcing_name
+    stop
+  end select
+
+end subroutine store_forcing
+
+
 subroutine get_time_step(time_step_value)
   use gipl_bmi
 
@@ -103,3 +390,161 @@ subroutine get_value(var_name, dest)
   end select
 
 end subroutine get_value
+
+
+subroutine save_state(snapshot_file)
+  ! Write the complete state of the selected instance to a binary snapshot
+  ! Every module variable listed in exchange_instance (gipl_state.f90) is
+  ! stored, so a run continued from load_state gives the same results.
+  ! The magic is followed by n_site, n_grd, m_grd and n_time, which
+  ! load_state checks against the instance.
+  use gipl_bmi
+  use gipl_state
+
+  implicit none
+
+  character(256) :: snapshot_file
+  integer :: unit
+
+  open(newunit=unit,file=trim(snapshot_file),access='stream', &
+    form='unformatted',convert='little_endian',status='replace')
+  write(unit) 'GIPL_SNP', n_site, n_grd, m_grd, n_time
+  call write_snapshot(unit)
+  close(unit)
+
+end subroutine save_state
+
+
+subroutine load_state(snapshot_file, ierr)
+  ! Replace the state of the selected instance with a snapshot written by
+  ! save_state.  The instance keeps its own configuration file name and
+  ! output files, so output continues into the files it was initialized
+  ! with.  The state is left alone, and ierr is set, when
+  !   1: the file cannot be opened
+  !   2: the file is not a GIPL snapshot
+  !   3: the instance is not initialized
+  !   4: the snapshot has other numbers of sites, grid levels, output
+  !      depths or timesteps per year than the instance
+  use gipl_bmi
+  use gipl_state
+
+  implicit none
+
+  character(256) :: snapshot_file
+  integer, intent(out) :: ierr
+  integer :: unit, status
+  character(8) :: magic
+  integer :: dims(4)
+
+  ierr = 0
+  open(newunit=unit,file=trim(snapshot_file),access='stream', &
+    form='unformatted',convert='little_endian',status='old',action='read', &
+    iostat=status)
+  if (status .ne. 0) then
+    ierr = 1
+    return
+  endif
+  read(unit,iostat=status) magic, dims
+  if (status .ne. 0 .or. magic .ne. 'GIPL_SNP') then
+    ierr = 2
+  elseif (.not. allocated(temp)) then
+    ierr = 3
+  elseif (any(dims .ne. (/ n_site, n_grd, m_grd, n_time /))) then
+    ierr = 4
+  endif
+  if (ierr .ne. 0) then
+    close(unit)
+    return
+  endif
+
+  call read_snapshot(unit)
+  close(unit)
+
+end subroutine load_state
+
+
+subroutine new_instance(handle)
+  ! Create a new, empty model instance and return its handle
+  ! The new instance is not selected
+  use gipl_state
+
+  implicit none
+
+  integer, intent(out) :: handle
+  integer :: h
+
+  call reserve_instances(1)
+
+  handle = ubound(instances, 1) + 1
+  do h = 1, ubound(instances, 1)
+    if (.not. instances(h)%in_use) then
+      handle = h
+      exit
+    endif
+  enddo
+  call reserve_instances(handle)
+
+  instances(handle)%in_use = .true.
+  instances(handle)%result_unit = first_unit + 4*handle
+  instances(handle)%aver_res_unit = first_unit + 4*handle + 1
+  instances(handle)%restart_unit = first_unit + 4*handle + 2
+  instances(handle)%reduction_unit = first_unit + 4*handle + 3
+
+end subroutine new_instance
+
+
+subroutine select_instance(handle)
+  ! Make the model instance with this handle the one that all other
+  ! routines operate on
+  use gipl_state
+
+  implicit none
+
+  integer, intent(in) :: handle
+
+  if (handle .eq. active_instance) return
+
+  call reserve_instances(0)
+  if (handle .lt. 0 .or. handle .gt. ubound(instances, 1)) then
+    print*, 'No GIPL instance with handle: ', handle
+    stop
+  endif
+  if (.not. instances(handle)%in_use) then
+    print*, 'No GIPL instance with handle: ', handle
+    stop
+  endif
+
+  call exchange_instance(instances(active_instance))
+  call exchange_instance(instances(handle))
+  active_instance = handle
+
+end subroutine select_instance
+
+
+subroutine free_instance(handle)
+  ! Release the state of a model instance
+  ! The default instance, handle 0, is never released
+  use gipl_state
+
+  implicit none
+
+  integer, intent(in) :: handle
+  type(gipl_instance) :: empty_instance
+
+  if (handle .le. 0) return
+  if (.not. allocated(instances)) return
+  if (handle .gt. ubound(instances, 1)) return
+
+  if (handle .eq. active_instance) then
+    call exchange_instance(instances(handle))
+    call exchange_instance(instances(0))
+    active_instance = 0
+  endif
+
+  close(instances(handle)%result_unit)
+  close(instances(handle)%aver_res_unit)
+  close(instances(handle)%restart_unit)
+  close(instances(handle)%reduction_unit)
+  instances(handle) = empty_instance
+
+end subroutine free_instance
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_ensemble.py
+
+Run GIPL over a large number of sites, or over a list of configuration
+files, using a pool of worker processes.
+
+See also bmi_gipl.py
+
+NOTES:
+    Regarding namespace independence:
+        Each BmiGiplMethod runs its own model instance (see the notes in
+            bmi_gipl.py), but only one instance can be active at a time,
+            so runs in one process are serialized.
+        Here the chunks of sites are run in a pool of worker processes to
+            run them in parallel.  A worker may run several chunks one
+            after the other, each with a new BmiGiplMethod that is
+            finalized when its run ends.
+
+    Regarding the split:
+        The sites in the sites file are split into contiguous chunks.  For
+            each chunk a work directory is created holding a configuration
+            file and the sites, bound, snow and rsnow files restricted to
+            the chunk's columns.  The values are copied as text, so every
+            chunk reads exactly the numbers a single run would read.
+        The initial, grid, vegetation and geo files are shared by all sites
+            and are copied unchanged.
+        Paths written to the chunk configuration files are relative to the
+            chunk directory because the Fortran code limits file names to
+            64 characters.
+
+    Regarding the merge:
+        result.txt and mean.txt are written one block per year, with the
+            sites of the block in order.  The blocks of all chunks are
+            interleaved year by year and the site number in the first
+            column is replaced by the site's index in the full sites file.
+        start.txt holds one row per grid level with one column per site,
+            so the rows of the chunks are joined side by side.
+        Only the text output is merged, so a configuration that sets
+            output_format='binary' in its &gipl_options is rejected.
+        With monthly_output=0 there is no result file, and only the mean and
+            start files are merged.
+        The chunks are run without reductions (see add_reduction in
+            bmi_gipl.py), so a reduction_file is not written.
+
+Usage:
+    python gipl_ensemble.py <config_file> [n_processes]
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import multiprocessing
+
+# bmi_gipl.py and the f2py_gipl shared object live next to this file
+_gipl_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+# Line numbers (0-based) of the entries in a GIPL configuration file
+# These follow the order of the read() calls in initialize_f90()
+_cfg_input_lines = {
+    'sites':      1,
+    'bound':      2,
+    'snow':       3,
+    'rsnow':      4,
+    'initial':    5,
+    'grid':       6,
+    'vegetation': 7,
+    'geo':        8,
+}
+
+_cfg_output_lines = {
+    'mean':   11,
+    'result': 12,
+    'start':  13,
+}
+
+_cfg_n_time_line = 24
+
+# The chunk-local names written to the chunk configuration files
+_chunk_files = {
+    'sites':      'in/sites.txt',
+    'bound':      'in/bound.txt',
+    'snow':       'in/snow.txt',
+    'rsnow':      'in/rsnow.txt',
+    'initial':    'in/initial.txt',
+    'grid':       'in/grid.txt',
+    'vegetation': 'in/vegetation.txt',
+    'geo':        'in/geo.txt',
+    'mean':       'output/mean.txt',
+    'result':     'output/result.txt',
+    'start':      'output/start.txt',
+}
+
+_chunk_cfg_name = 'gipl_config.cfg'
+
+
+def print_usage():
+    print('Usage:')
+    print('  python {} <config_file> [n_processes]'.format(sys.argv[0]))
+    print('e.g.:')
+    print('  python {} gipl_config.cfg 8'.format(sys.argv[0]))
+    print(' ')
+
+
+def read_config(cfg_filename):
+    """ Return the lines of a configuration file and the named entries """
+    with open(cfg_filename) as cfg_file:
+        lines = cfg_file.read().splitlines()
+
+    files = {}
+    for name, line_number in _cfg_input_lines.items():
+        files[name] = lines[line_number].strip()
+    for name, line_number in _cfg_output_lines.items():
+        files[name] = lines[line_number].strip()
+
+    n_time = int(lines[_cfg_n_time_line].split()[1])
+
+    return lines, files, n_time
+
+
+def read_options(lines):
+    """ Return the settings of the &gipl_options namelist of a configuration
+
+    The values are returned as strings, without quotes, keyed by the lower
+    case option names.  Options that are not given are left out.
+    """
+    # Drop the comments, then take everything from the namelist's start
+    text = ' '.join(line.split('!')[0] for line in lines)
+    start = text.lower().find('&gipl_options')
+    if start < 0:
+        return {}
+    pairs = re.findall(r"(\w+)\s*=\s*('[^']*'|\"[^\"]*\"|[^\s,/]+)",
+                       text[start + len('&gipl_options'):])
+    return dict((name.lower(), value.strip('\'"')) for name, value in pairs)
+
+
+def _read_sites(sites_filename):
+    """ Return the header and the per-site lines of a sites file """
+    with open(sites_filename) as sites_file:
+        n_site = int(sites_file.readline().split()[0])
+        site_lines = [sites_file.readline() for i_site in range(n_site)]
+    return n_site, site_lines
+
+
+def _split_columns(in_filename, chunks, out_filenames):
+    """ Write the time column plus each chunk's site columns to a file
+
+    The first line of a forcing file is the number of records, and every
+    following line is a time followed by one value per site.
+    """
+    out_files = [open(fn, 'w') for fn in out_filenames]
+    try:
+        with open(in_filename) as in_file:
+            header = in_file.readline()
+            for out_file in out_files:
+                out_file.write(header)
+            for line in in_file:
+                fields = line.split()
+                if not fields:
+                    continue
+                for (first, last), out_file in zip(chunks, out_files):
+                    out_file.write(' '.join([fields[0]] +
+                                            fields[first + 1:last + 1]))
+                    out_file.write('\n')
+    finally:
+        for out_file in out_files:
+            out_file.close()
+
+
+def split_sites(cfg_filename, n_chunks, workdir, rundir=None):
+    """ Create one work directory per chunk of sites
+
+    Returns a list of (chunk_directory, first_site, last_site) where the
+    sites are 0-based and last_site is exclusive.
+    """
+    if rundir is None:
+        rundir = os.getcwd()
+
+    lines, files, n_time = read_config(os.path.join(rundir, cfg_filename))
+
+    def in_path(name):
+        return os.path.join(rundir, files[name])
+
+    n_site, site_lines = _read_sites(in_path('sites'))
+    n_chunks = max(1, min(n_chunks, n_site))
+
+    chunks = []
+    for i_chunk in range(n_chunks):
+        first = (i_chunk * n_site) // n_chunks
+        last = ((i_chunk + 1) * n_site) // n_chunks
+        chunks.append((first, last))
+
+    chunk_dirs = []
+    for i_chunk, (first, last) in enumerate(chunks):
+        chunk_dir = os.path.join(workdir, 'chunk_{:04d}'.format(i_chunk))
+        os.makedirs(os.path.join(chunk_dir, 'in'))
+        os.makedirs(os.path.join(chunk_dir, 'output'))
+        chunk_dirs.append(chunk_dir)
+
+        with open(os.path.join(chunk_dir, _chunk_files['sites']), 'w') as f:
+            f.write(' {}\n'.format(last - first))
+            f.writelines(site_lines[first:last])
+
+        for name in ('initial', 'grid', 'vegetation', 'geo'):
+            shutil.copyfile(in_path(name),
+                            os.path.join(chunk_dir, _chunk_files[name]))
+
+        chunk_lines = list(lines)
+        for name, line_number in _cfg_input_lines.items():
+            chunk_lines[line_number] = _chunk_files[name]
+        for name, line_number in _cfg_output_lines.items():
+            chunk_lines[line_number] = _chunk_files[name]
+        with open(os.path.join(chunk_dir, _chunk_cfg_name), 'w') as f:
+            f.write('\n'.join(chunk_lines) + '\n')
+
+    for name in ('bound', 'snow', 'rsnow'):
+        _split_columns(in_path(name), chunks,
+                       [os.path.join(d, _chunk_files[name])
+                        for d in chunk_dirs])
+
+    return [(d, first, last) for d, (first, last) in zip(chunk_dirs, chunks)]
+
+
+def run_model(cfg_filename, rundir=None):
+    """ Run one GIPL configuration to its end time in this process
+
+    The file names in the configuration are relative to rundir, which
+    becomes the current directory of the process.
+    """
+    if rundir is not None:
+        os.chdir(rundir)
+
+    if _gipl_dir not in sys.path:
+        sys.path.insert(0, _gipl_dir)
+    import bmi_gipl
+
+    model = bmi_gipl.BmiGiplMethod()
+    model.initialize(cfg_filename)
+    end_time = model.get_end_time()
+    while model.get_current_time() < end_time:
+        model.update()
+    model.finalize()
+
+    return rundir
+
+
+def _run_model_star(args):
+    return run_model(*args)
+
+
+def _make_pool(processes):
+    # Each task runs and finalizes its own model instance, so the worker
+    # processes can be reused
+    return multiprocessing.Pool(processes=processes)
+
+
+def run_configs(cfg_filenames, processes=None, rundir=None):
+    """ Run several configuration files, each in its own worker process
+
+    The file names in each configuration are relative to rundir (the
+    current directory by default), as they would be for a single run.
+    Configurations that share output file names overwrite each other.
+    """
+    if rundir is None:
+        rundir = os.getcwd()
+
+    pool = _make_pool(processes)
+    try:
+        pool.map(_run_model_star,
+                 [(cfg_filename, rundir) for cfg_filename in cfg_filenames],
+                 chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _merge_blocks(chunks, filename, lines_per_site, out_filename):
+    """ Interleave the yearly blocks of several result or mean files """
+    chunk_lines = []
+    for chunk_dir, first, last in chunks:
+        with open(os.path.join(chunk_dir, filename)) as f:
+            chunk_lines.append(f.readlines())
+
+    n_years = [len(lines) // ((last - first) * lines_per_site)
+               for lines, (chunk_dir, first, last) in zip(chunk_lines, chunks)]
+    if len(set(n_years)) > 1:
+        raise ValueError(
+            'Chunks of {} hold different numbers of years: {}'.format(
+                filename, n_years))
+
+    with open(out_filename, 'w') as out_file:
+        for i_year in range(n_years[0] if n_years else 0):
+            for lines, (chunk_dir, first, last) in zip(chunk_lines, chunks):
+                block_size = (last - first) * lines_per_site
+                block = lines[i_year * block_size:(i_year + 1) * block_size]
+                for line in block:
+                    # The site number is written as (1x,I10)
+                    site = int(line[:11]) + first
+                    out_file.write(' {:10d}{}'.format(site, line[11:]))
+
+
+def _merge_columns(chunks, filename, out_filename):
+    """ Join the per-site columns of several restart files """
+    chunk_lines = []
+    for chunk_dir, first, last in chunks:
+        with open(os.path.join(chunk_dir, filename)) as f:
+            chunk_lines.append(f.read().splitlines())
+
+    with open(out_filename, 'w') as out_file:
+        # The first line is time_restart, which is the same for all chunks
+        out_file.write(chunk_lines[0][0] + '\n')
+        for rows in zip(*[lines[1:] for lines in chunk_lines]):
+            # Each list-directed value carries its own separating blanks
+            out_file.write(''.join(rows))
+            out_file.write('\n')
+
+
+def merge_outputs(chunks, n_time, out_files):
+    """ Merge the chunk outputs into the files named in out_files
+
+    Only the result, mean and start files that out_files names are merged.
+    """
+    if 'result' in out_files:
+        _merge_blocks(chunks, _chunk_files['result'], n_time,
+                      out_files['result'])
+    if 'mean' in out_files:
+        _merge_blocks(chunks, _chunk_files['mean'], 1, out_files['mean'])
+    if 'start' in out_files:
+        _merge_columns(chunks, _chunk_files['start'], out_files['start'])
+
+
+def run_ensemble(cfg_filename, processes=None, n_chunks=None, rundir=None,
+                 workdir=None, keep_workdir=False):
+    """ Split the sites of one configuration across worker processes
+
+    The merged result, mean and start files are written to the output
+    files named in the configuration, as a single run would write them.
+    Returns the names of the merged files.
+    """
+    if rundir is None:
+        rundir = os.getcwd()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if n_chunks is None:
+        n_chunks = processes
+
+    lines, files, n_time = read_config(os.path.join(rundir, cfg_filename))
+
+    options = read_options(lines)
+    output_format = options.get('output_format', 'text')
+    if output_format != 'text':
+        raise ValueError(
+            "Only text output can be merged, {} sets output_format='{}'".format(
+                cfg_filename, output_format))
+
+    made_workdir = workdir is None
+    if made_workdir:
+        workdir = tempfile.mkdtemp(prefix='gipl_ensemble_')
+
+    try:
+        chunks = split_sites(cfg_filename, n_chunks, workdir, rundir=rundir)
+
+        pool = _make_pool(processes)
+        try:
+            pool.map(_run_model_star,
+                     [(_chunk_cfg_name, chunk_dir)
+                      for chunk_dir, first, last in chunks],
+                     chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        out_files = dict((name, os.path.join(rundir, files[name]))
+                         for name in _cfg_output_lines)
+        if int(options.get('monthly_output', 1)) == 0:
+            # The chunks wrote no result files
+            del out_files['result']
+        merge_outputs(chunks, n_time, out_files)
+    finally:
+        if made_workdir and not keep_workdir:
+            shutil.rmtree(workdir)
+
+    return out_files
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print_usage()
+        sys.exit(1)
+
+    if len(sys.argv) > 2:
+        run_ensemble(sys.argv[1], processes=int(sys.argv[2]))
+    else:
+        run_ensemble(sys.argv[1])
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_forcing.py
+
+Forcing sources that stream the forcing of a GIPL run a window at a time.
+
+See also bmi_gipl.py
+
+NOTES:
+    A forcing source is given to a model with
+        BmiGiplMethod.set_forcing_source(var_name, source)
+    Before each year-end, the model asks the source for the records that
+        cover the next year's interpolation times with
+            source.window(t_first, t_last)
+        which returns (times, values), values being (n_rec, n_site).  Only
+        these records are passed to the Fortran code, so the memory used
+        there is bounded by the window, not by the length of the record.
+    A window holds the last record before t_first and the first record at
+        or after t_last, so the interpolated forcing is the same as with
+        the full record.
+
+    ArrayForcing takes arrays, which can be memory maps, e.g. of .npy files
+        written by convert_forcing_file(): only the pages of a window are
+        read.
+    GeneratorForcing takes an iterator of (times, values) chunks in time
+        order, and keeps the records from the current window on.
+
+Usage:
+    python gipl_forcing.py <forcing_file> <times.npy> <values.npy>
+        converts a bound, snow or rsnow file to .npy files for ArrayForcing
+"""
+
+from __future__ import print_function
+
+import sys
+
+import numpy as np
+
+
+class ArrayForcing(object):
+    """ A forcing source holding the times and values of the whole record """
+
+    def __init__(self, times, values):
+        self.times = times
+        self.values = values
+        if len(times) != len(values):
+            raise ValueError('{} times but {} records of values'.format(
+                len(times), len(values)))
+
+    @classmethod
+    def from_npy(cls, times_filename, values_filename):
+        """ Memory-map the times and (n_rec, n_site) values of .npy files """
+        return cls(np.load(times_filename, mmap_mode='r'),
+                   np.load(values_filename, mmap_mode='r'))
+
+    def window(self, t_first, t_last):
+        first = max(np.searchsorted(self.times, t_first, side='left') - 1, 0)
+        last = np.searchsorted(self.times, t_last, side='left') + 1
+        return (np.asarray(self.times[first:last]),
+                np.asarray(self.values[first:last]))
+
+
+class GeneratorForcing(object):
+    """ A forcing source reading (times, values) chunks from an iterator """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._times = np.zeros(0)
+        self._values = None
+        self._exhausted = False
+
+    def _read_chunk(self):
+        try:
+            times, values = next(self._chunks)
+        except StopIteration:
+            self._exhausted = True
+            return
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            values = values.reshape((-1, 1))
+        if self._values is None:
+            self._times, self._values = times, values
+        else:
+            self._times = np.concatenate((self._times, times))
+            self._values = np.concatenate((self._values, values))
+
+    def window(self, t_first, t_last):
+        while not self._exhausted and (len(self._times) == 0 or
+                                       self._times[-1] < t_last):
+            self._read_chunk()
+        if self._values is None:
+            raise ValueError('The forcing generator gave no records')
+
+        # Later windows start later, so earlier records are not needed again
+        first = max(np.searchsorted(self._times, t_first, side='left') - 1, 0)
+        self._times = self._times[first:]
+        self._values = self._values[first:]
+
+        last = np.searchsorted(self._times, t_last, side='left') + 1
+        return self._times[:last], self._values[:last]
+
+
+def convert_forcing_file(forcing_filename, times_filename, values_filename):
+    """ Write a bound, snow or rsnow file as .npy files for ArrayForcing
+
+    The file is read a line at a time into memory-mapped .npy files, so
+    the record does not need to fit in memory.
+    """
+    with open(forcing_filename) as forcing_file:
+        n_rec = int(forcing_file.readline().split()[0])
+        line = forcing_file.readline()
+        first = np.array(line.split(), dtype=np.float64)
+
+        times = np.lib.format.open_memmap(times_filename, mode='w+',
+                                          dtype=np.float64, shape=(n_rec,))
+        values = np.lib.format.open_memmap(values_filename, mode='w+',
+                                           dtype=np.float64,
+                                           shape=(n_rec, len(first) - 1))
+        times[0] = first[0]
+        values[0] = first[1:]
+        for i_rec in range(1, n_rec):
+            fields = np.array(forcing_file.readline().split(),
+                              dtype=np.float64)
+            times[i_rec] = fields[0]
+            values[i_rec] = fields[1:]
+        times.flush()
+        values.flush()
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 4:
+        print('Usage:')
+        print('  python {} <forcing_file> <times.npy> <values.npy>'.format(
+            sys.argv[0]))
+        sys.exit(1)
+
+    convert_forcing_file(sys.argv[1], sys.argv[2], sys.argv[3])
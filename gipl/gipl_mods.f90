@@ -19,10 +19,14 @@ module bnd
   integer :: n_stcon
   real*8 ,allocatable,dimension(:):: stcon_time(:)          ! snow thermal conductivity time and itself (input)
   real*8 ,allocatable,dimension(:,:):: stcon(:,:)          ! snow thermal conductivity time and itself (input)
+  character(16) :: storage_precision='double'             ! 'double' or 'single': precision of the forcing series (see read_forcing)
+  real,allocatable,dimension(:,:):: utemp_s,snd_s,stcon_s ! utemp, snd and stcon when storage_precision='single'
   real*8 ,allocatable,dimension(:,:):: snd_i (:,:)        ! snow depth and thermal conductivity (interpolated)
   real*8 ,allocatable,dimension(:,:):: stcon_i (:,:)        ! snow depth and thermal conductivity (interpolated)
   real*8 :: TINIR
   real*8 :: time_restart                                  ! restart time in restart file
+  integer :: utemp_cursor=0,snd_cursor=0,stcon_cursor=0   ! forcing interval of the first interpolation time (see locate_intervals)
+  logical :: utemp_preset=.false.,snd_preset=.false.,stcon_preset=.false. ! forcing given by set_forcing, its file is not read
 
 
 ! Parameter read from cmd file
@@ -34,6 +38,15 @@ module bnd
   ! time_beg and time_end are not in gipl_bmi module
   !real*8 :: time_beg,time_end                            ! inbegin time, end time
   integer :: itmax                                       ! maximum number of iterations in Stefan subroutine
+  integer :: step_control=0                              ! sub-step control (0: TAUM with halving/doubling, 1: step doubling, see stefan1D_adaptive; only pays off with TAUM well below 0.1)
+  real*8 :: step_tolerance=0.02D0                        ! largest local temperature error of a sub-step for step_control=1 [C]
+  real*8,allocatable,dimension(:):: timei_site           ! next sub-step of each site for step_control=1
+  integer :: site_dedup=0                                ! 1: solve one site of each group of identical sites (see group_sites)
+  real*8 :: dedup_tolerance=0.D0                         ! largest forcing difference of the sites of a group (0: equal forcing)
+  logical :: sites_grouped=.false.                       ! the groups are those of the current inputs
+  integer :: n_groups=0                                  ! number of site groups when they were last formed
+  integer,allocatable,dimension(:):: site_group          ! site whose solution each site takes (itself for the first of a group)
+  logical,allocatable,dimension(:):: site_solved         ! site is solved in the current timestep (see update_model)
   !integer :: n_time                                      ! number of time steps that temp will be averaged over
   integer :: n_frz_max                                   ! maximum number of freezing fronts
   real*8 :: smooth_coef                                  ! smoothing factor
@@ -43,10 +56,12 @@ module bnd
   real*8 :: sat_coef                                     ! saturation coefficient [dimensionless, fraction of 1]
 ! output file names
   character(64) :: restart_file,result_file,aver_res_file
-
-  type site_gipl
-    real*8 :: time
-  end type site_gipl
+! output file units, each model instance has its own (see gipl_state.f90)
+  integer :: result_unit=1,aver_res_unit=2,restart_unit=3,reduction_unit=4
+  character(16) :: output_format='text'                  ! 'text' or 'binary' (see open_output)
+  integer :: monthly_output=1                            ! 0: the result file of every timestep is not written
+  character(64) :: reduction_file=''                     ! file of the yearly reductions ('': none, see write_reductions)
+  character(64) :: input_cache=''                        ! file of parsed inputs ('': none, see load_input_cache)
 
 end module bnd
 
@@ -65,6 +80,17 @@ module thermo
 
   real*8 :: hcap_s                                         ! heat capacity of snow (constant) nondimentional
 
+! tabulated unfrozen water and ground thermal conductivity (see build_property_tables)
+  integer :: table_resolution=0                            ! initial number of table intervals per octave of |T|, 0: closed forms only
+  real*8 :: table_tolerance=1.D-4                          ! largest relative deviation of the tables from the closed forms
+  real*8 :: table_t_min=-50.D0                             ! lowest tabulated temperature
+  integer :: n_tbl_sub=0                                   ! table intervals per octave in use, 0: no tables
+  integer :: tbl_oct_lo,tbl_oct_hi                         ! binary exponents of the tabulated octaves of |T|
+  real*8 :: tbl_t_small,tbl_t_big                          ! tabulated range of |T|
+  real*8 :: table_error_unf,table_error_dunf,table_error_tcon ! largest relative deviations found when building the tables
+  integer,allocatable,dimension(:,:):: tbl_set             ! table of each soil layer and site
+  real*8,allocatable,dimension(:,:,:,:):: prop_tbl         ! (interval node, octave, table, property)
+
   ! temp is now defined in gipl_bmi_mod.f90
   !real*8, allocatable,dimension(:,:) :: temp                        ! soil temperature
   real, allocatable,dimension(:,:):: n_bnd_lay                      ! number of boundaries between layer in soil
@@ -95,6 +121,10 @@ module grd
   real*8, allocatable,dimension(:) :: zdepth_ini     ! depth and correspoding initial temperature (time=0) 'zdepth_ini(n_ini)'
   real*8, allocatable,dimension(:,:) :: ztemp_ini     ! depth and correspoding initial temperature (time=0) 'zdepth_ini(n_ini)'
   character(210) :: FMT1,FMT2                             ! results formating type
+! grid generated at initialize instead of the nodes of grid.txt below sea_level (see generate_grid)
+  real*8 :: grid_stretch=0.D0                             ! growth of the spacing from node to node (<= 1: use grid.txt)
+  real*8 :: grid_dz_min=0.002D0                           ! spacing below sea_level [m]
+  real*8 :: grid_dz_front=0.2D0                           ! largest spacing above frz_frn_max [m]
 
 end module grd
 
@@ -102,5 +132,34 @@ module alt
   integer,allocatable,dimension(:,:)::n_frz_frn                     ! number of freezing front (e.g. when freezup is about to happened)
   integer,allocatable,dimension(:)::i_time                          ! internal time step with the the main loop
   real*8 ,allocatable,dimension(:,:,:)::z_frz_frn                   ! depth of the freezing front
+  integer :: frz_frn_first=1,frz_frn_last=0                         ! nodes J searched by active_layer, zdepth(J)>=sea_level, zdepth(J+1)<=frz_frn_max
 end module alt
 
+module prof
+  ! Solver counters and phase timers (see profile_start)
+  integer :: profile=0                                              ! 1: collect the counters and timers below
+  integer,allocatable,dimension(:,:)::prof_iterations               ! Picard iterations of each site and timestep
+  integer,allocatable,dimension(:,:)::prof_halvings                 ! halvings of the sub-step timei
+  real*8 ,allocatable,dimension(:,:)::prof_min_timei                ! smallest sub-step timei reached
+  real*8 ,allocatable,dimension(:,:)::prof_solver_time              ! seconds spent in the solver
+  real*8 :: prof_time_solver=0.D0                                   ! seconds spent in each phase of update
+  real*8 :: prof_time_active_layer=0.D0
+  real*8 :: prof_time_interpolation=0.D0
+  real*8 :: prof_time_output=0.D0
+end module prof
+
+module red
+  ! Yearly reductions of the temperatures at the zdepth_id depths (see reduce_step)
+  integer :: n_red=0                                                ! number of reductions
+  integer,allocatable,dimension(:)::red_kind                        ! 1 mean, 2 max, 3 min, 4 crossing time, 5 degree sum, 6 percentile
+  real*8 ,allocatable,dimension(:)::red_threshold                   ! temperature of kinds 4 and 5
+  real*8 ,allocatable,dimension(:)::red_fraction                    ! quantile of kind 6, as a fraction
+  integer,allocatable,dimension(:,:)::red_steps                     ! 1: timestep of the year taken by the reduction (n_time, n_red)
+  integer,allocatable,dimension(:,:)::red_count                     ! timesteps taken this year (n_site, n_red)
+  real*8 ,allocatable,dimension(:,:,:)::red_acc                     ! running sum, extreme or crossing time (n_site, m_grd, n_red)
+  real*8 ,allocatable,dimension(:,:,:,:)::red_q                     ! P2 marker heights of kind 6 (5, n_site, m_grd, n_red)
+  integer,allocatable,dimension(:,:,:,:)::red_n                     ! P2 marker positions of kind 6
+  real*8 ,allocatable,dimension(:,:)::red_prev                      ! temperatures of the step before (n_site, m_grd)
+  real*8 ,allocatable,dimension(:,:,:)::red_value                   ! reductions of the last complete year (n_site, m_grd, n_red)
+end module red
+
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_output.py
+
+Read the binary output files of GIPL as numpy memory maps.
+
+GIPL writes these files instead of the text files when output_format is
+'binary' (see open_output() in gipl.f90 for the layout).  The arrays
+returned here are views of the files, so nothing is read until it is used.
+
+Usage:
+    python gipl_output.py <result.bin | mean.bin | start.bin | reductions>
+"""
+
+from __future__ import print_function
+
+import sys
+
+import numpy as np
+
+_int = np.dtype('<i4')
+_float = np.dtype('<f8')
+_magic_size = 8
+
+# Column names of the yearly blocks, in the order of the text files
+_result_columns = ('time', 'surface_temperature', 'snow_level')
+_mean_columns = ('time', 'surface_temperature', 'snow_level')
+_mean_tail_columns = ('freeze_up_depth', 'freeze_up_time_current',
+                      'freeze_up_time_total')
+
+
+def _read_magic(filename):
+    with open(filename, 'rb') as f:
+        return f.read(_magic_size).decode('ascii')
+
+
+def _read_header(filename, magic):
+    """ Return n_site, n_time, n_col, depths and the size of the header """
+    found = _read_magic(filename)
+    if found != magic:
+        raise ValueError('{} is not a {} file (found {!r})'.format(
+            filename, magic, found))
+
+    sizes = np.fromfile(filename, dtype=_int, count=_magic_size // 4 + 4)
+    n_site, n_time, n_col, m_grd = [int(n) for n in sizes[_magic_size // 4:]]
+    offset = _magic_size + 4 * _int.itemsize
+    depths = np.memmap(filename, dtype=_float, mode='r', offset=offset,
+                       shape=(m_grd,))
+    offset += m_grd * _float.itemsize
+    return n_site, n_time, n_col, depths, offset
+
+
+def _map_blocks(filename, offset, block_shape):
+    """ Map the complete yearly blocks that follow the header """
+    block_size = int(np.prod(block_shape)) * _float.itemsize
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        n_years = (f.tell() - offset) // block_size
+    if n_years == 0:
+        return np.zeros((0,) + tuple(block_shape), dtype=_float)
+    return np.memmap(filename, dtype=_float, mode='r', offset=offset,
+                     shape=(n_years,) + tuple(block_shape))
+
+
+def read_result(filename):
+    """ Map a result.bin file
+
+    Returns a dict of arrays with one row per record (n_years * n_time):
+    'time', 'surface_temperature' and 'snow_level' are (record, site), and
+    'temperature' is (record, site, depth).  'depth' holds the depths of the
+    stored grid points and 'n_time' the number of records per year.
+    """
+    n_site, n_time, n_col, depths, offset = _read_header(filename,
+                                                         'GIPL_RES')
+    blocks = _map_blocks(filename, offset, (n_time, n_site, n_col))
+    data = blocks.reshape((-1, n_site, n_col))
+
+    result = {'depth': depths, 'n_time': n_time}
+    for i_col, name in enumerate(_result_columns):
+        result[name] = data[:, :, i_col]
+    result['temperature'] = data[:, :, len(_result_columns):]
+    return result
+
+
+def read_mean(filename):
+    """ Map a mean.bin file
+
+    Returns a dict of arrays with one row per year: 'temperature' is
+    (year, site, depth) and all other columns are (year, site).
+    """
+    n_site, n_time, n_col, depths, offset = _read_header(filename,
+                                                         'GIPL_MEA')
+    data = _map_blocks(filename, offset, (n_site, n_col))
+    m_grd = len(depths)
+
+    mean = {'depth': depths}
+    for i_col, name in enumerate(_mean_columns):
+        mean[name] = data[:, :, i_col]
+    first = len(_mean_columns)
+    mean['temperature'] = data[:, :, first:first + m_grd]
+    for i_col, name in enumerate(_mean_tail_columns):
+        mean[name] = data[:, :, first + m_grd + i_col]
+    return mean
+
+
+def read_reductions(filename):
+    """ Map a reduction file (the reduction_file option, see
+    write_reductions() in gipl.f90)
+
+    Returns a dict with the 'depth' of the stored grid points and 'value',
+    a (year, site, reduction, depth) array, the reductions in the order in
+    which they were added.
+    """
+    n_site, n_time, n_col, depths, offset = _read_header(filename,
+                                                         'GIPL_RED')
+    data = _map_blocks(filename, offset, (n_site, n_col))
+    m_grd = len(depths)
+    return {
+        'depth':    depths,
+        'value':    data.reshape(data.shape[:2] + (n_col // m_grd, m_grd)),
+    }
+
+
+def read_restart(filename):
+    """ Map a start.bin file
+
+    Returns a dict with 'time_restart', the model 'depth' and the
+    'temperature' as (depth, site).
+    """
+    found = _read_magic(filename)
+    if found != 'GIPL_RST':
+        raise ValueError('{} is not a GIPL_RST file (found {!r})'.format(
+            filename, found))
+
+    sizes = np.fromfile(filename, dtype=_int, count=_magic_size // 4 + 2)
+    n_site, n_grd = [int(n) for n in sizes[_magic_size // 4:]]
+    offset = _magic_size + 2 * _int.itemsize
+    values = np.memmap(filename, dtype=_float, mode='r', offset=offset,
+                       shape=(n_grd + 1 + n_grd * n_site,))
+    return {
+        'depth':        values[:n_grd],
+        'time_restart': float(values[n_grd]),
+        'temperature':  values[n_grd + 1:].reshape((n_grd, n_site)),
+    }
+
+
+def read_output(filename):
+    """ Map any of the binary output files, chosen by its header """
+    readers = {
+        'GIPL_RES': read_result,
+        'GIPL_MEA': read_mean,
+        'GIPL_RED': read_reductions,
+        'GIPL_RST': read_restart,
+    }
+    magic = _read_magic(filename)
+    try:
+        return readers[magic](filename)
+    except KeyError:
+        raise ValueError('{} is not a GIPL binary output file'.format(
+            filename))
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('Usage:')
+        print('  python {} <binary_output_file>'.format(sys.argv[0]))
+        sys.exit(1)
+
+    for name, value in sorted(read_output(sys.argv[1]).items()):
+        print('{:24s} {}'.format(name, np.shape(value)))
@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_server.py
+
+Run a GIPL model in a process of its own and serve the BMI calls of
+BmiGiplMethod over a local socket.  Large arrays are exchanged through
+shared memory.  GiplClient is the asyncio client of such a server.
+
+See also bmi_gipl.py and gipl_ensemble.py
+
+NOTES:
+    Regarding the protocol:
+        A server listens on a Unix domain socket.  It serves one client
+            connection at a time, one call after the other.
+        Every call and every reply is a JSON object preceded by its length
+            as a 4-byte little-endian integer.  A call is
+                {"method": name, "args": [...], "kwargs": {...}}
+            and a reply is {"result": value} or {"error": message}.
+        Scalars, names, grid coordinates and the values of variables that
+            are not shared travel as JSON.  Numpy arrays are sent as nested
+            lists with their dtype and come back as numpy arrays.
+
+    Regarding the shared arrays:
+        soil__temperature is held in a shared memory segment.  The server
+            creates the segment at initialize() and load_state(), in the
+            Fortran order of the model array.  After every call that can
+            change the array (see _changing_calls), the server copies it
+            into the segment.  GiplClient.get_value() and get_value_ptr()
+            then read it without a call to the server.
+            GiplClient.set_value() writes it to the segment, and the server
+            copies it into the model.
+        The input variables are given with
+                GiplClient.set_forcing(var_name, times, values)
+            as with BmiGiplMethod.set_forcing().  The client writes the
+            times and the (n_rec, n_site) values into shared segments, and
+            the server passes them to the model.  The segments are created
+            on first use and replaced by larger ones when needed.
+        All segments are owned by the server, which removes them at
+            finalize() and when it stops.
+
+    Regarding processes:
+        Each server holds one model, so the Fortran state of its f2py_gipl
+            is its own (see gipl_ensemble.py).  Relative file names in a
+            configuration file are relative to the working directory of the
+            server, see start_server().
+        The calls of one client are sequential.  A driver can await the
+            calls of many clients at once, e.g. with asyncio.gather(), and
+            the servers then run concurrently.
+        Socket paths are limited to about 100 characters.
+        This module needs Python 3.8 or later, for asyncio and
+            multiprocessing.shared_memory.
+
+Usage:
+    python gipl_server.py <socket_path>
+        serves a model on socket_path until a client calls shutdown()
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import socket
+import struct
+import asyncio
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+# bmi_gipl.py and the f2py_gipl shared object live next to this file
+_gipl_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The length of a message, ahead of its JSON text
+_header = struct.Struct('<I')
+
+# Output variables held in shared memory
+_shared_outputs = ('soil__temperature',)
+
+# Input variables given through shared memory, see GiplClient.set_forcing()
+_shared_inputs = ('atmosphere_bottom_air__temperature',
+                  'surface__snow_depth',
+                  'surface__snow_thermal_conductivity')
+
+# The BmiGiplMethod calls served, answered with their return values
+_bmi_calls = (
+    'initialize', 'update', 'update_until', 'finalize',
+    'get_component_name', 'get_input_var_names', 'get_output_var_names',
+    'get_var_units', 'get_var_type', 'get_var_itemsize', 'get_var_nbytes',
+    'get_var_grid', 'get_grid_type', 'get_grid_rank', 'get_grid_shape',
+    'get_grid_size', 'get_grid_x', 'get_grid_y', 'get_grid_z',
+    'get_grid_spacing', 'get_grid_origin',
+    'get_start_time', 'get_end_time', 'get_time_step', 'get_current_time',
+    'get_value', 'set_value', 'get_value_at_indices', 'set_value_at_indices',
+    'set_option', 'get_option', 'get_table_error', 'scale_parameters',
+    'spin_up', 'save_state', 'load_state', 'get_profile', 'set_num_threads',
+    'get_memory_usage',
+)
+
+# Calls after which the shared outputs are copied from the model again
+_changing_calls = ('initialize', 'update', 'update_until', 'spin_up',
+                   'load_state', 'set_value', 'set_value_at_indices')
+
+
+class GiplServerError(RuntimeError):
+    """ An error raised by a call on a GIPL server, or a lost server """
+
+
+def _to_json(value):
+    """ Encode the numpy values that json cannot """
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': value.tolist(), 'dtype': value.dtype.str}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    raise TypeError('Cannot send a {}'.format(type(value).__name__))
+
+
+def _from_json(value):
+    if '__ndarray__' in value:
+        return np.array(value['__ndarray__'], dtype=value['dtype'])
+    return value
+
+
+def _encode(message):
+    data = json.dumps(message, default=_to_json).encode('utf-8')
+    return _header.pack(len(data)) + data
+
+
+def _decode(data):
+    return json.loads(data.decode('utf-8'), object_hook=_from_json)
+
+
+def _create_shared(shape, order='C'):
+    """ Create a shared memory segment holding a float64 array
+
+    Returns the segment, the array and the description that
+    _attach_shared() takes.
+    """
+    dtype = np.dtype(np.float64)
+    segment = shared_memory.SharedMemory(
+        create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    array = np.ndarray(shape, dtype=dtype, buffer=segment.buf, order=order)
+    description = {'name': segment.name, 'shape': list(shape),
+                   'dtype': dtype.str, 'order': order}
+    return segment, array, description
+
+
+def _attach_shared(description):
+    """ Map a segment created by the server, return it and its array """
+    try:
+        segment = shared_memory.SharedMemory(name=description['name'],
+                                             track=False)
+    except TypeError:
+        # Before Python 3.13, the resource tracker of this process would
+        #   remove the server's segment when this process exits
+        segment = shared_memory.SharedMemory(name=description['name'])
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    array = np.ndarray(tuple(description['shape']),
+                       dtype=description['dtype'], buffer=segment.buf,
+                       order=description['order'])
+    return segment, array
+
+
+def _release(shared, unlink=False):
+    """ Unmap the (segment, array) pairs of a dict, and empty it """
+    for name in list(shared):
+        segment, array = shared.pop(name)
+        del array
+        try:
+            segment.close()
+        except BufferError:
+            # A view of the array is still in use, the mapping goes with it
+            pass
+        if unlink:
+            segment.unlink()
+
+
+class GiplServer(object):
+    """ Serve the calls of clients on a model, see the NOTES above """
+
+    def __init__(self, model):
+        self.model = model
+        self.stopped = False
+        # var_name -> (segment, array)
+        self._outputs = {}
+        # (var_name, 'times' or 'values') -> (segment, array)
+        self._inputs = {}
+        self._server_calls = {
+            'shared_outputs':    self.shared_outputs,
+            'set_shared_value':  self.set_shared_value,
+            'share_forcing':     self.share_forcing,
+            'set_forcing':       self.set_forcing,
+            'shutdown':          self.shutdown,
+        }
+
+    def call(self, method, args, kwargs):
+        if method in self._server_calls:
+            return self._server_calls[method](*args, **kwargs)
+        if method not in _bmi_calls:
+            raise ValueError('No call named: {}'.format(method))
+
+        if method == 'finalize':
+            _release(self._outputs, unlink=True)
+        result = getattr(self.model, method)(*args, **kwargs)
+        if method in ('initialize', 'load_state'):
+            self._share_outputs()
+        if method in _changing_calls:
+            self._copy_outputs()
+        return result
+
+    def _share_outputs(self):
+        _release(self._outputs, unlink=True)
+        for var_name in _shared_outputs:
+            ref = self.model.get_value_ptr(var_name)
+            order = 'F' if np.isfortran(ref) else 'C'
+            segment, array, description = _create_shared(ref.shape, order)
+            self._outputs[var_name] = (segment, array)
+
+    def _copy_outputs(self):
+        for var_name, (segment, array) in self._outputs.items():
+            self.model.get_value(var_name, dest=array)
+
+    def shared_outputs(self):
+        """ Return the descriptions of the shared output segments """
+        descriptions = {}
+        for var_name, (segment, array) in self._outputs.items():
+            descriptions[var_name] = {
+                'name': segment.name, 'shape': list(array.shape),
+                'dtype': array.dtype.str,
+                'order': 'F' if np.isfortran(array) else 'C'}
+        return descriptions
+
+    def set_shared_value(self, var_name):
+        """ Copy a shared output, as written by the client, into the model """
+        self.model.set_value(var_name, self._outputs[var_name][1])
+
+    def share_forcing(self, var_name, n_rec, n_site):
+        """ Create the segments of an input variable for n_rec records
+
+        Returns the descriptions of its 'times' and 'values' segments.
+        """
+        if var_name not in _shared_inputs:
+            raise ValueError('{} is not a shared input'.format(var_name))
+        _release(dict((key, self._inputs.pop(key))
+                      for key in list(self._inputs) if key[0] == var_name),
+                 unlink=True)
+        descriptions = {}
+        for part, shape in (('times', (n_rec,)),
+                            ('values', (n_rec, n_site))):
+            segment, array, description = _create_shared(shape)
+            self._inputs[(var_name, part)] = (segment, array)
+            descriptions[part] = description
+        return descriptions
+
+    def set_forcing(self, var_name, n_rec):
+        """ Give the model the first n_rec records of a shared input """
+        self.model.set_forcing(var_name,
+                               self._inputs[(var_name, 'times')][1][:n_rec],
+                               self._inputs[(var_name, 'values')][1][:n_rec])
+
+    def shutdown(self):
+        self.stopped = True
+
+    def release(self):
+        """ Remove all segments """
+        _release(self._outputs, unlink=True)
+        _release(self._inputs, unlink=True)
+
+    def serve_connection(self, connection):
+        """ Answer the calls of a connection until it closes or shutdown()
+        """
+        while not self.stopped:
+            header = _recv_exactly(connection, _header.size)
+            if header is None:
+                return
+            message = _decode(_recv_exactly(connection,
+                                            _header.unpack(header)[0]))
+            try:
+                reply = {'result': self.call(message['method'],
+                                             message.get('args', []),
+                                             message.get('kwargs', {}))}
+            except Exception as error:
+                reply = {'error': '{}: {}'.format(type(error).__name__,
+                                                  error)}
+            connection.sendall(_encode(reply))
+
+
+def _recv_exactly(connection, n_bytes):
+    """ Read n_bytes from a socket, or return None if it is closed first """
+    data = bytearray(n_bytes)
+    view = memoryview(data)
+    received = 0
+    while received < n_bytes:
+        n_received = connection.recv_into(view[received:])
+        if n_received == 0:
+            return None
+        received += n_received
+    return bytes(data)
+
+
+def serve(socket_path):
+    """ Serve a model on socket_path until a client calls shutdown() """
+    if _gipl_dir not in sys.path:
+        sys.path.insert(0, _gipl_dir)
+    import bmi_gipl
+
+    server = GiplServer(bmi_gipl.BmiGiplMethod())
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(socket_path)
+        listener.listen(1)
+        while not server.stopped:
+            connection, address = listener.accept()
+            try:
+                server.serve_connection(connection)
+            finally:
+                connection.close()
+    finally:
+        listener.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server.release()
+
+
+def _remote(method):
+    """ A GiplClient coroutine making the call of the same name """
+    async def call(self, *args, **kwargs):
+        return await self.call(method, *args, **kwargs)
+    call.__name__ = method
+    return call
+
+
+class GiplClient(object):
+    """ The asyncio client of a GIPL server
+
+    The BMI calls of BmiGiplMethod are coroutines of the same names, e.g.
+        await client.update_until(time)
+    get_value(), set_value() and set_forcing() of the shared variables go
+    through shared memory, see the NOTES above.
+    """
+
+    def __init__(self, reader, writer, process=None):
+        self._reader = reader
+        self._writer = writer
+        self.process = process
+        self._lock = asyncio.Lock()
+        # var_name -> (segment, array)
+        self._outputs = {}
+        # (var_name, 'times' or 'values') -> (segment, array)
+        self._inputs = {}
+
+    @classmethod
+    async def connect(cls, socket_path, process=None):
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        return cls(reader, writer, process=process)
+
+    async def call(self, method, *args, **kwargs):
+        """ Make a call on the server and return its result """
+        async with self._lock:
+            self._writer.write(_encode({'method': method, 'args': args,
+                                        'kwargs': kwargs}))
+            try:
+                await self._writer.drain()
+                header = await self._reader.readexactly(_header.size)
+                reply = _decode(await self._reader.readexactly(
+                    _header.unpack(header)[0]))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                raise GiplServerError(
+                    'The GIPL server closed the connection during '
+                    '{}()'.format(method))
+        if 'error' in reply:
+            raise GiplServerError(reply['error'])
+        return reply['result']
+
+    async def _attach_outputs(self):
+        _release(self._outputs)
+        descriptions = await self.call('shared_outputs')
+        for var_name, description in descriptions.items():
+            self._outputs[var_name] = _attach_shared(description)
+
+    async def initialize(self, cfg_filename=None):
+        await self.call('initialize', cfg_filename)
+        await self._attach_outputs()
+
+    async def load_state(self, filename):
+        await self.call('load_state', filename)
+        await self._attach_outputs()
+
+    async def finalize(self):
+        _release(self._outputs)
+        await self.call('finalize')
+
+    def get_value_ptr(self, var_name):
+        """ Return the shared array of a shared output
+
+        It holds the model's values as of the end of the last call.
+        """
+        return self._outputs[var_name][1]
+
+    async def get_value(self, var_name, dest=None):
+        if var_name not in self._outputs:
+            value = await self.call('get_value', var_name)
+            if dest is not None:
+                np.copyto(dest, value)
+                return dest
+            return value
+        array = self._outputs[var_name][1]
+        if dest is not None:
+            np.copyto(dest, array)
+            return dest
+        return array.copy(order='K')
+
+    async def set_value(self, var_name, src):
+        if var_name not in self._outputs:
+            await self.call('set_value', var_name, np.asarray(src))
+            return
+        np.copyto(self._outputs[var_name][1], src)
+        await self.call('set_shared_value', var_name)
+
+    async def set_forcing(self, var_name, times, values):
+        """ Set a forcing series, see BmiGiplMethod.set_forcing() """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            values = values.reshape((-1, 1))
+        if values.shape[0] != times.shape[0]:
+            raise ValueError(
+                '{} has {} times but {} records of values'.format(
+                    var_name, times.shape[0], values.shape[0]))
+        n_rec, n_site = values.shape
+
+        shared = self._inputs.get((var_name, 'values'))
+        if (shared is None or shared[1].shape[0] < n_rec or
+                shared[1].shape[1] != n_site):
+            _release(dict((key, self._inputs.pop(key))
+                          for key in list(self._inputs)
+                          if key[0] == var_name))
+            descriptions = await self.call('share_forcing', var_name,
+                                           n_rec, n_site)
+            for part, description in descriptions.items():
+                self._inputs[(var_name, part)] = _attach_shared(description)
+
+        self._inputs[(var_name, 'times')][1][:n_rec] = times
+        self._inputs[(var_name, 'values')][1][:n_rec] = values
+        await self.call('set_forcing', var_name, n_rec)
+
+    async def shutdown(self):
+        """ Stop the server, and wait for its process if it was started
+        with start_server() """
+        _release(self._outputs)
+        _release(self._inputs)
+        try:
+            await self.call('shutdown')
+        finally:
+            self._writer.close()
+        if self.process is not None:
+            await self.process.wait()
+
+
+for _method in _bmi_calls:
+    if not hasattr(GiplClient, _method):
+        setattr(GiplClient, _method, _remote(_method))
+
+
+async def start_server(socket_path, cwd=None, timeout=60.0):
+    """ Start a server process and return its connected GiplClient
+
+    cwd is the working directory of the server, which relative file names
+    of the configuration file are relative to.
+    """
+    socket_path = os.path.abspath(socket_path)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), socket_path, cwd=cwd)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            return await GiplClient.connect(socket_path, process=process)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if process.returncode is not None or loop.time() > deadline:
+                raise GiplServerError(
+                    'The GIPL server at {} did not start'.format(socket_path))
+            await asyncio.sleep(0.05)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('Usage:')
+        print('  python {} <socket_path>'.format(sys.argv[0]))
+        sys.exit(1)
+
+    serve(sys.argv[1])
@@ -0,0 +1,683 @@
+! gipl_state.f90
+!
+! Several serialized model instances per process.
+!
+! All of the model's state lives in the module variables of gipl_bmi, bnd,
+! thermo, grd, alt, prof and red, and every routine in gipl.f90 reads it from there.
+! To keep several independent models in one process, each model instance is
+! given a handle, and the state of every instance that is not currently
+! active is parked in its slot of the 'instances' array.  Selecting an
+! instance exchanges the module variables with the contents of its slot.
+!
+! The routines in gipl.f90 are not reentrant: they take no instance
+! argument and work on the module variables, so only the selected instance
+! can run, and instances never run at the same time.  Models that are to
+! run in parallel need processes of their own (gipl_ensemble.py,
+! gipl_server.py); OpenMP only spreads the sites of one instance over
+! threads.
+!
+! Allocatable arrays are exchanged with move_alloc, so selecting an
+! instance never copies array data, and an array keeps its address while
+! it belongs to its instance.  Only scalars are copied.
+!
+! Handle 0 is the default instance, which is what the module variables
+! hold when no other instance has been created (e.g. in the standalone
+! gipl executable).
+!
+! Callers that use instances from several threads must serialize their
+! calls (bmi_gipl.py does this with one lock for all instances).
+!
+! The same list of variables is used to write the active instance to a
+! snapshot file and to read it back (save_state and load_state in
+! gipl_bmi_methods.f90): with state_action set to do_write or do_read,
+! exchange_instance writes or reads each module variable on snapshot_unit
+! instead of swapping it.  Arrays are stored with whether they are
+! allocated and their bounds, so a variable added to exchange_instance is
+! also part of the snapshot.
+!
+! Note: f2py does not wrap modules that define derived types, so the
+! BMI-facing routines are in gipl_bmi_methods.f90.
+
+module gipl_state
+
+  implicit none
+
+  type gipl_instance
+    logical :: in_use = .false.
+
+    ! gipl_bmi
+    character(64) :: fconfig = ""
+    integer :: n_site, n_time, n_grd, m_grd, n_total_timesteps
+    real*8 :: time_loop, time_step, time_beg, time_end, time_s, time_e
+    real*8, allocatable, dimension(:) :: surface_temp
+    real*8, allocatable, dimension(:) :: snow_depth
+    real*8, allocatable, dimension(:) :: snow_thermal_conductivity
+    real*8, allocatable, dimension(:,:) :: monthly_time
+    real*8, allocatable, dimension(:,:) :: monthly_freeze_up_temp
+    real*8, allocatable, dimension(:,:) :: monthly_snow_level
+    real*8, allocatable, dimension(:,:,:) :: monthly_temperature
+    real*8, allocatable, dimension(:) :: annual_average_time
+    real*8, allocatable, dimension(:) :: annual_freeze_up_temp
+    real*8, allocatable, dimension(:) :: annual_snow_level
+    real*8, allocatable, dimension(:,:) :: annual_temperature
+    real*8, allocatable, dimension(:) :: freeze_up_depth
+    real*8, allocatable, dimension(:) :: freeze_up_time_current
+    real*8, allocatable, dimension(:) :: freeze_up_time_total
+    real*8, allocatable, dimension(:,:) :: temp
+
+    ! bnd
+    integer :: n_temp, n_snow, n_stcon
+    real*8, allocatable, dimension(:) :: utemp_time, utemp_time_i
+    real*8, allocatable, dimension(:,:) :: utemp, utemp_i
+    real*8, allocatable, dimension(:) :: snd_time, stcon_time
+    real*8, allocatable, dimension(:,:) :: snd, stcon, snd_i, stcon_i
+    character(16) :: storage_precision = 'double'
+    real, allocatable, dimension(:,:) :: utemp_s, snd_s, stcon_s
+    real*8 :: TINIR, time_restart
+    integer :: utemp_cursor = 0, snd_cursor = 0, stcon_cursor = 0
+    logical :: utemp_preset = .false., snd_preset = .false.
+    logical :: stcon_preset = .false.
+    integer :: restart, itmax, n_frz_max
+    integer :: step_control = 0
+    real*8 :: step_tolerance = 0.02D0
+    real*8, allocatable, dimension(:) :: timei_site
+    integer :: site_dedup = 0, n_groups = 0
+    logical :: sites_grouped = .false.
+    real*8 :: dedup_tolerance = 0.D0
+    integer, allocatable, dimension(:) :: site_group
+    logical, allocatable, dimension(:) :: site_solved
+    real*8 :: TAUM, TMIN, smooth_coef, unf_water_coef, n_sec_day
+    real*8 :: frz_frn_max, frz_frn_min, sat_coef
+    character(64) :: restart_file, result_file, aver_res_file
+    integer :: result_unit = 1, aver_res_unit = 2, restart_unit = 3
+    integer :: reduction_unit = 4
+    character(16) :: output_format = 'text'
+    integer :: monthly_output = 1
+    character(64) :: reduction_file = ''
+    character(64) :: input_cache = ''
+
+    ! thermo
+    real*8 :: L_fus, sea_level, hcap_s
+    real*8, allocatable, dimension(:,:) :: vwc, a_coef, b_coef, temp_frz, EE
+    real*8, allocatable, dimension(:,:) :: hcap_frz, hcap_thw
+    real*8, allocatable, dimension(:,:) :: tcon_frz, tcon_thw
+    real, allocatable, dimension(:,:) :: n_bnd_lay
+    integer :: k0
+    integer, allocatable, dimension(:) :: snow_code, veg_code
+    integer, allocatable, dimension(:) :: geo_code, gt_zone_code
+    real*8, allocatable, dimension(:) :: temp_grd
+    integer :: table_resolution = 0
+    real*8 :: table_tolerance = 1.D-4, table_t_min = -50.D0
+    integer :: n_tbl_sub = 0, tbl_oct_lo, tbl_oct_hi
+    real*8 :: tbl_t_small, tbl_t_big
+    real*8 :: table_error_unf, table_error_dunf, table_error_tcon
+    integer, allocatable, dimension(:,:) :: tbl_set
+    real*8, allocatable, dimension(:,:,:,:) :: prop_tbl
+
+    ! grd
+    integer, allocatable, dimension(:) :: n_lay_cur
+    real*8, allocatable, dimension(:) :: zdepth, dz
+    integer, allocatable, dimension(:,:) :: lay_id
+    integer, allocatable, dimension(:) :: zdepth_id
+    integer :: n_ini
+    real*8, allocatable, dimension(:) :: zdepth_ini
+    real*8, allocatable, dimension(:,:) :: ztemp_ini
+    character(210) :: FMT1, FMT2
+    real*8 :: grid_stretch = 0.D0, grid_dz_min = 0.002D0
+    real*8 :: grid_dz_front = 0.2D0
+
+    ! alt
+    integer, allocatable, dimension(:,:) :: n_frz_frn
+    integer, allocatable, dimension(:) :: i_time
+    real*8, allocatable, dimension(:,:,:) :: z_frz_frn
+    integer :: frz_frn_first = 1, frz_frn_last = 0
+
+    ! prof
+    integer :: profile = 0
+    integer, allocatable, dimension(:,:) :: prof_iterations, prof_halvings
+    real*8, allocatable, dimension(:,:) :: prof_min_timei, prof_solver_time
+    real*8 :: prof_time_solver = 0.D0, prof_time_active_layer = 0.D0
+    real*8 :: prof_time_interpolation = 0.D0, prof_time_output = 0.D0
+
+    ! red
+    integer :: n_red = 0
+    integer, allocatable, dimension(:) :: red_kind
+    real*8, allocatable, dimension(:) :: red_threshold, red_fraction
+    integer, allocatable, dimension(:,:) :: red_steps, red_count
+    real*8, allocatable, dimension(:,:,:) :: red_acc
+    real*8, allocatable, dimension(:,:,:,:) :: red_q
+    integer, allocatable, dimension(:,:,:,:) :: red_n
+    real*8, allocatable, dimension(:,:) :: red_prev
+    real*8, allocatable, dimension(:,:,:) :: red_value
+  end type gipl_instance
+
+  type(gipl_instance), allocatable, dimension(:), save :: instances
+  integer, save :: active_instance = 0
+
+  ! Output units of instance h are first_unit + 4*h + (0, 1, 2, 3)
+  integer, parameter :: first_unit = 100
+
+  ! What exchange_instance does with each variable
+  integer, parameter :: do_swap = 0, do_write = 1, do_read = 2
+  integer, save :: state_action = do_swap
+  integer, save :: snapshot_unit = 0
+
+  interface swap
+    module procedure swap_int, swap_r8, swap_char, swap_logical
+    module procedure swap_logical_1d
+    module procedure swap_int_1d, swap_int_2d, swap_int_4d
+    module procedure swap_r4_2d
+    module procedure swap_r8_1d, swap_r8_2d, swap_r8_3d, swap_r8_4d
+  end interface swap
+
+contains
+
+  subroutine exchange_instance(slot)
+    ! Exchange the module variables with the contents of an instance slot
+    use gipl_bmi
+    use bnd
+    use thermo
+    use grd
+    use alt
+    use prof
+    use red
+
+    implicit none
+
+    type(gipl_instance), intent(inout) :: slot
+
+    ! gipl_bmi
+    call swap(slot%fconfig, fconfig)
+    call swap(slot%n_site, n_site)
+    call swap(slot%n_time, n_time)
+    call swap(slot%n_grd, n_grd)
+    call swap(slot%m_grd, m_grd)
+    call swap(slot%n_total_timesteps, n_total_timesteps)
+    call swap(slot%time_loop, time_loop)
+    call swap(slot%time_step, time_step)
+    call swap(slot%time_beg, time_beg)
+    call swap(slot%time_end, time_end)
+    call swap(slot%time_s, time_s)
+    call swap(slot%time_e, time_e)
+    call swap(slot%surface_temp, surface_temp)
+    call swap(slot%snow_depth, snow_depth)
+    call swap(slot%snow_thermal_conductivity, snow_thermal_conductivity)
+    call swap(slot%monthly_time, monthly_time)
+    call swap(slot%monthly_freeze_up_temp, monthly_freeze_up_temp)
+    call swap(slot%monthly_snow_level, monthly_snow_level)
+    call swap(slot%monthly_temperature, monthly_temperature)
+    call swap(slot%annual_average_time, annual_average_time)
+    call swap(slot%annual_freeze_up_temp, annual_freeze_up_temp)
+    call swap(slot%annual_snow_level, annual_snow_level)
+    call swap(slot%annual_temperature, annual_temperature)
+    call swap(slot%freeze_up_depth, freeze_up_depth)
+    call swap(slot%freeze_up_time_current, freeze_up_time_current)
+    call swap(slot%freeze_up_time_total, freeze_up_time_total)
+    call swap(slot%temp, temp)
+
+    ! bnd
+    call swap(slot%n_temp, n_temp)
+    call swap(slot%n_snow, n_snow)
+    call swap(slot%n_stcon, n_stcon)
+    call swap(slot%utemp_time, utemp_time)
+    call swap(slot%utemp_time_i, utemp_time_i)
+    call swap(slot%utemp, utemp)
+    call swap(slot%utemp_i, utemp_i)
+    call swap(slot%snd_time, snd_time)
+    call swap(slot%stcon_time, stcon_time)
+    call swap(slot%snd, snd)
+    call swap(slot%stcon, stcon)
+    call swap(slot%storage_precision, storage_precision)
+    call swap(slot%utemp_s, utemp_s)
+    call swap(slot%snd_s, snd_s)
+    call swap(slot%stcon_s, stcon_s)
+    call swap(slot%snd_i, snd_i)
+    call swap(slot%stcon_i, stcon_i)
+    call swap(slot%TINIR, TINIR)
+    call swap(slot%time_restart, time_restart)
+    call swap(slot%utemp_cursor, utemp_cursor)
+    call swap(slot%snd_cursor, snd_cursor)
+    call swap(slot%stcon_cursor, stcon_cursor)
+    call swap(slot%utemp_preset, utemp_preset)
+    call swap(slot%snd_preset, snd_preset)
+    call swap(slot%stcon_preset, stcon_preset)
+    call swap(slot%restart, restart)
+    call swap(slot%itmax, itmax)
+    call swap(slot%n_frz_max, n_frz_max)
+    call swap(slot%step_control, step_control)
+    call swap(slot%step_tolerance, step_tolerance)
+    call swap(slot%timei_site, timei_site)
+    call swap(slot%site_dedup, site_dedup)
+    call swap(slot%dedup_tolerance, dedup_tolerance)
+    call swap(slot%sites_grouped, sites_grouped)
+    call swap(slot%n_groups, n_groups)
+    call swap(slot%site_group, site_group)
+    call swap(slot%site_solved, site_solved)
+    call swap(slot%TAUM, TAUM)
+    call swap(slot%TMIN, TMIN)
+    call swap(slot%smooth_coef, smooth_coef)
+    call swap(slot%unf_water_coef, unf_water_coef)
+    call swap(slot%n_sec_day, n_sec_day)
+    call swap(slot%frz_frn_max, frz_frn_max)
+    call swap(slot%frz_frn_min, frz_frn_min)
+    call swap(slot%sat_coef, sat_coef)
+    call swap(slot%restart_file, restart_file)
+    call swap(slot%result_file, result_file)
+    call swap(slot%aver_res_file, aver_res_file)
+    call swap(slot%result_unit, result_unit)
+    call swap(slot%aver_res_unit, aver_res_unit)
+    call swap(slot%restart_unit, restart_unit)
+    call swap(slot%reduction_unit, reduction_unit)
+    call swap(slot%output_format, output_format)
+    call swap(slot%monthly_output, monthly_output)
+    call swap(slot%reduction_file, reduction_file)
+    call swap(slot%input_cache, input_cache)
+
+    ! thermo
+    call swap(slot%L_fus, L_fus)
+    call swap(slot%sea_level, sea_level)
+    call swap(slot%hcap_s, hcap_s)
+    call swap(slot%vwc, vwc)
+    call swap(slot%a_coef, a_coef)
+    call swap(slot%b_coef, b_coef)
+    call swap(slot%temp_frz, temp_frz)
+    call swap(slot%EE, EE)
+    call swap(slot%hcap_frz, hcap_frz)
+    call swap(slot%hcap_thw, hcap_thw)
+    call swap(slot%tcon_frz, tcon_frz)
+    call swap(slot%tcon_thw, tcon_thw)
+    call swap(slot%n_bnd_lay, n_bnd_lay)
+    call swap(slot%k0, k0)
+    call swap(slot%snow_code, snow_code)
+    call swap(slot%veg_code, veg_code)
+    call swap(slot%geo_code, geo_code)
+    call swap(slot%gt_zone_code, gt_zone_code)
+    call swap(slot%temp_grd, temp_grd)
+    call swap(slot%table_resolution, table_resolution)
+    call swap(slot%table_tolerance, table_tolerance)
+    call swap(slot%table_t_min, table_t_min)
+    call swap(slot%n_tbl_sub, n_tbl_sub)
+    call swap(slot%tbl_oct_lo, tbl_oct_lo)
+    call swap(slot%tbl_oct_hi, tbl_oct_hi)
+    call swap(slot%tbl_t_small, tbl_t_small)
+    call swap(slot%tbl_t_big, tbl_t_big)
+    call swap(slot%table_error_unf, table_error_unf)
+    call swap(slot%table_error_dunf, table_error_dunf)
+    call swap(slot%table_error_tcon, table_error_tcon)
+    call swap(slot%tbl_set, tbl_set)
+    call swap(slot%prop_tbl, prop_tbl)
+
+    ! grd
+    call swap(slot%n_lay_cur, n_lay_cur)
+    call swap(slot%zdepth, zdepth)
+    call swap(slot%dz, dz)
+    call swap(slot%lay_id, lay_id)
+    call swap(slot%zdepth_id, zdepth_id)
+    call swap(slot%n_ini, n_ini)
+    call swap(slot%zdepth_ini, zdepth_ini)
+    call swap(slot%ztemp_ini, ztemp_ini)
+    call swap(slot%FMT1, FMT1)
+    call swap(slot%FMT2, FMT2)
+    call swap(slot%grid_stretch, grid_stretch)
+    call swap(slot%grid_dz_min, grid_dz_min)
+    call swap(slot%grid_dz_front, grid_dz_front)
+
+    ! alt
+    call swap(slot%n_frz_frn, n_frz_frn)
+    call swap(slot%i_time, i_time)
+    call swap(slot%z_frz_frn, z_frz_frn)
+    call swap(slot%frz_frn_first, frz_frn_first)
+    call swap(slot%frz_frn_last, frz_frn_last)
+
+    ! prof
+    call swap(slot%profile, profile)
+    call swap(slot%prof_iterations, prof_iterations)
+    call swap(slot%prof_halvings, prof_halvings)
+    call swap(slot%prof_min_timei, prof_min_timei)
+    call swap(slot%prof_solver_time, prof_solver_time)
+    call swap(slot%prof_time_solver, prof_time_solver)
+    call swap(slot%prof_time_active_layer, prof_time_active_layer)
+    call swap(slot%prof_time_interpolation, prof_time_interpolation)
+    call swap(slot%prof_time_output, prof_time_output)
+
+    ! red
+    call swap(slot%n_red, n_red)
+    call swap(slot%red_kind, red_kind)
+    call swap(slot%red_threshold, red_threshold)
+    call swap(slot%red_fraction, red_fraction)
+    call swap(slot%red_steps, red_steps)
+    call swap(slot%red_count, red_count)
+    call swap(slot%red_acc, red_acc)
+    call swap(slot%red_q, red_q)
+    call swap(slot%red_n, red_n)
+    call swap(slot%red_prev, red_prev)
+    call swap(slot%red_value, red_value)
+
+  end subroutine exchange_instance
+
+
+  subroutine reserve_instances(n)
+    ! Make sure slots 0 to n exist
+    implicit none
+
+    integer, intent(in) :: n
+    type(gipl_instance), allocatable, dimension(:) :: grown
+    integer :: i
+
+    if (.not. allocated(instances)) then
+      allocate(instances(0:max(n, 7)))
+      instances(0)%in_use = .true.
+    elseif (ubound(instances, 1) .lt. n) then
+      allocate(grown(0:max(n, 2*ubound(instances, 1))))
+      do i = 0, ubound(instances, 1)
+        call exchange_slots(grown(i), instances(i))
+      enddo
+      call move_alloc(grown, instances)
+    endif
+
+  end subroutine reserve_instances
+
+
+  subroutine exchange_slots(a, b)
+    ! Move the state held in slot b into slot a, which must be empty,
+    ! by passing it through the module variables
+    implicit none
+
+    type(gipl_instance), intent(inout) :: a, b
+
+    call exchange_instance(b)
+    call exchange_instance(a)
+    call exchange_instance(b)
+
+  end subroutine exchange_slots
+
+
+  subroutine write_snapshot(unit)
+    ! Write the module variables to unit, an open unformatted stream
+    implicit none
+
+    integer, intent(in) :: unit
+    type(gipl_instance) :: unused
+
+    snapshot_unit = unit
+    state_action = do_write
+    call exchange_instance(unused)
+    state_action = do_swap
+
+  end subroutine write_snapshot
+
+
+  subroutine read_snapshot(unit)
+    ! Replace the module variables with those written by write_snapshot
+    ! The active instance keeps its own configuration file name and output
+    ! files, so its output continues into the files it was initialized with,
+    ! and its own site_dedup settings, with the sites grouped again at the
+    ! next update
+    use gipl_bmi
+    use bnd
+
+    implicit none
+
+    integer, intent(in) :: unit
+    type(gipl_instance) :: unused
+
+    character(64) :: own_fconfig
+    character(64) :: own_restart_file, own_result_file, own_aver_res_file
+    character(64) :: own_reduction_file
+    character(16) :: own_output_format
+    integer :: own_result_unit, own_aver_res_unit, own_restart_unit
+    integer :: own_reduction_unit, own_monthly_output
+    integer :: own_site_dedup
+    real*8 :: own_dedup_tolerance
+
+    own_fconfig = fconfig
+    own_restart_file = restart_file
+    own_result_file = result_file
+    own_aver_res_file = aver_res_file
+    own_reduction_file = reduction_file
+    own_output_format = output_format
+    own_monthly_output = monthly_output
+    own_result_unit = result_unit
+    own_aver_res_unit = aver_res_unit
+    own_restart_unit = restart_unit
+    own_reduction_unit = reduction_unit
+    own_site_dedup = site_dedup
+    own_dedup_tolerance = dedup_tolerance
+
+    snapshot_unit = unit
+    state_action = do_read
+    call exchange_instance(unused)
+    state_action = do_swap
+
+    fconfig = own_fconfig
+    restart_file = own_restart_file
+    result_file = own_result_file
+    aver_res_file = own_aver_res_file
+    reduction_file = own_reduction_file
+    output_format = own_output_format
+    monthly_output = own_monthly_output
+    result_unit = own_result_unit
+    aver_res_unit = own_aver_res_unit
+    restart_unit = own_restart_unit
+    reduction_unit = own_reduction_unit
+    site_dedup = own_site_dedup
+    dedup_tolerance = own_dedup_tolerance
+    sites_grouped = .false.
+
+  end subroutine read_snapshot
+
+
+  logical function read_bounds(lo, hi)
+    ! Read whether a snapshot array is allocated, and if it is its bounds
+    implicit none
+
+    integer, intent(out) :: lo(:), hi(:)
+
+    read(snapshot_unit) read_bounds
+    if (read_bounds) read(snapshot_unit) lo, hi
+
+  end function read_bounds
+
+
+  subroutine swap_int(a, b)
+    integer, intent(inout) :: a, b
+    integer :: tmp
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) b
+    elseif (state_action .eq. do_read) then
+      read(snapshot_unit) b
+    else
+      tmp = a; a = b; b = tmp
+    endif
+  end subroutine swap_int
+
+  subroutine swap_r8(a, b)
+    real*8, intent(inout) :: a, b
+    real*8 :: tmp
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) b
+    elseif (state_action .eq. do_read) then
+      read(snapshot_unit) b
+    else
+      tmp = a; a = b; b = tmp
+    endif
+  end subroutine swap_r8
+
+  subroutine swap_logical(a, b)
+    logical, intent(inout) :: a, b
+    logical :: tmp
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) b
+    elseif (state_action .eq. do_read) then
+      read(snapshot_unit) b
+    else
+      tmp = a; a = b; b = tmp
+    endif
+  end subroutine swap_logical
+
+  subroutine swap_char(a, b)
+    character(len=*), intent(inout) :: a, b
+    character(len=len(a)) :: tmp
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) b
+    elseif (state_action .eq. do_read) then
+      read(snapshot_unit) b
+    else
+      tmp = a; a = b; b = tmp
+    endif
+  end subroutine swap_char
+
+  subroutine swap_logical_1d(a, b)
+    logical, allocatable, dimension(:) :: a, b, tmp
+    integer :: lo(1), hi(1)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_logical_1d
+
+  subroutine swap_int_1d(a, b)
+    integer, allocatable, dimension(:) :: a, b, tmp
+    integer :: lo(1), hi(1)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_int_1d
+
+  subroutine swap_int_2d(a, b)
+    integer, allocatable, dimension(:,:) :: a, b, tmp
+    integer :: lo(2), hi(2)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1), lo(2):hi(2)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_int_2d
+
+  subroutine swap_int_4d(a, b)
+    integer, allocatable, dimension(:,:,:,:) :: a, b, tmp
+    integer :: lo(4), hi(4)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1), lo(2):hi(2), lo(3):hi(3), lo(4):hi(4)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_int_4d
+
+  subroutine swap_r4_2d(a, b)
+    real, allocatable, dimension(:,:) :: a, b, tmp
+    integer :: lo(2), hi(2)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1), lo(2):hi(2)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_r4_2d
+
+  subroutine swap_r8_1d(a, b)
+    real*8, allocatable, dimension(:) :: a, b, tmp
+    integer :: lo(1), hi(1)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_r8_1d
+
+  subroutine swap_r8_2d(a, b)
+    real*8, allocatable, dimension(:,:) :: a, b, tmp
+    integer :: lo(2), hi(2)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1), lo(2):hi(2)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_r8_2d
+
+  subroutine swap_r8_3d(a, b)
+    real*8, allocatable, dimension(:,:,:) :: a, b, tmp
+    integer :: lo(3), hi(3)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1), lo(2):hi(2), lo(3):hi(3)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_r8_3d
+
+  subroutine swap_r8_4d(a, b)
+    real*8, allocatable, dimension(:,:,:,:) :: a, b, tmp
+    integer :: lo(4), hi(4)
+    if (state_action .eq. do_write) then
+      write(snapshot_unit) allocated(b)
+      if (allocated(b)) write(snapshot_unit) lbound(b), ubound(b), b
+    elseif (state_action .eq. do_read) then
+      if (allocated(b)) deallocate(b)
+      if (read_bounds(lo, hi)) then
+        allocate(b(lo(1):hi(1), lo(2):hi(2), lo(3):hi(3), lo(4):hi(4)))
+        read(snapshot_unit) b
+      endif
+    else
+      call move_alloc(a, tmp); call move_alloc(b, a); call move_alloc(tmp, b)
+    endif
+  end subroutine swap_r8_4d
+
+end module gipl_state
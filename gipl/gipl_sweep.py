@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+gipl_sweep.py
+
+Run GIPL for many perturbations of the soil parameters and convergence
+criteria (a parameter sweep), with the members of the sweep run as extra
+sites of a model.
+
+See also gipl_ensemble.py and bmi_gipl.py
+
+NOTES:
+    Regarding the parameter table:
+        A sweep is given as a dict from parameter name to a sequence with
+            one value per member, e.g. read from a CSV file with one column
+            per parameter by read_table().
+        'vwc', 'a_coef', 'b_coef', 'hcap_thw', 'hcap_frz', 'tcon_thw' and
+            'tcon_frz' are factors on the layer properties read from the
+            vegetation and geo files (see BmiGiplMethod.scale_parameters).
+        'smooth_coef' and 'unf_water_coef' replace the values of the
+            configuration file.
+        Parameters left out of the table keep their configured values.
+
+    Regarding the runs:
+        A run holds one copy of every site of the configuration per member,
+            member after member, and its forcing files repeat the sites'
+            columns once per member.  The input files are parsed once per
+            run, however many members it holds.  After initialize() the
+            properties of each copy are scaled by its member's factors.
+        smooth_coef and unf_water_coef are the same for all sites of a model,
+            so members that differ in them are run separately.  A run holds
+            at most members_per_run members, and the runs are spread over a
+            pool of worker processes as in gipl_ensemble.py.  Each run has
+            its own BmiGiplMethod, which is finalized when the run ends.
+        The runs write binary output to their work directories, which are
+            removed afterwards; the annual results are collected through
+            BmiGiplMethod instead.
+
+    Regarding the results:
+        run_sweep() returns a dict of arrays with one row per model year:
+            'annual_temperature' is (year, member, site, depth), and
+            'freeze_up_depth', 'freeze_up_time_current' and
+            'freeze_up_time_total' are (year, member, site).
+
+Usage:
+    python gipl_sweep.py <config_file> <table.csv> <results.npz> [n_processes]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import gipl_ensemble
+
+# The site-by-site factors, applied with BmiGiplMethod.scale_parameters()
+_factor_names = ('vwc', 'a_coef', 'b_coef', 'hcap_thw', 'hcap_frz',
+                 'tcon_thw', 'tcon_frz')
+
+# The values of the configuration file's line of convergence criteria,
+#   'smoothing factor | unfrozen water parameter | max number of iterations'
+_coef_names = ('smooth_coef', 'unf_water_coef')
+_cfg_coef_line = 22
+
+# The annual values collected after each year end, (site,) or
+#   (site, depth) in the model, and their BMI names
+_annual_names = {
+    'annual_temperature':      'soil__temperature__annual',
+    'freeze_up_depth':         'freezing_front__depth',
+    'freeze_up_time_current':  'freeze_up__time_current',
+    'freeze_up_time_total':    'freeze_up__time_total',
+}
+
+
+def print_usage():
+    print('Usage:')
+    print('  python {} <config_file> <table.csv> <results.npz> '
+          '[n_processes]'.format(sys.argv[0]))
+    print('e.g.:')
+    print('  python {} gipl_config.cfg sweep.csv sweep.npz 8'.format(
+        sys.argv[0]))
+    print(' ')
+
+
+def read_table(table_filename):
+    """ Read a parameter table from a CSV file with a header of names """
+    table = np.genfromtxt(table_filename, delimiter=',', names=True,
+                          dtype=np.float64, ndmin=1)
+    return dict((name, table[name]) for name in table.dtype.names)
+
+
+def _table_members(table):
+    """ Return the members of a parameter table as a list of dicts """
+    unknown = set(table) - set(_factor_names) - set(_coef_names)
+    if unknown:
+        raise ValueError('Unknown sweep parameters: {}'.format(
+            ', '.join(sorted(unknown))))
+    lengths = set(len(values) for values in table.values())
+    if len(lengths) != 1:
+        raise ValueError('The parameter table columns differ in length')
+    n_members = lengths.pop()
+    return [dict((name, float(values[i_member]))
+                 for name, values in table.items())
+            for i_member in range(n_members)]
+
+
+def _tile_columns(in_filename, n_copies, out_filename):
+    """ Write a forcing file with its site columns repeated n_copies times """
+    with open(in_filename) as in_file:
+        with open(out_filename, 'w') as out_file:
+            out_file.write(in_file.readline())
+            for line in in_file:
+                fields = line.split()
+                if not fields:
+                    continue
+                out_file.write(' '.join([fields[0]] + fields[1:] * n_copies))
+                out_file.write('\n')
+
+
+def make_run_dir(cfg_filename, members, run_dir, rundir=None):
+    """ Create the work directory of a run holding the given members
+
+    The members must agree on smooth_coef and unf_water_coef.  Returns the
+    number of sites of the configuration.
+    """
+    if rundir is None:
+        rundir = os.getcwd()
+
+    lines, files, n_time = gipl_ensemble.read_config(
+        os.path.join(rundir, cfg_filename))
+
+    def in_path(name):
+        return os.path.join(rundir, files[name])
+
+    chunk_files = gipl_ensemble._chunk_files
+    n_site, site_lines = gipl_ensemble._read_sites(in_path('sites'))
+    n_members = len(members)
+
+    os.makedirs(os.path.join(run_dir, 'in'))
+    os.makedirs(os.path.join(run_dir, 'output'))
+
+    with open(os.path.join(run_dir, chunk_files['sites']), 'w') as f:
+        f.write(' {}\n'.format(n_site * n_members))
+        f.writelines(site_lines * n_members)
+
+    for name in ('initial', 'grid', 'vegetation', 'geo'):
+        shutil.copyfile(in_path(name), os.path.join(run_dir, chunk_files[name]))
+
+    for name in ('bound', 'snow', 'rsnow'):
+        _tile_columns(in_path(name), n_members,
+                      os.path.join(run_dir, chunk_files[name]))
+
+    run_lines = list(lines)
+    for name, line_number in gipl_ensemble._cfg_input_lines.items():
+        run_lines[line_number] = chunk_files[name]
+    for name, line_number in gipl_ensemble._cfg_output_lines.items():
+        run_lines[line_number] = chunk_files[name]
+    coefs = run_lines[_cfg_coef_line].split()
+    for i_coef, name in enumerate(_coef_names):
+        if name in members[0]:
+            coefs[i_coef] = repr(members[0][name])
+    run_lines[_cfg_coef_line] = ' ' + '    '.join(coefs)
+    with open(os.path.join(run_dir, gipl_ensemble._chunk_cfg_name), 'w') as f:
+        f.write('\n'.join(run_lines) + '\n')
+
+    return n_site
+
+
+def run_members(cfg_filename, members, layers=None, rundir=None):
+    """ Run the members of a sweep as the sites of one model in this process
+
+    Each call runs its own model instance, so a process can run several
+    in turn.  Returns the annual results described in the notes above for
+    these members.
+    """
+    if rundir is None:
+        rundir = os.getcwd()
+    run_dir = tempfile.mkdtemp(prefix='gipl_sweep_')
+    cwd = os.getcwd()
+
+    try:
+        n_site = make_run_dir(cfg_filename, members, run_dir, rundir=rundir)
+        os.chdir(run_dir)
+
+        if gipl_ensemble._gipl_dir not in sys.path:
+            sys.path.insert(0, gipl_ensemble._gipl_dir)
+        import bmi_gipl
+
+        model = bmi_gipl.BmiGiplMethod()
+        model.set_option('output_format', 'binary')
+        model.initialize(gipl_ensemble._chunk_cfg_name)
+
+        factors = {}
+        for name in _factor_names:
+            if name in members[0]:
+                factors[name] = np.repeat(
+                    [member[name] for member in members], n_site)
+        if factors:
+            model.scale_parameters(factors, layers=layers)
+
+        # write_output() takes the annual means at the step before a year end
+        n_time = int(model.get_value('model_timesteps_per_year'))
+        annual = dict((name, []) for name in _annual_names)
+        end_time = model.get_end_time()
+        while model.get_current_time() < end_time:
+            model.update()
+            if int(model.get_current_time()) % n_time == n_time - 1:
+                for name, var_name in _annual_names.items():
+                    values = model.get_value(var_name)
+                    annual[name].append(values.reshape(
+                        (len(members), n_site) + values.shape[1:]))
+        model.finalize()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(run_dir)
+
+    return dict((name, np.array(rows)) for name, rows in annual.items())
+
+
+def _run_members_star(args):
+    return run_members(*args)
+
+
+def run_sweep(cfg_filename, table, processes=None, members_per_run=256,
+              layers=None, rundir=None):
+    """ Run every member of a parameter table
+
+    See the notes above for the table and the results.  layers restricts
+    the factors to these 1-based soil layer numbers.
+    """
+    if rundir is None:
+        rundir = os.getcwd()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    members = _table_members(table)
+
+    # Members that share the convergence criteria can share a run
+    groups = {}
+    for i_member, member in enumerate(members):
+        key = tuple(member.get(name) for name in _coef_names)
+        groups.setdefault(key, []).append(i_member)
+
+    runs = []
+    for key in sorted(groups, key=str):
+        indices = groups[key]
+        for first in range(0, len(indices), members_per_run):
+            runs.append(indices[first:first + members_per_run])
+
+    pool = gipl_ensemble._make_pool(processes)
+    try:
+        run_results = pool.map(
+            _run_members_star,
+            [(cfg_filename, [members[i] for i in run], layers, rundir)
+             for run in runs],
+            chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = {}
+    for name in _annual_names:
+        first = run_results[0][name]
+        stacked = np.zeros((first.shape[0], len(members)) + first.shape[2:])
+        for run, run_result in zip(runs, run_results):
+            stacked[:, run] = run_result[name]
+        results[name] = stacked
+    return results
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 4:
+        print_usage()
+        sys.exit(1)
+
+    if len(sys.argv) > 4:
+        results = run_sweep(sys.argv[1], read_table(sys.argv[2]),
+                            processes=int(sys.argv[4]))
+    else:
+        results = run_sweep(sys.argv[1], read_table(sys.argv[2]))
+    np.savez(sys.argv[3], **results)